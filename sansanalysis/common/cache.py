@@ -0,0 +1,135 @@
+"""
+    Process-level caches shared by the analysis applications.
+
+    The cache is bounded by the total size of the stored values
+    rather than by the number of entries, since the size of a
+    data set can vary by several orders of magnitude.
+"""
+import threading
+
+class LRUCache(object):
+    """
+        Least-recently-used cache bounded by the total size, in bytes,
+        of the stored items. The size of each item is given by the caller
+        when it is stored.
+    """
+    def __init__(self, max_bytes):
+        """
+            @param max_bytes: maximum total size of the cached items
+        """
+        ## Maximum total size of the cached items
+        self.max_bytes = max_bytes
+        ## Current total size of the cached items
+        self.size = 0
+        ## Number of successful look-ups
+        self.hits = 0
+        ## Number of failed look-ups
+        self.misses = 0
+        ## Number of items removed to make room for new ones
+        self.evictions = 0
+
+        # Stored items {key: [value, nbytes, tick]}
+        self._items = {}
+        # Access counter used to order items by last use
+        self._tick = 0
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        """
+            Returns the item stored under the given key, or the
+            default value if no such item exists.
+            @param key: item key
+            @param default: value returned on a miss
+        """
+        self._lock.acquire()
+        try:
+            item = self._items.get(key, None)
+            if item is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._tick += 1
+            item[2] = self._tick
+            return item[0]
+        finally:
+            self._lock.release()
+
+    def put(self, key, value, nbytes):
+        """
+            Store an item. Least recently used items are evicted
+            until the total size is within bounds. An item larger
+            than the cache itself is not stored.
+
+            @param key: item key
+            @param value: item to store
+            @param nbytes: size of the item, in bytes
+            @return: True if the item was stored
+        """
+        self._lock.acquire()
+        try:
+            self._remove(key)
+            if nbytes > self.max_bytes:
+                return False
+
+            while self.size + nbytes > self.max_bytes and len(self._items)>0:
+                oldest = min(self._items, key=lambda k: self._items[k][2])
+                self._remove(oldest)
+                self.evictions += 1
+
+            self._tick += 1
+            self._items[key] = [value, nbytes, self._tick]
+            self.size += nbytes
+            return True
+        finally:
+            self._lock.release()
+
+    def invalidate(self, match):
+        """
+            Remove all items for which match(key) is True
+            @param match: callable taking a key as argument
+            @return: number of items removed
+        """
+        self._lock.acquire()
+        try:
+            keys = [k for k in self._items if match(k)]
+            for k in keys:
+                self._remove(k)
+            return len(keys)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """
+            Remove all items and reset the counters
+        """
+        self._lock.acquire()
+        try:
+            self._items = {}
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+        finally:
+            self._lock.release()
+
+    def get_stats(self):
+        """
+            Returns a dictionary of cache statistics
+        """
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._items),
+                'size': self.size,
+                'max_size': self.max_bytes}
+
+    def _remove(self, key):
+        item = self._items.pop(key, None)
+        if item is not None:
+            self.size -= item[1]
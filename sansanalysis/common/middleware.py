@@ -0,0 +1,22 @@
+"""
+    Middleware shared by all applications
+"""
+
+class SessionSizeMiddleware(object):
+    """
+        Reports the size of the encoded session data, in bytes,
+        in the X-Session-Size header of each response.
+        Sessions that are not used by the request are not loaded.
+    """
+    ## Name of the response header
+    HEADER = 'X-Session-Size'
+
+    def process_response(self, request, response):
+        session = getattr(request, 'session', None)
+        if session is not None and session.accessed:
+            try:
+                response[self.HEADER] = str(len(session.encode(dict(session.items()))))
+            except:
+                # The header is only informative
+                pass
+        return response
@@ -0,0 +1,9 @@
+from sansanalysis.jobs.models import Job
+from django.contrib import admin
+
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'kind', 'get_user_name', 'status', 'progress', 'attempts', 'created_on', 'finished_on')
+    list_filter = ['status', 'kind', 'created_on']
+    date_hierarchy = 'created_on'
+
+admin.site.register(Job, JobAdmin)
@@ -0,0 +1,248 @@
+"""
+    Submission and execution of background jobs.
+
+    The function executing each kind of job is given by the JOB_HANDLERS
+    setting, which maps job kinds to the dotted path of a function.
+    A handler takes the Job object as argument and returns a result that
+    can be encoded as JSON. It may raise JobError to fail the job without
+    retrying it; any other exception puts the job back in the queue until
+    it runs out of attempts.
+
+    State changes are made with conditional updates so that several
+    workers can share the same queue.
+
+    Each user may have at most JOB_MAX_QUEUED_PER_USER jobs waiting
+    or running, and at most JOB_MAX_RUNNING_PER_USER jobs running at
+    the same time: the jobs of a user who reached that limit stay in
+    the queue while the jobs of other users are executed.
+
+    A running job whose worker died would otherwise never finish. Workers
+    record a heartbeat when they claim a job and each time they report its
+    progress; before claiming a job, running jobs without a heartbeat for
+    JOB_RUNNING_TIMEOUT seconds are put back in the queue, or failed if
+    they ran out of attempts.
+"""
+import sys, datetime
+
+from django.db.models import F, Q
+from django.utils import simplejson
+from django.utils.importlib import import_module
+
+from sansanalysis.app_logging.models import store_error
+from models import Job, QUEUED, RUNNING, DONE, FAILED, CANCELLED
+import sansanalysis.settings
+
+class JobError(Exception):
+    """
+        Raised by a job handler for failures that retrying won't fix
+    """
+    pass
+
+class JobLimitError(Exception):
+    """
+        Raised when a user submits a job while having too many
+        jobs waiting or running
+    """
+    pass
+
+def get_handler(kind):
+    """
+        Returns the function executing a given kind of job
+        @param kind: job kind
+    """
+    path = sansanalysis.settings.JOB_HANDLERS.get(kind, None)
+    if path is None:
+        raise JobError, "No handler for jobs of type '%s'" % kind
+    module_name, function_name = path.rsplit('.', 1)
+    return getattr(import_module(module_name), function_name)
+
+def find_active(kind, owner, fingerprint):
+    """
+        Returns the oldest job of a user that is queued or running
+        with a given fingerprint, or None
+        @param kind: job kind
+        @param owner: ID of the user
+        @param fingerprint: fingerprint given to submit
+    """
+    jobs = Job.objects.filter(kind=kind, owner=owner, fingerprint=fingerprint,
+                              status__in=[QUEUED, RUNNING]).order_by('created_on')[:1]
+    if len(jobs)==0:
+        return None
+    return jobs[0]
+
+def find_done(kind, owner, fingerprint):
+    """
+        Returns the job of a user with a given fingerprint
+        that was completed last, or None
+        @param kind: job kind
+        @param owner: ID of the user
+        @param fingerprint: fingerprint given to submit
+    """
+    jobs = Job.objects.filter(kind=kind, owner=owner, fingerprint=fingerprint,
+                              status=DONE).order_by('-finished_on')[:1]
+    if len(jobs)==0:
+        return None
+    return jobs[0]
+
+def submit(kind, owner, parameters, max_attempts=None, fingerprint=None):
+    """
+        Add a job to the queue
+        @param kind: job kind, one of the keys of JOB_HANDLERS
+        @param owner: ID of the user submitting the job
+        @param parameters: dictionary of input parameters
+        @param max_attempts: maximum number of times the job can be started
+        @param fingerprint: digest identifying jobs that compute the same
+            result, used by find_active, or None
+        @return: Job object
+        @raise JobLimitError: if the user has too many jobs waiting or running
+    """
+    max_active = sansanalysis.settings.JOB_MAX_QUEUED_PER_USER
+    if max_active is not None and \
+        Job.objects.filter(owner=owner, status__in=[QUEUED, RUNNING]).count() >= max_active:
+        raise JobLimitError, "You already have %d jobs waiting or running" % max_active
+    
+    job = Job(kind=kind, owner=owner, status=QUEUED, fingerprint=fingerprint)
+    job.set_parameters(parameters)
+    if max_attempts is not None:
+        job.max_attempts = max_attempts
+    job.save()
+    return job
+
+def _get_busy_owners():
+    """
+        Returns the list of users that have as many running
+        jobs as they are allowed to
+    """
+    max_running = sansanalysis.settings.JOB_MAX_RUNNING_PER_USER
+    if max_running is None:
+        return []
+    counts = {}
+    for owner in Job.objects.filter(status=RUNNING).values_list('owner', flat=True):
+        counts[owner] = counts.get(owner, 0)+1
+    return [owner for owner, count in counts.items() if count >= max_running]
+
+def recover_stale():
+    """
+        Put back in the queue the running jobs that have not shown
+        any sign of life for JOB_RUNNING_TIMEOUT seconds, or fail
+        them if they ran out of attempts
+        @return: number of jobs recovered
+    """
+    timeout = sansanalysis.settings.JOB_RUNNING_TIMEOUT
+    if timeout is None:
+        return 0
+    now = datetime.datetime.now()
+    limit = now - datetime.timedelta(seconds=timeout)
+    # Jobs claimed before heartbeats were recorded only have a start time
+    stale = Job.objects.filter(status=RUNNING).filter(Q(heartbeat_on__lt=limit) |
+                                                      Q(heartbeat_on__isnull=True, started_on__lt=limit))
+    error = "The job did not respond for %g seconds" % timeout
+    n_failed = stale.filter(attempts__gte=F('max_attempts')).update(status=FAILED, error=error, finished_on=now)
+    n_queued = stale.update(status=QUEUED, error=error)
+    if n_failed+n_queued>0:
+        error_msg = "Recovered %d stale jobs: %d queued, %d failed" % (n_failed+n_queued, n_queued, n_failed)
+        store_error(user=None, url=None, text=error_msg, method='jobs.recover_stale', build=sansanalysis.settings.APP_VERSION)
+    return n_failed+n_queued
+
+def claim_next(kinds=None):
+    """
+        Mark the oldest queued job as running and return it.
+        Returns None if the queue is empty or if all queued jobs
+        belong to users who reached their limit of running jobs.
+        Stale running jobs are recovered first, see recover_stale.
+        @param kinds: list of job kinds to consider, or None for all
+    """
+    recover_stale()
+    candidates = Job.objects.filter(status=QUEUED)
+    if kinds is not None:
+        candidates = candidates.filter(kind__in=kinds)
+    busy_owners = _get_busy_owners()
+    if len(busy_owners)>0:
+        candidates = candidates.exclude(owner__in=busy_owners)
+
+    for job_id in candidates.order_by('created_on').values_list('id', flat=True)[:10]:
+        # Another worker may have claimed the job since the query
+        now = datetime.datetime.now()
+        claimed = Job.objects.filter(pk=job_id, status=QUEUED).update(status=RUNNING,
+                                                                     started_on=now,
+                                                                     heartbeat_on=now,
+                                                                     attempts=F('attempts')+1)
+        if claimed==1:
+            return Job.objects.get(pk=job_id)
+    return None
+
+def set_progress(job, progress, result=None):
+    """
+        Update the fraction of a running job that is completed,
+        and record a heartbeat for the job
+        @param job: Job object
+        @param progress: fraction completed, between 0 and 1
+        @param result: partial result, or None to leave the result unchanged.
+            It is replaced by the output of the handler when the job is done.
+    """
+    job.progress = progress
+    now = datetime.datetime.now()
+    if result is None:
+        Job.objects.filter(pk=job.id, status=RUNNING).update(progress=progress, heartbeat_on=now)
+    else:
+        job.set_result(result)
+        Job.objects.filter(pk=job.id, status=RUNNING).update(progress=progress, result=job.result, heartbeat_on=now)
+
+def is_cancelled(job):
+    """
+        Returns True if the job was cancelled.
+        Long-running handlers should check this periodically.
+        @param job: Job object
+    """
+    return Job.objects.filter(pk=job.id, status=CANCELLED).count()>0
+
+def cancel(job):
+    """
+        Cancel a job that is queued or running
+        @param job: Job object
+        @return: True if the job was cancelled
+    """
+    cancelled = Job.objects.filter(pk=job.id, status__in=[QUEUED, RUNNING]).update(status=CANCELLED,
+                                                                                 finished_on=datetime.datetime.now())
+    return cancelled==1
+
+def run_job(job):
+    """
+        Execute a claimed job and record its outcome
+        @param job: Job object, in the running state
+        @return: final status of the job
+    """
+    running = Job.objects.filter(pk=job.id, status=RUNNING)
+    try:
+        handler = get_handler(job.kind)
+        result = handler(job)
+        running.update(status=DONE, result=simplejson.dumps(result), error=None,
+                       progress=1.0, finished_on=datetime.datetime.now())
+    except JobError:
+        running.update(status=FAILED, error=str(sys.exc_value),
+                       finished_on=datetime.datetime.now())
+    except:
+        error_msg = "Job %d [%s] failed on attempt %d\n%s" % (job.id, job.kind, job.attempts, sys.exc_value)
+        store_error(user=None, url=None, text=error_msg, method='jobs.run_job', build=sansanalysis.settings.APP_VERSION)
+        if job.attempts < job.max_attempts:
+            running.update(status=QUEUED, error=str(sys.exc_value))
+        else:
+            running.update(status=FAILED, error=str(sys.exc_value),
+                           finished_on=datetime.datetime.now())
+    return Job.objects.get(pk=job.id).status
+
+def run_pending(kinds=None, max_jobs=None):
+    """
+        Execute queued jobs until the queue is empty
+        @param kinds: list of job kinds to execute, or None for all
+        @param max_jobs: maximum number of jobs to execute, or None for no limit
+        @return: number of jobs executed
+    """
+    n_jobs = 0
+    while max_jobs is None or n_jobs < max_jobs:
+        job = claim_next(kinds)
+        if job is None:
+            break
+        run_job(job)
+        n_jobs += 1
+    return n_jobs
@@ -0,0 +1,55 @@
+import time
+import multiprocessing
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from sansanalysis.jobs import job_queue
+
+class Command(BaseCommand):
+    """
+        Execute the queued background jobs
+    """
+    option_list = BaseCommand.option_list + (
+        make_option('--once', action='store_true', dest='once', default=False,
+                    help='Exit once the queue is empty instead of waiting for new jobs'),
+        make_option('--sleep', dest='sleep', type='float', default=2.0,
+                    help='Seconds to wait between checks of an empty queue'),
+        make_option('--kind', action='append', dest='kinds', default=None,
+                    help='Only execute jobs of this type. Can be repeated.'),
+        make_option('--processes', dest='processes', type='int', default=1,
+                    help='Number of worker processes executing jobs at the same time'),
+    )
+    help = 'Execute the queued background jobs'
+
+    def handle(self, *args, **options):
+        if options['processes']<=1:
+            _run_worker(options)
+            return
+        
+        # The workers open their own database connections
+        connection.close()
+        workers = [multiprocessing.Process(target=_run_worker, args=(options,)) for i in range(options['processes'])]
+        for worker in workers:
+            worker.start()
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            for worker in workers:
+                worker.terminate()
+
+def _run_worker(options):
+    """
+        Execute queued jobs until the queue is empty,
+        or forever unless the --once option is given
+    """
+    verbosity = int(options.get('verbosity', 1))
+    while True:
+        n_jobs = job_queue.run_pending(kinds=options['kinds'])
+        if verbosity>1 and n_jobs>0:
+            print "Executed %d jobs" % n_jobs
+        if options['once']:
+            break
+        time.sleep(options['sleep'])
@@ -0,0 +1,89 @@
+from django.db import models
+from django.contrib.auth.models import User
+from django.utils import simplejson
+
+## Job states
+QUEUED    = 'queued'
+RUNNING   = 'running'
+DONE      = 'done'
+FAILED    = 'failed'
+CANCELLED = 'cancelled'
+
+STATUS_CHOICES = ((QUEUED, 'Queued'),
+                  (RUNNING, 'Running'),
+                  (DONE, 'Done'),
+                  (FAILED, 'Failed'),
+                  (CANCELLED, 'Cancelled'))
+
+## States from which a job will not change anymore
+FINAL_STATES = [DONE, FAILED, CANCELLED]
+
+class Job(models.Model):
+    """
+        Unit of work executed outside of the request cycle
+        by the run_jobs management command
+    """
+    ## Type of job, used to find the function that executes it
+    kind = models.CharField(max_length=50)
+    ## Owner
+    owner = models.IntegerField()
+    ## Current state of the job
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=QUEUED)
+    ## Input parameters, JSON-encoded
+    parameters = models.TextField(default='{}')
+    ## Digest identifying jobs computing the same result, or None
+    fingerprint = models.CharField(max_length=64, null=True, db_index=True)
+    ## Output of the job, JSON-encoded
+    result = models.TextField(null=True)
+    ## Error message of the last failed attempt
+    error = models.TextField(null=True)
+    ## Fraction of the job completed, between 0 and 1
+    progress = models.FloatField(default=0)
+    ## Number of times the job was started
+    attempts = models.IntegerField(default=0)
+    ## Maximum number of times the job can be started
+    max_attempts = models.IntegerField(default=3)
+    ## Created on
+    created_on = models.DateTimeField('Created', auto_now_add=True)
+    ## Time the last attempt was started
+    started_on = models.DateTimeField('Started', null=True)
+    ## Last time the worker executing the job showed it was still alive
+    heartbeat_on = models.DateTimeField('Heartbeat', null=True)
+    ## Time the job reached a final state
+    finished_on = models.DateTimeField('Finished', null=True)
+
+    def get_parameters(self):
+        """
+            Returns the input parameters as a dictionary
+        """
+        return simplejson.loads(self.parameters)
+
+    def set_parameters(self, parameters):
+        self.parameters = simplejson.dumps(parameters)
+
+    def get_result(self):
+        """
+            Returns the output of the job, or None if it is not available
+        """
+        if self.result is None:
+            return None
+        return simplejson.loads(self.result)
+
+    def set_result(self, result):
+        self.result = simplejson.dumps(result)
+
+    def is_finished(self):
+        """
+            Returns True if the job will not change state anymore
+        """
+        return self.status in FINAL_STATES
+
+    def get_user_name(self):
+        """
+            Return the name of the owner of the job
+        """
+        try:
+            return User.objects.get(pk=self.owner).username
+        except User.DoesNotExist:
+            return "System"
+    get_user_name.short_description = 'User name'
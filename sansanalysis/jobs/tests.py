@@ -0,0 +1,183 @@
+import unittest
+import threading
+import time
+import datetime
+import BaseHTTPServer
+
+# Import Django modules
+from django.contrib.auth.models import User
+
+# Import application modules
+from sansanalysis.jobs.models import Job, QUEUED, RUNNING, DONE, FAILED, CANCELLED
+from sansanalysis.jobs import job_queue
+from sansanalysis.jobs.job_queue import JobLimitError
+from sansanalysis.simpleplot.models import IqData
+import sansanalysis.settings
+
+TESTUSER = "SANSJOBSTESTUSER"
+TESTFILE = 'simpleplot/test/sphere_80.txt'
+
+class DataRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+        Local stand-in for a remote server hosting data files
+    """
+    def do_GET(self):
+        if self.path.startswith('/sphere_80.txt'):
+            content = open(TESTFILE, 'r').read()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+        elif self.path.startswith('/garbage.txt'):
+            content = "this is not a data file"
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(content)
+        elif self.path.startswith('/slow.txt'):
+            self.send_response(200)
+            self.end_headers()
+            time.sleep(2)
+        else:
+            self.send_error(404)
+
+    def log_message(self, format, *args):
+        pass
+
+class job_tests(unittest.TestCase):
+
+    def setUp(self):
+        users = User.objects.filter(username=TESTUSER)
+        if len(users)==0:
+            self.user = User(username=TESTUSER)
+            self.user.save()
+        else:
+            self.user = users[0]
+
+        # Clear jobs left by other tests
+        Job.objects.filter(status__in=[QUEUED, RUNNING]).update(status=CANCELLED)
+
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), DataRequestHandler)
+        self.base_url = "http://127.0.0.1:%d" % self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _fetch(self, path, max_attempts=1):
+        job = job_queue.submit('fetch_url', self.user.id, {'url': self.base_url+path}, max_attempts=max_attempts)
+        self.assertEqual(job_queue.run_pending(kinds=['fetch_url']), 1)
+        return Job.objects.get(pk=job.id)
+
+    def test_fetch_url(self):
+        """
+            Check that a data file is downloaded and parsed by a job
+        """
+        job = self._fetch('/sphere_80.txt')
+        self.assertEqual(job.status, DONE)
+        self.assertEqual(job.attempts, 1)
+        iq_data = IqData.objects.get(pk=job.get_result()['iq_id'])
+        self.assertEqual(iq_data.owner, self.user.id)
+        self.assertEqual(len(iq_data.content_hash), 64)
+
+    def test_invalid_data(self):
+        """
+            Check that files that can't be parsed fail without retry
+        """
+        job = self._fetch('/garbage.txt', max_attempts=3)
+        self.assertEqual(job.status, FAILED)
+        self.assertEqual(job.attempts, 1)
+
+    def test_size_limit(self):
+        """
+            Check that the size limit is enforced
+        """
+        max_size = sansanalysis.settings.IQDATA_MAX_UPLOAD_SIZE
+        sansanalysis.settings.IQDATA_MAX_UPLOAD_SIZE = 100
+        try:
+            job = self._fetch('/sphere_80.txt')
+        finally:
+            sansanalysis.settings.IQDATA_MAX_UPLOAD_SIZE = max_size
+        self.assertEqual(job.status, FAILED)
+
+    def test_timeout_retry(self):
+        """
+            Check that a timed-out download is put back in the queue
+        """
+        timeout = sansanalysis.settings.IQDATA_FETCH_TIMEOUT
+        sansanalysis.settings.IQDATA_FETCH_TIMEOUT = 0.5
+        try:
+            job = job_queue.submit('fetch_url', self.user.id, {'url': self.base_url+'/slow.txt'}, max_attempts=2)
+            job_queue.run_job(job_queue.claim_next(['fetch_url']))
+            self.assertEqual(Job.objects.get(pk=job.id).status, QUEUED)
+            job_queue.run_job(job_queue.claim_next(['fetch_url']))
+        finally:
+            sansanalysis.settings.IQDATA_FETCH_TIMEOUT = timeout
+        job = Job.objects.get(pk=job.id)
+        self.assertEqual(job.status, FAILED)
+        self.assertEqual(job.attempts, 2)
+
+    def test_claim(self):
+        """
+            Check that a job can only be claimed once
+        """
+        job = job_queue.submit('fetch_url', self.user.id, {'url': self.base_url+'/sphere_80.txt'})
+        claimed = job_queue.claim_next(['fetch_url'])
+        self.assertEqual(claimed.id, job.id)
+        self.assertEqual(claimed.status, RUNNING)
+        self.assertEqual(job_queue.claim_next(['fetch_url']), None)
+        self.assertTrue(job_queue.cancel(claimed))
+        self.assertTrue(job_queue.is_cancelled(claimed))
+
+    def test_stale_jobs(self):
+        """
+            Check that a running job abandoned by its worker is put back
+            in the queue, then failed once it ran out of attempts
+        """
+        job = job_queue.submit('fetch_url', self.user.id, {'url': self.base_url+'/sphere_80.txt'}, max_attempts=2)
+        claimed = job_queue.claim_next(['fetch_url'])
+        self.assertEqual(claimed.id, job.id)
+        
+        # A job reporting its progress is not recovered
+        job_queue.set_progress(claimed, 0.5)
+        self.assertEqual(job_queue.recover_stale(), 0)
+        
+        # The worker stops responding
+        timeout = sansanalysis.settings.JOB_RUNNING_TIMEOUT
+        last_seen = datetime.datetime.now() - datetime.timedelta(seconds=2*timeout)
+        Job.objects.filter(pk=job.id).update(heartbeat_on=last_seen)
+        claimed = job_queue.claim_next(['fetch_url'])
+        self.assertEqual(claimed.id, job.id)
+        self.assertEqual(claimed.status, RUNNING)
+        self.assertEqual(claimed.attempts, 2)
+        
+        Job.objects.filter(pk=job.id).update(heartbeat_on=last_seen)
+        self.assertEqual(job_queue.recover_stale(), 1)
+        job = Job.objects.get(pk=job.id)
+        self.assertEqual(job.status, FAILED)
+        self.assertNotEqual(job.error, None)
+        self.assertNotEqual(job.finished_on, None)
+        self.assertEqual(job_queue.claim_next(['fetch_url']), None)
+        
+    def test_user_limits(self):
+        """
+            Check the limits on the number of jobs of a user
+        """
+        max_queued = sansanalysis.settings.JOB_MAX_QUEUED_PER_USER
+        max_running = sansanalysis.settings.JOB_MAX_RUNNING_PER_USER
+        sansanalysis.settings.JOB_MAX_QUEUED_PER_USER = 2
+        sansanalysis.settings.JOB_MAX_RUNNING_PER_USER = 1
+        try:
+            first = job_queue.submit('fetch_url', self.user.id, {'url': self.base_url+'/sphere_80.txt'})
+            job_queue.submit('fetch_url', self.user.id, {'url': self.base_url+'/sphere_80.txt'})
+            self.assertRaises(JobLimitError, job_queue.submit, 'fetch_url', self.user.id,
+                              {'url': self.base_url+'/sphere_80.txt'})
+            
+            # Only one job of the user runs at a time
+            self.assertEqual(job_queue.claim_next(['fetch_url']).id, first.id)
+            self.assertEqual(job_queue.claim_next(['fetch_url']), None)
+        finally:
+            sansanalysis.settings.JOB_MAX_QUEUED_PER_USER = max_queued
+            sansanalysis.settings.JOB_MAX_RUNNING_PER_USER = max_running
@@ -0,0 +1,6 @@
+from django.conf.urls.defaults import *
+
+urlpatterns = patterns('sansanalysis.jobs.views',
+    (r'^(?P<job_id>\d+)/status/$', 'job_status'),
+    (r'^(?P<job_id>\d+)/cancel/$', 'cancel_job'),
+)
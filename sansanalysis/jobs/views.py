@@ -0,0 +1,53 @@
+from django.shortcuts import get_object_or_404
+from django.http import HttpResponse, Http404
+from django.contrib.auth.decorators import login_required
+from django.utils.html import escape
+
+from sansanalysis.jobs.models import Job
+from sansanalysis.jobs import job_queue
+
+def _get_user_job(request, job_id):
+    """
+        Returns a job owned by the current user
+        @param job_id: pk of the Job object
+    """
+    job = get_object_or_404(Job, pk=job_id)
+    if job.owner != request.user.id:
+        raise Http404
+    return job
+
+def _job_as_xml(job):
+    """
+        Returns the status of a job as an XML string
+        @param job: Job object
+    """
+    resp = "<?xml version=\"1.0\" encoding=\"ISO-8859-1\"?>\n<job>\n"
+    resp += "<id>%d</id>\n<kind>%s</kind>\n<status>%s</status>\n" % (job.id, job.kind, job.status)
+    resp += "<progress>%g</progress>\n<attempts>%d</attempts>\n" % (job.progress, job.attempts)
+    if job.error is not None:
+        resp += "<error>%s</error>\n" % escape(job.error)
+    result = job.get_result()
+    if isinstance(result, dict) and result.has_key('url'):
+        resp += "<url>%s</url>\n" % escape(result['url'])
+    resp += "</job>"
+    return resp
+
+@login_required
+def job_status(request, job_id):
+    """
+        Ajax call returning the status of a job
+        @param job_id: pk of the Job object
+    """
+    job = _get_user_job(request, job_id)
+    return HttpResponse(_job_as_xml(job), mimetype="text/xml")
+
+@login_required
+def cancel_job(request, job_id):
+    """
+        Ajax call to cancel a job
+        @param job_id: pk of the Job object
+    """
+    job = _get_user_job(request, job_id)
+    job_queue.cancel(job)
+    job = Job.objects.get(pk=job.id)
+    return HttpResponse(_job_as_xml(job), mimetype="text/xml")
@@ -30,7 +30,7 @@ class SansFit():
     
     def __init__(self, model, data, fit_params=[], smearer=None, qmin=None, qmax=None):
         """
-            @param data: Data1D object
+            @param data: Data1D object, with points sorted by increasing Q
             @param smearer: Smearer object. If supplied, will override the smearing info is part of Data1D
         """ 
         ## SANS model
@@ -69,22 +69,26 @@ class SansFit():
         if qmax==None: self.qmax = max(self.data.x)
         else:          self.qmax=float(qmax)
             
+        # Identify the bin range for the smeared space. The points
+        # are sorted by Q, so the range is a contiguous block of points.
+        first = int(numpy.searchsorted(self.data.x, self.qmin, side='left'))
+        last  = int(numpy.searchsorted(self.data.x, self.qmax, side='right'))
+        self.idx = slice(first, max(first, last))
+        
         # Determine the range needed in unsmeared-Q to cover
         # the smeared Q range
         self._qmin_unsmeared = self.qmin
         self._qmax_unsmeared = self.qmax    
         
-        self._first_unsmeared_bin = 0
-        self._last_unsmeared_bin  = len(self.data.x)-1
+        self._first_unsmeared_bin = first
+        self._last_unsmeared_bin  = last-1
         
         if self.smearer!=None:
             self._first_unsmeared_bin, self._last_unsmeared_bin = self.smearer.get_bin_range(self.qmin, self.qmax)
             self._qmin_unsmeared = self.data.x[self._first_unsmeared_bin]
             self._qmax_unsmeared = self.data.x[self._last_unsmeared_bin]
             
-        # Identify the bin range for the unsmeared and smeared spaces
-        self.idx = (self.data.x>=self.qmin) & (self.data.x <= self.qmax)
-        self.idx_unsmeared = (self.data.x>=self._qmin_unsmeared) & (self.data.x <= self._qmax_unsmeared)
+        self.idx_unsmeared = slice(self._first_unsmeared_bin, self._last_unsmeared_bin+1)
   
 
     def residuals(self, params=None):
@@ -103,32 +107,35 @@ class SansFit():
                 self.fit_params[i].set(params[i])
         
         # Compute theory data f(x)
-        fx= numpy.zeros(len(self.data.x))
-        fx[self.idx_unsmeared] = self.model.evalDistribution(self.data.x[self.idx_unsmeared])
-       
-        ## Smear theory data
-        if self.smearer is not None:
-            fx = self.smearer(fx, self._first_unsmeared_bin, self._last_unsmeared_bin)
+        fx = self._get_theory()
        
         ## Sanity check
-        if numpy.size(self.dy)!= numpy.size(fx):
-            raise RuntimeError, "SansFit: invalid error array %d <> %d" % (numpy.shape(self.dy),
+        dy = self.dy[self.idx]
+        if numpy.size(dy)!= numpy.size(fx):
+            raise RuntimeError, "SansFit: invalid error array %d <> %d" % (numpy.size(dy),
                                                                            numpy.size(fx))
                                                                               
-        return (self.data.y[self.idx]-fx[self.idx])/self.dy[self.idx]
+        return (self.data.y[self.idx]-fx)/dy
     
     def get_model_distribution(self):
         """
         """
-        # Compute theory data f(x)
+        return self.data.x[self.idx], self._get_theory()
+    
+    def _get_theory(self):
+        """
+            Compute theory data over the fitted Q range.
+            Without smearing, only the points within the Q range are evaluated.
+        """
+        if self.smearer is None:
+            return self.model.evalDistribution(self.data.x[self.idx])
+        
         fx= numpy.zeros(len(self.data.x))
         fx[self.idx_unsmeared] = self.model.evalDistribution(self.data.x[self.idx_unsmeared])
        
         ## Smear theory data
-        if self.smearer is not None:
-            fx = self.smearer(fx, self._first_unsmeared_bin, self._last_unsmeared_bin)
-                                                                                     
-        return self.data.x[self.idx], fx[self.idx]
+        fx = self.smearer(fx, self._first_unsmeared_bin, self._last_unsmeared_bin)
+        return fx[self.idx]
     
      
     def chi2(self, params=None):
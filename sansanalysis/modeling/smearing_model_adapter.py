@@ -314,6 +314,24 @@ def get_default_smear_adapter(data1d):
     else:
         return None
     
+def get_default_smear_adapter_from_metadata(iq_data):
+    """
+        Returns the default smearing adapter for a data set,
+        using the summary of the data stored at upload time
+        @param iq_data: IqData object
+    """
+    if iq_data.smearing == 'point':
+        return PointSmearerAdapter(fit_parameters=dict(smear_dq_min=iq_data.dq_min,
+                                                       smear_dq_avg=iq_data.dq_avg,
+                                                       smear_dq_max=iq_data.dq_max),
+                                   is_fixed=True)
+    elif iq_data.smearing == 'slit':
+        return SlitSmearerAdapter(fit_parameters=dict(smear_width=iq_data.slit_width,
+                                                      smear_height=iq_data.slit_height),
+                                  is_fixed=True)
+    else:
+        return None
+    
 def get_smear_adapter_class_by_type(smearer_model_id):
     """
         Returns the smear adapter class correspinding smearing type
@@ -16,6 +16,7 @@ urlpatterns = patterns(
     (r'^smearing/(?P<model_id>\d+)/parameters/$', 'get_smearing_parameters'),
     (r'^model/(?P<model_id>\d+)/table$', 'get_model_table'),
     (r'^(?P<iq_id>\d+)/model/(?P<model_id>\d+)/$', 'get_model_update'),
+    (r'^(?P<iq_id>\d+)/model/(?P<model_id>\d+)/data/$', 'model_plot_data'),
     (r'^model/dialog$', 'get_fit_model_dialog'),
 
 )
@@ -2,6 +2,7 @@
 from django.template import Context, loader
 
 # Application imports
+from sansanalysis.simpleplot.models import IqData
 import smearing_model_adapter
 import data_manipulations
 import forms as modeling_forms
@@ -39,10 +40,6 @@ def smearing_model_as_table(request, smearer_model_id=None, iq_id=None):
     """
     t = loader.get_template('modeling/smearing_parameters.html')
 
-    # Get the data object if available
-    if iq_id is not None:
-        data1d = data_manipulations.get_data(iq_id)
-
     # Defaults
     # TODO: This needs to be a short string to be compatible 
     # with the max length of the smearing type in the DB.
@@ -59,7 +56,13 @@ def smearing_model_as_table(request, smearer_model_id=None, iq_id=None):
         if adapter_cls is not None:
             adapter = adapter_cls()
     elif iq_id is not None:
-        adapter = smearing_model_adapter.get_default_smear_adapter(data1d)
+        # Use the smearing information stored at upload time if available
+        iq = IqData.objects.get(pk=iq_id)
+        if iq.has_metadata():
+            adapter = smearing_model_adapter.get_default_smear_adapter_from_metadata(iq)
+        else:
+            data1d = data_manipulations.get_data(iq_id)
+            adapter = smearing_model_adapter.get_default_smear_adapter(data1d)
     else:
         raise ValueError, "view_util.smearing_model_as_table takes either a model ID or a Data1D object"
     
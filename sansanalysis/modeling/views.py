@@ -13,6 +13,7 @@ from django.template import Context, loader
 import sansanalysis.settings
 from sansanalysis.simpleplot.views import confirm_access, _process_plot_scale, _data_template_args, _common_template_args
 from sansanalysis.simpleplot import view_util
+from sansanalysis.simpleplot import plot_payload
 from sansanalysis.app_logging.models import store_error
 from sansanalysis.simpleplot.models import IqData
 from sansanalysis.simpleplot.manipulations import iqdata as iq_data_manipulations
@@ -64,9 +65,9 @@ TODO: need to divide Chi2 by DoF
     #TODO: put this in a decorator
     _process_plot_scale(request)
     
-    # Get plot data
+    # Check that the data can be read. The points are loaded by the page.
     try:
-        iq_data, ticks_x, ticks_y, errors = view_util.get_plottable_iq(request, iq)              
+        plot_data, errors = view_util.get_iq_data_dict(request, iq)              
     except:
         # Send user to error page
         error_msg = 'fit() could not process stored data\n%s' % sys.exc_value
@@ -129,7 +130,14 @@ TODO: need to divide Chi2 by DoF
         
     scale_x = request.session.get(view_util.DATA_SCALE_X_QSTRING, default='linear')
     scale_y = request.session.get(view_util.DATA_SCALE_Y_QSTRING, default='linear')
-    iq_calc, iq_ticks_x, iq_ticks_y = view_util.get_plot_data(iq_dist, scale_x, scale_y)  
+    columns, is_set, iq_ticks_x, iq_ticks_y = view_util.get_plot_arrays(iq_dist, scale_x, scale_y)  
+    columns, is_set, n_full = view_util.decimate_plot_arrays(columns, is_set,
+                                                             sansanalysis.settings.PLOT_MAX_POINTS,
+                                                             sansanalysis.settings.PLOT_DECIMATION)
+    iq_calc = plot_payload.encode_json(columns, plot_payload.PLOT_COLUMNS, npts_full=n_full)
+    iq_data_url = view_util.get_data_url('sansanalysis.simpleplot.views.iq_plot_data', (iq.id,),
+                                         scale_x=scale_x, scale_y=scale_y,
+                                         v=iq_data_manipulations.get_data_version(iq))
         
     # Action list
     actions = []
@@ -157,12 +165,10 @@ TODO: need to divide Chi2 by DoF
                                                       reverse('sansanalysis.simpleplot.views.data_details', args=(iq_id,)), iq.name) 
     
     # Prepare the response
-    template_args = {  'iq_data':str(iq_data),
+    template_args = {  'iq_data_url': iq_data_url,
                        'form': form,
-                       'ticks_x': ticks_x,
-                       'ticks_y': ticks_y,
                        'iq_id': iq_id,
-                       'iq_calc': str(iq_calc),
+                       'iq_calc': iq_calc,
                        'iq_name':iq.name,
                        'actions': actions,
                        'chisqr': chisqr,
@@ -255,6 +261,26 @@ def get_smearing_parameters(request, model_id):
     resp = "<?xml version=\"1.0\" encoding=\"ISO-8859-1\"?>\n<parlist>%s</parlist>\n" % parlist
     return HttpResponse(resp, mimetype="text/xml")
 
+def _get_model_update(request, iq_id):
+    """
+        Evaluate the model given by the GET arguments at the Q points
+        of a data set, and keep its parameters in the session.
+        Returns the form holding the parameters, and the model
+        distribution or None if the parameters are not valid.
+        
+        @param iq_id: pk of IqData object
+    """
+    fit_problem  = sans_model_adapter.FitProblem()
+    form = modeling_forms.populate_fit_problem_from_query_data(request.GET, fit_problem)
+    if not fit_problem.is_valid:
+        return form, None
+    
+    iq_dist = data_manipulations.compute_model(fit_problem, iq_id)
+    
+    # Store the current parameters in the session  
+    request.session['sans_model_params'] = modeling_forms.fit_problem_as_form_data(fit_problem)
+    return form, iq_dist
+
 @login_required
 @confirm_access
 def get_model_update(request, iq_id, model_id):
@@ -269,23 +295,16 @@ def get_model_update(request, iq_id, model_id):
     _process_plot_scale(request)
     
     try:        
-        fit_problem  = sans_model_adapter.FitProblem()
-        form = modeling_forms.populate_fit_problem_from_query_data(request.GET, fit_problem)
+        form, iq_dist = _get_model_update(request, iq_id)
                 
-        if fit_problem.is_valid:
+        if iq_dist is not None:
             # If the parameters are valid, update the model
-            iq_dist = data_manipulations.compute_model(fit_problem, iq_id)
             scale_x = request.session.get(view_util.DATA_SCALE_X_QSTRING, default='linear')
             scale_y = request.session.get(view_util.DATA_SCALE_Y_QSTRING, default='linear')
-            iq_calc, iq_ticks_x, iq_ticks_y = view_util.get_plot_data(iq_dist, scale_x, scale_y)  
-            
-            # Store the current parameters in the session  
-            request.session['sans_model_params'] = modeling_forms.fit_problem_as_form_data(fit_problem)
+            columns, is_set, iq_ticks_x, iq_ticks_y = view_util.get_plot_arrays(iq_dist, scale_x, scale_y)  
             
-            resp = "<?xml version=\"1.0\" encoding=\"ISO-8859-1\"?>\n<distrib>\n"
-            for i in range(len(iq_calc)):
-                resp += "<point><x>%g</x><y>%g</y></point>\n" % (iq_calc[i][0], iq_calc[i][1])
-            resp += "</distrib>"
+            points = ["<point><x>%g</x><y>%g</y></point>\n" % (x, y) for x, y in zip(columns[0], columns[1])]
+            resp = "<?xml version=\"1.0\" encoding=\"ISO-8859-1\"?>\n<distrib>\n%s</distrib>" % ''.join(points)
             return HttpResponse(resp, mimetype="text/xml")
             
         else:
@@ -301,10 +320,39 @@ def get_model_update(request, iq_id, model_id):
         err_id = store_error(user=request.user, url=request.path, text=err_mess, method='modeling.views.get_model_update', build=sansanalysis.settings.APP_VERSION)
         resp = "<?xml version=\"1.0\" encoding=\"ISO-8859-1\"?>\n<error><par>Server Error</par><value>Error %s: The system could not compute your model. We're on it!</value></error>\n" % err_id
         return HttpResponse(resp, mimetype="text/xml")
-   
-   
-    resp = "<?xml version=\"1.0\" encoding=\"ISO-8859-1\"?>\n<distrib></distrib>" 
-    return HttpResponse(resp, mimetype="text/xml")
+
+@login_required
+@confirm_access
+def model_plot_data(request, iq_id, model_id):
+    """
+        Ajax call returning a model evaluated at the Q points of a data set.
+        Takes the same GET arguments as get_model_update, plus 'scale_x'
+        and 'scale_y' to override the scales of the session, and the
+        format, precision and decimation arguments of plot_payload.
+        Messages describe the parameters that are not valid.
+        
+        @param iq_id: pk of IqData object
+        @param model_id: model ID
+    """
+    scale_x = request.GET.get('scale_x', request.session.get(view_util.DATA_SCALE_X_QSTRING, 'linear'))
+    scale_y = request.GET.get('scale_y', request.session.get(view_util.DATA_SCALE_Y_QSTRING, 'linear'))
+    
+    messages = []
+    iq_dist = None
+    try:
+        form, iq_dist = _get_model_update(request, iq_id)
+        if iq_dist is None:
+            messages = ["%s: %s" % (item, ' '.join([unicode(e) for e in form.errors[item]])) for item in form.errors]
+    except:
+        err_mess = "model_plot_data failed: %s" % sys.exc_value
+        err_id = store_error(user=request.user, url=request.path, text=err_mess, method='modeling.views.model_plot_data', build=sansanalysis.settings.APP_VERSION)
+        messages = ["Error %s: The system could not compute your model. We're on it!" % err_id]
+    
+    max_points, method = plot_payload.get_decimation_options(request)
+    columns, is_set, ticks_x, ticks_y = view_util.get_plot_arrays(iq_dist, scale_x, scale_y)
+    columns, is_set, n_full = view_util.decimate_plot_arrays(columns, is_set, max_points, method)
+    return plot_payload.plot_response(request, columns, plot_payload.PLOT_COLUMNS, ticks_x, ticks_y,
+                                      messages=messages, npts_full=n_full)
 
 
 @login_required
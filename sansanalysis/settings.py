@@ -4,6 +4,92 @@ APP_DOMAIN = 'http://127.0.0.1:8000'
 APP_VERSION = __version__
 SAMPLE_LOCATION = 'simpleplot/test/'
 
+# Maximum total size, in bytes, of the parsed data sets kept in memory
+# by each server process
+IQDATA_CACHE_SIZE = 64*1024*1024
+# If True, the validated columns of each data file are stored in a binary
+# file next to it and memory-mapped instead of parsing the file again
+IQDATA_USE_SIDECAR = True
+# Maximum size, in bytes, of an uploaded data file
+IQDATA_MAX_UPLOAD_SIZE = 20*1024*1024
+# Size, in bytes, of the chunks used to write uploaded data files to disk
+IQDATA_UPLOAD_CHUNK_SIZE = 64*1024
+# Timeout, in seconds, of each network operation when downloading a data file
+IQDATA_FETCH_TIMEOUT = 20
+# Maximum time, in seconds, allowed for the download of a data file
+IQDATA_FETCH_MAX_TIME = 120
+# Default number of significant digits of the values sent to the plots
+PLOT_DATA_PRECISION = 8
+# Time, in seconds, browsers may keep plot data without asking again
+PLOT_DATA_MAX_AGE = 3600
+# Maximum total size, in bytes, of the plot-ready curves kept in memory
+# by each server process
+PLOT_DATA_CACHE_SIZE = 16*1024*1024
+# Curves with more points are decimated before being sent to the plots,
+# with 'lttb' (Largest-Triangle-Three-Buckets) or 'minmax'
+PLOT_MAX_POINTS = 2000
+PLOT_DECIMATION = 'lttb'
+# Default and maximum number of points of the P(r) curves computed
+# from the output of an inversion
+PR_OUTPUT_NPTS = 50
+PR_OUTPUT_MAX_NPTS = 1000
+# If True, the covariance matrix of each P(r) inversion is stored
+# so that the uncertainty on P(r) can be shown
+PR_STORE_COVARIANCE = True
+# Maximum total size, in bytes, of the P(r) basis matrices kept in memory
+# by each server process
+PR_BASIS_CACHE_SIZE = 16*1024*1024
+# Maximum total size, in bytes, of the prepared inputs of P(r) inversions
+# kept in memory by each server process
+PR_INPUTS_CACHE_SIZE = 16*1024*1024
+# If True, P(r) inversions are solved from the cached basis matrices
+# rather than by the invertor, which computes them for each inversion
+PR_CACHED_INVERSION = True
+# Number of processes sharing the inversions of a D_max scan,
+# or None for one per CPU
+PR_SCAN_PROCESSES = None
+# Maximum number of D_max values of a scan
+PR_SCAN_MAX_NPTS = 200
+# Maximum total size, in bytes, of the outputs of D_max scans kept
+# in memory by each server process
+PR_SCAN_CACHE_SIZE = 4*1024*1024
+# Maximum number of alpha values of a regularization path
+PR_PATH_MAX_NPTS = 200
+# Maximum total size, in bytes, of the factorizations of regularization
+# paths kept in memory by each server process
+PR_PATH_CACHE_SIZE = 4*1024*1024
+# Maximum number of D_max and of alpha values of a quality map
+PR_MAP_MAX_NPTS = 20
+# Outputs other than chi2 are not computed for the cells of a quality map
+# where chi2 is larger than this factor times its value at the smallest
+# alpha for the same D_max, or everywhere if None
+PR_MAP_MAX_CHI2_RATIO = 10.0
+# Maximum total size, in bytes, of the quality maps kept in memory
+# by each server process
+PR_MAP_CACHE_SIZE = 4*1024*1024
+
+# Functions executing each type of background job
+JOB_HANDLERS = {
+    'fetch_url': 'sansanalysis.simpleplot.manipulations.fetch.fetch_url_job',
+    'explore_dmax': 'sansanalysis.simpleplot.manipulations.prdata.explore_dmax_job',
+    'invert_pr': 'sansanalysis.simpleplot.manipulations.prdata.invert_job',
+    'pr_map': 'sansanalysis.simpleplot.manipulations.prdata.quality_map_job',
+}
+# Maximum number of jobs a user can have waiting or running,
+# or None for no limit
+JOB_MAX_QUEUED_PER_USER = 10
+# Maximum number of jobs of a user executed at the same time,
+# or None for no limit
+JOB_MAX_RUNNING_PER_USER = 2
+# Number of seconds after which a running job that did not report its
+# progress is considered abandoned by its worker: it is put back in the
+# queue, or failed if it ran out of attempts. None to never recover jobs.
+# It must be longer than the longest step between two progress reports of
+# a job, such as a single P(r) inversion or the download of a data file.
+JOB_RUNNING_TIMEOUT = 600
+# Number of times a P(r) inversion job is started before it fails
+PR_JOB_MAX_ATTEMPTS = 2
+
 DEBUG = True
 TEMPLATE_DEBUG = DEBUG
 
@@ -65,6 +151,7 @@ MIDDLEWARE_CLASSES = (
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'sansanalysis.common.middleware.SessionSizeMiddleware',
 )
 
 ROOT_URLCONF = 'sansanalysis.urls'
@@ -89,6 +176,7 @@ INSTALLED_APPS = (
     'django.contrib.webdesign',
     #'sansanalysis.refl_invert',
     'sansanalysis.modeling',
+    'sansanalysis.jobs',
     'django.contrib.staticfiles',
 
 )
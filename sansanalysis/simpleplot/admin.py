@@ -1,11 +1,11 @@
-from sansanalysis.simpleplot.models import IqData, IqDataPoint, RecentData 
+from sansanalysis.simpleplot.models import IqData, IqDataPoint, IqDataArrays, StoredBlob, RecentData 
 from sansanalysis.simpleplot.models import PrInversion, AnonymousSharedData, UserSharedData
 from sansanalysis.simpleplot.models import AnonymousSharedPr, UserSharedPr
 
 from django.contrib import admin
 
 class IqDataAdmin(admin.ModelAdmin):
-    list_display = ('file', 'name', 'owner', 'modified_on', 'created_on')
+    list_display = ('file', 'name', 'owner', 'npts', 'smearing', 'modified_on', 'created_on')
     list_filter = ['modified_on']
     search_fields = ['file']
     date_hierarchy = 'modified_on'
@@ -13,6 +13,12 @@ class IqDataAdmin(admin.ModelAdmin):
 class IqDataPointAdmin(admin.ModelAdmin):
     list_display = ('get_file_name', 'x', 'y', 'dy')
 
+class IqDataArraysAdmin(admin.ModelAdmin):
+    list_display = ('get_file_name', 'entry', 'npts', 'n_entries', 'version')
+
+class StoredBlobAdmin(admin.ModelAdmin):
+    list_display = ('name', 'size', 'refcount', 'created_on')
+
 class RecentDataAdmin(admin.ModelAdmin):
     list_display = ('get_file_name', 'user_id', 'get_user_name', 'visited_on')
     list_filter = ['visited_on', 'user_id']
@@ -38,6 +44,8 @@ class UserSharedPrAdmin(admin.ModelAdmin):
 
 admin.site.register(IqData, IqDataAdmin)
 admin.site.register(IqDataPoint, IqDataPointAdmin)
+admin.site.register(IqDataArrays, IqDataArraysAdmin)
+admin.site.register(StoredBlob, StoredBlobAdmin)
 admin.site.register(RecentData, RecentDataAdmin)
 admin.site.register(PrInversion, PrInversionAdmin)
 admin.site.register(AnonymousSharedData, AnonymousSharedDataAdmin)
@@ -0,0 +1,113 @@
+"""
+    Reduction of the number of points of a curve for display.
+
+    Both methods return the indices of the points to keep, so that
+    the other columns of a curve (error bars) can be reduced the
+    same way. The first and last points are always kept.
+
+        - lttb: Largest-Triangle-Three-Buckets. The points are split in
+          buckets of equal size and, in each bucket, the point forming
+          the largest triangle with the point kept in the previous bucket
+          and the average of the next bucket is kept. Requires x to be sorted.
+        - minmax: the x range is split in bins of equal width and the
+          points with the smallest and largest y of each bin are kept.
+"""
+import numpy
+
+LTTB = 'lttb'
+MINMAX = 'minmax'
+METHODS = [LTTB, MINMAX]
+
+def lttb(x, y, n_out):
+    """
+        Returns the indices of the points kept by the
+        Largest-Triangle-Three-Buckets algorithm
+
+        @param x: numpy array of sorted x values
+        @param y: numpy array of y values
+        @param n_out: number of points to keep
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return numpy.arange(n)
+
+    # Bucket i holds the points edges[i] to edges[i+1]-1. The first
+    # and last points are in buckets of their own.
+    edges = numpy.floor(numpy.linspace(1, n-1, n_out-1)).astype(int)
+
+    indices = numpy.zeros(n_out, dtype=int)
+    indices[-1] = n-1
+    a = 0
+    for i in range(n_out-2):
+        start, end = edges[i], edges[i+1]
+        if i < n_out-3:
+            next_start, next_end = edges[i+1], edges[i+2]
+        else:
+            next_start, next_end = n-1, n
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+
+        # Twice the area of the triangles formed with the last kept point
+        area = numpy.abs((x[a]-avg_x)*(y[start:end]-y[a]) - (x[a]-x[start:end])*(avg_y-y[a]))
+        a = start + int(numpy.argmax(area))
+        indices[i+1] = a
+    return indices
+
+def min_max(x, y, n_out):
+    """
+        Returns the indices of the points with the smallest and
+        largest y values in each of n_out/2 bins of equal width in x
+
+        @param x: numpy array of x values
+        @param y: numpy array of y values
+        @param n_out: approximate number of points to keep
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return numpy.arange(n)
+
+    n_bins = max((n_out-2)/2, 1)
+    x_min = x.min()
+    width = x.max() - x_min
+    if width > 0:
+        bins = numpy.floor((x-x_min)/width*n_bins).astype(int)
+        bins = numpy.minimum(bins, n_bins-1)
+    else:
+        bins = numpy.zeros(n, dtype=int)
+
+    # Sort by bin, then by y: the first and last point of each bin
+    # are its minimum and maximum
+    order = numpy.lexsort((y, bins))
+    sorted_bins = bins[order]
+    change = sorted_bins[1:] != sorted_bins[:-1]
+    first = numpy.concatenate(([True], change))
+    last = numpy.concatenate((change, [True]))
+
+    keep = numpy.concatenate((order[first], order[last], [0, n-1]))
+    return numpy.unique(keep)
+
+def decimate(x, y, max_points, method=LTTB):
+    """
+        Returns the indices of the points of a curve to display,
+        or None if the curve has no more than max_points points.
+        Points with values that are not finite are left out.
+
+        @param x: numpy array of x values
+        @param y: numpy array of y values
+        @param max_points: maximum number of points to keep
+        @param method: 'lttb' or 'minmax'
+    """
+    if max_points is None or len(x) <= max_points:
+        return None
+    if method not in METHODS:
+        raise ValueError, "Unknown decimation method '%s'" % method
+
+    finite = numpy.flatnonzero(numpy.isfinite(x) & numpy.isfinite(y))
+    if len(finite) <= max_points:
+        return finite
+
+    if method == LTTB:
+        kept = lttb(x[finite], y[finite], max_points)
+    else:
+        kept = min_max(x[finite], y[finite], max_points)
+    return finite[kept]
@@ -1,13 +1,418 @@
 from sans.pr.invertor import Invertor
-from sans.pr.distance_explorer import DistExplorer
 import numpy
 import math, sys
+import multiprocessing
+
+import pr_basis
+import sansanalysis.settings
+
+def prepare_inputs(x, y, dy=None, q_min=None, q_max=None):
+    """
+        Returns the arrays passed to the invertor for a data set.
+        The points with Q<=0, those with a Q that is not a number
+        and those outside the Q range are left out.
+        If the data has no errors, statistical errors are assumed.
+        A RuntimeError is raised if some of the points passed to the
+        invertor have an error equal to zero.
+        
+        The invertor copies the arrays it is given, so that the
+        inputs can be shared by several inversions of the same data.
+        
+        @param x: array of Q values, sorted by increasing Q
+        @param y: array of intensities
+        @param dy: array of errors on the intensities, or None
+        @param q_min: minimum Q, or None for no bound
+        @param q_max: maximum Q, or None for no bound
+        @return: dictionary with the 'x', 'y' and 'err' arrays, and
+            the list of messages for the user
+    """
+    messages = []
+    
+    # The points are sorted by Q, with the Q values that are not numbers
+    # at the end: skip the leading points with Q<=0 and the trailing points
+    # with infinite or NaN Q, and only pass the points within the Q range
+    # to the invertor
+    x = numpy.asarray(x, dtype=float)
+    npts = int(numpy.searchsorted(x, 0.0, side='right'))
+    n_finite = int(numpy.searchsorted(x, numpy.inf, side='left'))
+    n_invalid = len(x)-n_finite
+    first = npts
+    last = n_finite
+    if q_min is not None:
+        first = max(first, int(numpy.searchsorted(x, q_min, side='left')))
+    if q_max is not None:
+        last = min(last, int(numpy.searchsorted(x, q_max, side='right')))
+    idx = slice(first, max(first, last))
+    
+    x = x[idx]
+    y = numpy.asarray(y, dtype=float)[idx]
+    
+    if npts==1:
+        messages.append("A q-value was skipped because it was negative or equal to zero.")
+    elif npts>1:
+        messages.append("%d q-values were skipped because they were negative or equal to zero." % npts)
+    if n_invalid==1:
+        messages.append("A q-value was skipped because it was not a number.")
+    elif n_invalid>1:
+        messages.append("%d q-values were skipped because they were not numbers." % n_invalid)
+    
+    # If we have no errors, add statistical errors
+    if dy is None:
+        err = numpy.zeros(len(y))
+        if len(y)>0:
+            # Scale the error so that we can fit over several decades of Q
+            scale = 0.05*math.sqrt(y[0])
+            min_err = 0.01*y[0]
+            err = scale*numpy.sqrt(numpy.fabs(y)) + min_err
+        messages.append("The loaded file had no error bars, statistical errors are assumed.")
+    else:
+        err = numpy.asarray(dy, dtype=float)[idx]
+    
+    # The points are weighted by the inverse of their error
+    n_zero = int(numpy.sum(err==0))
+    if n_zero==1:
+        raise RuntimeError, "A point in the Q range has an error equal to zero: set its error or change the Q range."
+    elif n_zero>1:
+        raise RuntimeError, "%d points in the Q range have an error equal to zero: set their errors or change the Q range." % n_zero
+    
+    return {'x': numpy.ascontiguousarray(x),
+            'y': numpy.ascontiguousarray(y),
+            'err': numpy.ascontiguousarray(err),
+            'messages': messages}
+
+def get_dmax_values(d_max, min=None, max=None, npts=25):
+    """
+        Returns the D_max values of a scan. By default, the scan
+        goes from 75% to 125% of the given D_max.
+        
+        @param d_max: D_max of the inversion
+        @param min: minimum value for D_max, or None
+        @param max: maximum value for D_max, or None
+        @param npts: number of points for D_max
+    """
+    if min is None:
+        min = 0.75*d_max
+    if max is None:
+        max = 1.25*d_max
+    if npts<2:
+        return [min]
+    return [min+i*(max-min)/(npts-1.0) for i in range(npts)]
+
+def _check_float(value):
+    """
+        Returns None for values that are not numbers
+    """
+    if value is None or numpy.isnan(value): return None
+    return float(value)
+
+## Inputs and parameters of the scan executed by the current process
+_scan_state = {}
+
+def _init_scan(inputs, parameters, alphas=None, max_chi2_ratio=None):
+    """
+        Set the data and the parameters of a D_max scan.
+        Executed once in each process of the pool.
+    """
+    _scan_state['inputs'] = inputs
+    _scan_state['parameters'] = parameters
+    _scan_state['alphas'] = alphas
+    _scan_state['max_chi2_ratio'] = max_chi2_ratio
+
+def _invert_dmax(d_max):
+    """
+        Perform the inversion of a scan for a given D_max
+        @param d_max: D_max value
+        @return: dictionary of outputs, with an 'error' entry if the inversion failed
+    """
+    calculation = PrCalculation(_scan_state['parameters'])
+    calculation.invertor.d_max = d_max
+    inputs = calculation._setup_inversion(None, _scan_state['inputs'])
+    try:
+        out, cov = calculation.invert(inputs)
+        outputs = calculation.get_outputs(out, cov)
+    except:
+        return {'d_max': d_max,
+                'error': "Inversion failed for D_max=%g: %s" % (d_max, sys.exc_value)}
+    outputs['d_max'] = d_max
+    return outputs
+
+def scan_dmax(inputs, parameters, d_values, processes=1):
+    """
+        Generator returning the outputs of the inversions for a list of
+        D_max values, in the order they are completed. The inversions
+        are independent and are shared among a pool of processes.
+        
+        @param inputs: inputs prepared by prepare_inputs
+        @param parameters: inversion parameters, as given to PrCalculation
+        @param d_values: list of D_max values
+        @param processes: number of processes, or None for one per CPU
+    """
+    return _run_scan(_invert_dmax, d_values, processes, (inputs, parameters))
+
+def _map_dmax(d_max):
+    """
+        Compute the row of a quality map for a given D_max.
+        
+        All the alpha values are solved from a single factorization.
+        Since chi2 increases with alpha, the outputs other than chi2
+        are not computed once chi2 is larger than max_chi2_ratio times
+        its value at the smallest alpha.
+        
+        @param d_max: D_max value
+        @return: dictionary with the lists of chi2, oscillation,
+            positive fraction and Rg values for each alpha, None where
+            they were not computed, or an 'error' entry if the
+            inversion failed
+    """
+    calculation = PrCalculation(_scan_state['parameters'])
+    calculation.invertor.d_max = d_max
+    inputs = calculation._setup_inversion(None, _scan_state['inputs'])
+    alphas = numpy.asarray(_scan_state['alphas'], dtype=float)
+    try:
+        solution = calculation._get_path(inputs).solve(alphas)
+        
+        # Same definition of chi2 as the invertor
+        chi2 = solution['residual'] + alphas*solution['reg_norm']
+        limit = numpy.inf
+        if _scan_state['max_chi2_ratio'] is not None:
+            limit = _scan_state['max_chi2_ratio']*chi2[0]
+        
+        row = {'d_max': d_max, 'chi2': [_check_float(v) for v in chi2],
+               'osc': [], 'pos_frac': [], 'rg': [], 'skipped': 0}
+        for i in range(len(alphas)):
+            if chi2[i]>limit:
+                row['skipped'] = len(alphas)-i
+                break
+            # The compiled methods of the invertor need contiguous arrays
+            out = numpy.ascontiguousarray(solution['coeff'][i])
+            row['osc'].append(_check_float(calculation.invertor.oscillations(out)))
+            row['pos_frac'].append(_check_float(calculation.invertor.get_positive(out)))
+            row['rg'].append(_check_float(calculation.invertor.rg(out)))
+    except:
+        return {'d_max': d_max,
+                'error': "Inversion failed for D_max=%g: %s" % (d_max, sys.exc_value)}
+    
+    for name in ['osc', 'pos_frac', 'rg']:
+        row[name].extend([None]*(len(alphas)-len(row[name])))
+    return row
+
+def map_dmax_alpha(inputs, parameters, d_values, alphas, processes=1, max_chi2_ratio=None):
+    """
+        Generator returning the rows of a quality map of the inversion
+        over a grid of D_max and alpha values, one row per D_max, in the
+        order they are completed. The rows are shared among a pool of
+        processes. See _map_dmax for the content of each row.
+        
+        @param inputs: inputs prepared by prepare_inputs
+        @param parameters: inversion parameters, as given to PrCalculation
+        @param d_values: list of D_max values
+        @param alphas: list of alpha values, in increasing order
+        @param processes: number of processes, or None for one per CPU
+        @param max_chi2_ratio: largest ratio of chi2 to its value at the
+            smallest alpha for which the other outputs are computed,
+            or None to compute them everywhere
+    """
+    return _run_scan(_map_dmax, d_values, processes, (inputs, parameters, list(alphas), max_chi2_ratio))
+
+def _run_scan(function, d_values, processes, state):
+    """
+        Generator returning the results of a function for a list of
+        D_max values, in the order they are completed
+        
+        @param function: function of D_max, using _scan_state
+        @param d_values: list of D_max values
+        @param processes: number of processes, or None for one per CPU
+        @param state: arguments of _init_scan
+    """
+    if processes==1 or len(d_values)<2:
+        _init_scan(*state)
+        for d_max in d_values:
+            yield function(d_max)
+        return
+    
+    pool = multiprocessing.Pool(processes, _init_scan, state)
+    try:
+        for outputs in pool.imap_unordered(function, d_values):
+            yield outputs
+    finally:
+        # Also stops the remaining inversions if the caller
+        # stopped reading the results
+        pool.terminate()
+        pool.join()
+
+def get_alpha_values(alpha_min, alpha_max, npts):
+    """
+        Returns alpha values evenly spaced on a log scale
+        @param alpha_min: smallest alpha, greater than zero
+        @param alpha_max: largest alpha
+        @param npts: number of values
+    """
+    if alpha_min<=0 or alpha_max<alpha_min:
+        raise ValueError, "Invalid alpha range: %g to %g" % (alpha_min, alpha_max)
+    return numpy.logspace(math.log10(alpha_min), math.log10(alpha_max), max(npts, 1))
+
+def lcurve_corner(residual, reg_norm):
+    """
+        Returns the index of the corner of the L-curve, the point of
+        largest curvature of log(reg_norm) as a function of log(residual),
+        or None if it can't be found
+        
+        @param residual: array of residual norms, by increasing alpha
+        @param reg_norm: array of regularization norms, by increasing alpha
+    """
+    if len(residual)<3:
+        return None
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        rho = numpy.log(residual)
+        eta = numpy.log(reg_norm)
+        # The curvature does not depend on the parametrization,
+        # so the alpha values need not be evenly spaced
+        d_rho = numpy.gradient(rho)
+        d_eta = numpy.gradient(eta)
+        kappa = (d_rho*numpy.gradient(d_eta) - numpy.gradient(d_rho)*d_eta)/(d_rho**2+d_eta**2)**1.5
+    kappa[~numpy.isfinite(kappa)] = -numpy.inf
+    # The end points have one-sided derivatives
+    kappa[0] = kappa[-1] = -numpy.inf
+    if not numpy.isfinite(kappa.max()):
+        return None
+    return int(numpy.argmax(kappa))
+
+class RegularizationPath:
+    """
+        Solutions of the P(r) inversion for many values of alpha.
+        
+        The inversion minimizes |A c - b|^2 + alpha |L c|^2, where the
+        rows of A are the I(q) basis functions divided by the errors, b
+        holds the intensities divided by the errors, and the rows of L
+        are the regularization term of the invertor at nr points
+        between 0 and D_max, scaled by D_max/nr. The background, if
+        fitted, is an additional term of A that is not regularized.
+        
+        With A^T A = G G^T (Cholesky) and G^-1 L^T L G^-T = U diag(lambda) U^T,
+        the solution for any alpha is
+        
+            c(alpha) = G^-T U z/(1+alpha lambda), with z = U^T G^-1 A^T b
+        
+        so that, once the factorization is done, each value of alpha costs
+        a product with an n_terms x n_terms matrix.
+    """
+    def __init__(self, inputs, d_max, n_terms, has_bck=False, slit_height=0, slit_width=0, nr=20):
+        """
+            @param inputs: inputs prepared by prepare_inputs
+            @param d_max: maximum distance
+            @param n_terms: number of terms
+            @param has_bck: if True, a constant background is fitted
+            @param slit_height: slit height, 0 for none
+            @param slit_width: slit width, 0 for none
+            @param nr: number of points of the regularization term
+        """
+        x = inputs['x']
+        if len(x)<=n_terms:
+            raise RuntimeError, "RegularizationPath: %d points are not enough for %d terms" % (len(x), n_terms)
+        weights = 1.0/inputs['err']
+        
+        design = pr_basis.get_basis('iq', x, d_max, n_terms, slit_height=slit_height, slit_width=slit_width)
+        design = design*weights[:,numpy.newaxis]
+        r = d_max/float(nr)*numpy.arange(nr)
+        reg = d_max/float(nr)*pr_basis.get_basis('pr_reg', r, d_max, n_terms)
+        if has_bck:
+            design = numpy.hstack([weights[:,numpy.newaxis], design])
+            reg = numpy.hstack([numpy.zeros([nr, 1]), reg])
+        b = inputs['y']*weights
+        
+        normal = numpy.dot(design.T, design)
+        try:
+            g = numpy.linalg.cholesky(normal)
+        except numpy.linalg.LinAlgError:
+            # The basis functions are not independent over the Q range:
+            # a small ridge makes the normal matrix positive definite
+            ridge = 1e-12*numpy.trace(normal)/len(normal)
+            g = numpy.linalg.cholesky(normal+ridge*numpy.eye(len(normal)))
+        g_inv = numpy.linalg.inv(g)
+        k = numpy.dot(numpy.dot(g_inv, numpy.dot(reg.T, reg)), g_inv.T)
+        eigenvalues, u = numpy.linalg.eigh(0.5*(k+k.T))
+        
+        ## Number of data points
+        self.npts = len(x)
+        ## Number of fitted parameters, including the background
+        self.n_params = design.shape[1]
+        ## True if the first parameter is the background
+        self.has_bck = has_bck
+        ## Eigenvalues of the regularization term in the transformed basis
+        self.eigenvalues = numpy.maximum(eigenvalues, 0.0)
+        ## Transformation from the transformed basis to the coefficients
+        self.transform = numpy.dot(g_inv.T, u)
+        ## Projection of the data on the transformed basis
+        self.projection = numpy.dot(u.T, numpy.dot(g_inv, numpy.dot(design.T, b)))
+        ## Squared norm of the weighted data
+        self.data_norm = numpy.dot(b, b)
+        
+    def get_covariance(self, alpha):
+        """
+            Returns the inverse of the normal matrix of the
+            regularized problem for a given alpha, including the
+            background if it is fitted
+            @param alpha: regularization constant
+        """
+        filters = 1.0/(1.0+alpha*self.eigenvalues)
+        return numpy.dot(self.transform*filters, self.transform.T)
+        
+    def get_size(self):
+        """
+            Returns the approximate size of the factorization, in bytes
+        """
+        return self.transform.nbytes + self.projection.nbytes + self.eigenvalues.nbytes
+        
+    def solve(self, alphas):
+        """
+            Returns the solutions for a list of alpha values
+            
+            @param alphas: array of alpha values
+            @return: dictionary with the arrays of alpha values ('alpha'), of
+                coefficients with one row per alpha ('coeff'), of background
+                values ('bck'), of chi2 per degree of freedom ('chi2'), of
+                squared residual norms ('residual'), of squared regularization
+                norms ('reg_norm') and of generalized cross-validation
+                scores ('gcv')
+        """
+        alphas = numpy.atleast_1d(numpy.asarray(alphas, dtype=float))
+        filters = 1.0/(1.0+numpy.outer(self.eigenvalues, alphas))
+        
+        # Solutions in the transformed basis, one column per alpha
+        y = self.projection[:,numpy.newaxis]*filters
+        coeff = numpy.dot(self.transform, y).T
+        residual = self.data_norm - 2.0*numpy.dot(self.projection, y) + numpy.sum(y*y, axis=0)
+        residual = numpy.maximum(residual, 0.0)
+        reg_norm = numpy.sum(self.eigenvalues[:,numpy.newaxis]*y*y, axis=0)
+        
+        # The trace of the influence matrix is the effective number of parameters
+        n_eff = numpy.sum(filters, axis=0)
+        with numpy.errstate(divide='ignore'):
+            gcv = residual/(self.npts-n_eff)**2
+        
+        if self.has_bck:
+            bck = coeff[:,0]
+            coeff = coeff[:,1:]
+        else:
+            bck = numpy.zeros(len(alphas))
+        return {'alpha': alphas,
+                'coeff': coeff,
+                'bck': bck,
+                'chi2': residual/max(self.npts-self.n_params, 1),
+                'residual': residual,
+                'reg_norm': reg_norm,
+                'gcv': gcv}
 
 class PrCalculation:
     
     def __init__(self, parameters=None):
         self.errors = []
         self.messages = []
+        ## Parameters of the inversion
+        self.parameters = parameters
+        ## Q range of the inversion, None for no bound
+        self.q_min = None
+        self.q_max = None
         
         self.invertor = Invertor()
         if parameters is not None:
@@ -15,8 +420,10 @@ class PrCalculation:
             self.invertor.nfunc = parameters['n_terms']
             if parameters['q_min'] is not None:
                 self.invertor.q_min = parameters['q_min']
+                self.q_min = parameters['q_min']
             if parameters['q_max'] is not None:
                 self.invertor.q_max = parameters['q_max']
+                self.q_max = parameters['q_max']
             self.invertor.alpha = parameters['alpha']
             if parameters['slit_height'] is not None:
                 self.invertor.slit_height = parameters['slit_height']
@@ -25,71 +432,44 @@ class PrCalculation:
             if parameters['has_bck'] is not None:
                 self.invertor.has_bck = parameters['has_bck']
             
-    def _setup_inversion(self, data_info):
+    def _setup_inversion(self, data_info, inputs=None):
         """
             Set up the inversion object
+            @param data_info: Data1D object, with points sorted by increasing Q
+            @param inputs: inputs prepared by prepare_inputs for the Q range
+                of the inversion, or None to prepare them from data_info
         """
         self.errors   = []
         self.messages = []
 
-        # Sanity check
-        if data_info is None:
-            raise RuntimeError, "invert_pr.invert: expected a dictionary of data and got None"
-    
-        idx = [ i for i in range(len(data_info.x)) if data_info.x[i]>0 ]
-    
-        self.invertor.x   = data_info.x[idx]
-        self.invertor.y   = data_info.y[idx]
-        
-        if len(data_info.x) != len(self.invertor.x):
-            npts = len(data_info.x)-len(self.invertor.x)
-            if npts==1:
-                self.messages.append("A q-value was skipped because it was negative or equal to zero.")
-            elif npts>1:
-                self.messages.append("%d q-values were skipped because they were negative or equal to zero." % npts)
-        
-        # If we have no errors, add statistical errors
-        if data_info.dy==None and self.invertor.y is not None:
-            err = numpy.zeros(len(self.invertor.y))
-            scale = None
-            min_err = 0.0
-            for i in range(len(self.invertor.y)):
-                # Scale the error so that we can fit over several decades of Q
-                if scale==None:
-                    scale = 0.05*math.sqrt(self.invertor.y[i])
-                    min_err = 0.01*self.invertor.y[i]
-                err[i] = scale*math.sqrt( math.fabs(self.invertor.y[i]) ) + min_err
-            message = "The loaded file had no error bars, statistical errors are assumed."
-            self.invertor.err = err
-        else:
-            self.invertor.err = data_info.dy[idx]
+        if inputs is None:
+            # Sanity check
+            if data_info is None:
+                raise RuntimeError, "invert_pr.invert: expected a dictionary of data and got None"
+            inputs = prepare_inputs(data_info.x, data_info.y, data_info.dy, self.q_min, self.q_max)
+    
+        self.invertor.x   = inputs['x']
+        self.invertor.y   = inputs['y']
+        self.invertor.err = inputs['err']
+        self.messages.extend(inputs['messages'])
+        return inputs
         
     
-    def __call__(self, data_info):
+    def __call__(self, data_info, inputs=None):
         """
             Perform inversion
+            @param data_info: Data1D object
+            @param inputs: inputs prepared by prepare_inputs, or None
         """
         # Set up the inversion object
-        self._setup_inversion(data_info)
+        inputs = self._setup_inversion(data_info, inputs)
         
         # Perform inversion
-        out, cov = self.invertor.invert(self.invertor.nfunc)
+        out, cov = self.invert(inputs)
         
         # Store outputs 
-        out_pars = {}
-        
-        def _check_float(value):
-            if numpy.isnan(value): return None
-            return value
-        
         try:
-            out_pars['chi2']     = _check_float(self.invertor.chi2)
-            out_pars['rg']       = _check_float(self.invertor.rg(out))
-            out_pars['bck']      = _check_float(self.invertor.background)
-            out_pars['iq_zero']  = _check_float(self.invertor.iq0(out))
-            out_pars['osc']      = _check_float(self.invertor.oscillations(out))
-            out_pars['pos_frac'] = _check_float(self.invertor.get_positive(out))
-            out_pars['pos_frac_1sigma']  = _check_float(self.invertor.get_pos_err(out, cov))
+            out_pars = self.get_outputs(out, cov)
             out_pars['coeff']    = out
             out_pars['cov']      = cov
         except:
@@ -98,7 +478,7 @@ class PrCalculation:
         
         # Compute I(q)
         iq_calc = self.get_iq_calc(data_info.x, out, cov)
-        r, pr   = self.get_pr(out, cov)
+        r, pr, pr_err = self.get_pr(out, cov)
             
         # Put distributions together
         iqfit = {'x':data_info.x,
@@ -107,30 +487,44 @@ class PrCalculation:
         
         prfit = {'x':r,
                  'y':pr,
-                 'dy':None}
+                 'dy':pr_err}
     
         return iqfit, prfit, out_pars
         
     
+    def get_outputs(self, out, cov):
+        """
+            Returns the output parameters of an inversion,
+            with None for values that could not be computed
+            
+            @param out: coefficients
+            @param cov: covariance matrix of the coefficients
+        """
+        return {'chi2':     _check_float(self.invertor.chi2),
+                'rg':       _check_float(self.invertor.rg(out)),
+                'bck':      _check_float(self.invertor.background),
+                'iq_zero':  _check_float(self.invertor.iq0(out)),
+                'osc':      _check_float(self.invertor.oscillations(out)),
+                'pos_frac': _check_float(self.invertor.get_positive(out)),
+                'pos_frac_1sigma': _check_float(self.invertor.get_pos_err(out, cov))}
+    
     def get_iq_calc(self, q, out, cov):
         """
             Compute calculated I(q) given the output of 
-            a P(r) inversion
+            a P(r) inversion. The background of the invertor
+            is added to the result.
+            
+            @param q: array of Q values
+            @param out: coefficients
+            @param cov: covariance matrix of the coefficients
         """
-        # By default, we assume no smearing
-        evaluation_function = self.invertor.iq        
-        # If we have used slit smearing, plot the smeared I(q) too
-        if self.invertor.slit_width>0 or self.invertor.slit_height>0:
-            evaluation_function = self.invertor.iq_smeared
-
-        n_skip = 0
-        iq_calc = numpy.zeros(len(q))
-        for i in range(len(q)):
-            if q[i]>0:
-                iq_calc[i] = evaluation_function(out, q[i])
-            else:
-                n_skip += 1
-                iq_calc[i] = 0
+        q = numpy.asarray(q, dtype=float)
+        n_skip = int(numpy.sum(q<=0))
+        
+        # If we have used slit smearing, the basis is smeared
+        basis = self.get_iq_basis(q, len(out))
+        iq_calc = pr_basis.evaluate(basis, out)[0]
+        iq_calc = numpy.where(q>0, iq_calc+self.invertor.background, 0.0)
     
         if n_skip==1:
             self.messages.append("A q-value was skipped because it was negative or equal to zero.")
@@ -139,42 +533,151 @@ class PrCalculation:
             
         return iq_calc
     
+    def get_iq_basis(self, q, n_terms):
+        """
+            Returns the I(q) basis matrix for the D_max and
+            slit geometry of the invertor
+            
+            @param q: array of Q values
+            @param n_terms: number of terms
+        """
+        return pr_basis.get_basis('iq', q, self.invertor.d_max, n_terms,
+                                  slit_height=max(self.invertor.slit_height, 0),
+                                  slit_width=max(self.invertor.slit_width, 0))
+    
     def get_pr(self, out, cov, npts=50):
         """
             Compute P(r) given the output of 
             a P(r) inversion
-        """
-        pr = numpy.zeros(npts)
-        r  = numpy.zeros(npts)
-        for i in range(npts):
-            r[i] = self.invertor.d_max/(npts-1.0)*i
-            pr[i] = self.invertor.pr(out, r[i])
             
-        return r, pr
+            @param out: coefficients
+            @param cov: covariance matrix of the coefficients, or None
+            @param npts: number of points between r=0 and r=D_max
+            @return: r, P(r) and the uncertainty on P(r), or None
+                if the covariance matrix is not known
+        """
+        r = numpy.linspace(0, self.invertor.d_max, npts)
+        # A covariance matrix of zeros means that it was not stored
+        if cov is not None and not numpy.any(cov):
+            cov = None
+        basis = pr_basis.get_basis('pr', r, self.invertor.d_max, len(out))
+        pr, pr_err = pr_basis.evaluate(basis, out, cov)
+        return r, pr, pr_err
     
-    def estimate(self, data_info):
+    def estimate(self, data_info, inputs=None):
         """    
             Estimate the number of terms and alpha given
             the input data
             @param data_info: Data1D object
+            @param inputs: inputs prepared by prepare_inputs, or None
         """
         # Set up the inversion object
-        self._setup_inversion(data_info)
+        self._setup_inversion(data_info, inputs)
         
         return self.invertor.estimate_numterms()
     
-    def explore_dmax(self, data_info, min, max, npts=25):
+    def get_regularization_path(self, data_info, inputs=None):
+        """
+            Returns the RegularizationPath object for the data
+            and the parameters of the inversion
+            
+            @param data_info: Data1D object
+            @param inputs: inputs prepared by prepare_inputs, or None
+        """
+        inputs = self._setup_inversion(data_info, inputs)
+        return self._get_path(inputs)
+    
+    def _get_path(self, inputs):
+        """
+            Returns the RegularizationPath object for prepared inputs
+            @param inputs: inputs prepared by prepare_inputs
+        """
+        return RegularizationPath(inputs, self.invertor.d_max, self.invertor.nfunc,
+                                  has_bck=bool(self.invertor.has_bck),
+                                  slit_height=max(self.invertor.slit_height, 0),
+                                  slit_width=max(self.invertor.slit_width, 0))
+    
+    def invert(self, inputs):
+        """
+            Perform the inversion for the current value of alpha.
+            
+            With PR_CACHED_INVERSION, the least-squares problem is solved
+            from the cached basis matrices, which are shared with the
+            display of the outputs and with the other inversions of the
+            same data, instead of being computed again by the invertor.
+            The chi2, background and covariance matrix are normalized as
+            done by the invertor, and stored in it for get_outputs.
+            
+            @param inputs: inputs set up by _setup_inversion
+            @return: coefficients and covariance matrix
+        """
+        if not sansanalysis.settings.PR_CACHED_INVERSION:
+            return self.invertor.invert(self.invertor.nfunc)
+        
+        path = self._get_path(inputs)
+        alpha = self.invertor.alpha
+        solution = path.solve([alpha])
+        
+        # The invertor's chi2 is the residual of the regularized system
+        chi2 = solution['residual'][0] + alpha*solution['reg_norm'][0]
+        cov = math.fabs(chi2/float(path.npts-path.n_params))*path.get_covariance(alpha)
+        out = solution['coeff'][0]
+        if path.has_bck:
+            # The invertor drops the background term and pads the
+            # coefficients and covariance matrix with a zero term
+            out = numpy.append(out, 0.0)
+            padded = numpy.zeros([path.n_params, path.n_params])
+            padded[:-1,:-1] = cov[1:,1:]
+            cov = padded
+        # The compiled methods of the invertor need contiguous arrays
+        out = numpy.ascontiguousarray(out)
+        cov = numpy.ascontiguousarray(cov)
+        
+        self.invertor.chi2 = chi2
+        self.invertor.background = solution['bck'][0]
+        self.invertor.out = out
+        self.invertor.cov = cov
+        return out, cov
+    
+    def solve_regularization_path(self, path, alphas):
+        """
+            Returns the solutions of a regularization path for a list of
+            alpha values, and the alpha values chosen automatically
+            
+            @param path: RegularizationPath object
+            @param alphas: array of alpha values, in increasing order
+            @return: dictionary of solutions, see RegularizationPath.solve,
+                with the alpha of smallest generalized cross-validation score
+                ('alpha_gcv') and the alpha of the corner of the L-curve
+                ('alpha_lcurve'), or None if it could not be found
+        """
+        solutions = path.solve(alphas)
+        alphas = solutions['alpha']
+        gcv = numpy.where(numpy.isfinite(solutions['gcv']), solutions['gcv'], numpy.inf)
+        solutions['alpha_gcv'] = float(alphas[numpy.argmin(gcv)])
+        corner = lcurve_corner(solutions['residual'], solutions['reg_norm'])
+        solutions['alpha_lcurve'] = float(alphas[corner]) if corner is not None else None
+        return solutions
+    
+    def explore_dmax(self, data_info, min, max, npts=25, inputs=None, processes=1):
         """
             Explore output parameters for a range of D_max.
             
-            @param min: minimum value for D_max
-            @param max: maximum value for D_max
+            @param data_info: Data1D object
+            @param min: minimum value for D_max, or None
+            @param max: maximum value for D_max, or None
             @param npts: number of points for D_max
+            @param inputs: inputs prepared by prepare_inputs, or None
+            @param processes: number of processes, or None for one per CPU
+            @return: list of outputs for each D_max, by increasing D_max.
+                Failed inversions have an 'error' entry.
         """
         
         # Set up the inversion object
-        self._setup_inversion(data_info) 
+        inputs = self._setup_inversion(data_info, inputs)
         
-        explo = DistExplorer(self.invertor)
-        return explo(min, max, npts)
+        d_values = get_dmax_values(self.invertor.d_max, min, max, npts)
+        results = list(scan_dmax(inputs, self.parameters, d_values, processes))
+        results.sort(key=lambda item: item['d_max'])
+        return results
     
\ No newline at end of file
@@ -0,0 +1,198 @@
+"""
+    Basis functions of the P(r) inversion, evaluated on whole grids.
+
+    P(r) is expanded on the functions 2 r sin(pi n r / D_max), n=1..N,
+    and I(q) on their Fourier transforms. A curve is computed from the
+    coefficients of an inversion as the product of a basis matrix,
+    with one row per point and one column per term, with the
+    coefficient vector. The uncertainty on each point of the curve is
+    given by the diagonal of B C B^T, where C is the covariance matrix
+    of the coefficients.
+
+    When slit smearing is used, each row of the I(q) basis is the average
+    of the basis evaluated at sqrt((q-y)^2+z^2) over a grid of points
+    (y, z) covering the slit, as done by the invertor. The quadrature is
+    done once per Q grid and slit geometry, after which a smeared curve
+    is a single matrix-vector product.
+
+    Basis matrices are kept in a process-level cache, keyed by grid
+    digest, D_max, number of terms and slit geometry. The cache is shared
+    by the inversions, the D_max scans, the regularization paths and the
+    curves shown for stored inversions, so that requests on the same data
+    set compute each matrix once. Its statistics are given by get_cache_stats.
+"""
+import math
+import hashlib
+import numpy
+
+from sansanalysis.common.cache import LRUCache
+import sansanalysis.settings
+
+## Basis matrices {(kind, grid size, grid digest, d_max, n_terms, slit_height, slit_width): matrix}
+_basis_cache = LRUCache(sansanalysis.settings.PR_BASIS_CACHE_SIZE)
+
+## Number of points along each dimension of the slit, as used by the invertor
+SMEARING_NPTS = 21
+## Maximum number of basis values computed at once for the smeared basis
+_SMEARING_BLOCK_SIZE = 1000000
+
+def pr_basis(r, d_max, n_terms):
+    """
+        Returns the P(r) basis matrix, of shape (len(r), n_terms)
+        @param r: numpy array of distances
+        @param d_max: maximum distance
+        @param n_terms: number of terms
+    """
+    r = numpy.asarray(r, dtype=float)
+    n = numpy.arange(1, n_terms+1, dtype=float)
+    return 2.0*r[:,numpy.newaxis]*numpy.sin(math.pi/d_max*numpy.outer(r, n))
+
+def pr_reg_basis(r, d_max, n_terms):
+    """
+        Returns the matrix of the regularization term of the invertor,
+        of shape (len(r), n_terms). For k = pi n / D_max, each column is
+        2 k (2 cos(k r) + k r sin(k r)). The invertor multiplies it by
+        D_max/nr, where nr is the number of points.
+        
+        @param r: numpy array of distances
+        @param d_max: maximum distance
+        @param n_terms: number of terms
+    """
+    r = numpy.asarray(r, dtype=float)
+    k = math.pi/d_max*numpy.arange(1, n_terms+1, dtype=float)
+    arg = numpy.outer(r, k)
+    return 2.0*k*(2.0*numpy.cos(arg) + arg*numpy.sin(arg))
+
+def iq_basis(q, d_max, n_terms):
+    """
+        Returns the I(q) basis matrix, of shape (len(q), n_terms).
+        Rows for q<=0 are set to zero.
+
+        @param q: numpy array of Q values
+        @param d_max: maximum distance
+        @param n_terms: number of terms
+    """
+    q = numpy.asarray(q, dtype=float)
+    n = numpy.arange(1, n_terms+1, dtype=float)
+    positive = q>0
+    q_pos = numpy.where(positive, q, 1.0)[:,numpy.newaxis]
+
+    qd = q_pos*d_max
+    pi_n = math.pi*n
+    denom = pi_n**2 - qd**2
+    sign = numpy.where(n%2==1, 1.0, -1.0)
+
+    # At q*d_max = pi*n, sin(qd)/denom tends to (-1)^(n+1)/(2 pi n)
+    # and the term tends to 4 pi d_max/q
+    singular = numpy.abs(denom) < 1e-12*pi_n**2
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        basis = 8.0*math.pi**2/q_pos*d_max*n*sign*numpy.sin(qd)/denom
+    basis = numpy.where(singular, 4.0*math.pi*d_max/q_pos, basis)
+    basis[~positive] = 0.0
+    return basis
+
+def smeared_iq_basis(q, d_max, n_terms, slit_height, slit_width, npts=SMEARING_NPTS):
+    """
+        Returns the slit-smeared I(q) basis matrix, of shape (len(q), n_terms)
+        
+        @param q: numpy array of Q values
+        @param d_max: maximum distance
+        @param n_terms: number of terms
+        @param slit_height: slit height, 0 for none
+        @param slit_width: slit width, 0 for none
+        @param npts: number of points along each dimension of the slit
+    """
+    q = numpy.asarray(q, dtype=float)
+    if slit_height>0:
+        z = numpy.linspace(0, slit_height, npts)
+    else:
+        z = numpy.zeros(1)
+    if slit_width>0:
+        y = numpy.linspace(-slit_width/2.0, slit_width/2.0, npts)
+    else:
+        y = numpy.zeros(1)
+    y, z = [v.ravel() for v in numpy.meshgrid(y, z)]
+
+    # Points of the slit where the effective Q is zero are left out
+    basis = numpy.zeros([len(q), n_terms])
+    block = max(_SMEARING_BLOCK_SIZE/(len(y)*n_terms), 1)
+    for start in range(0, len(q), block):
+        q_block = q[start:start+block]
+        q_eff = numpy.sqrt((q_block[:,numpy.newaxis]-y)**2 + z**2)
+        weights = (q_eff>0).astype(float)
+        count = weights.sum(axis=1)
+        weights /= numpy.where(count>0, count, 1.0)[:,numpy.newaxis]
+        values = iq_basis(q_eff.ravel(), d_max, n_terms).reshape(len(q_block), len(y), n_terms)
+        basis[start:start+block] = numpy.sum(values*weights[:,:,numpy.newaxis], axis=1)
+    return basis
+
+def _grid_key(kind, grid, d_max, n_terms, slit_height=0, slit_width=0):
+    """
+        Returns the cache key of a basis matrix
+        @param kind: type of basis
+        @param grid: numpy array of points
+        @param d_max: maximum distance
+        @param n_terms: number of terms
+        @param slit_height: slit height, 0 for none
+        @param slit_width: slit width, 0 for none
+    """
+    grid = numpy.ascontiguousarray(grid, dtype=float)
+    return (kind, len(grid), hashlib.sha1(grid.tostring()).hexdigest(), float(d_max), int(n_terms),
+            float(slit_height or 0), float(slit_width or 0))
+
+def get_basis(kind, grid, d_max, n_terms, slit_height=0, slit_width=0):
+    """
+        Returns a basis matrix, from the cache if possible.
+        The I(q) basis is smeared if a slit height or width is given.
+        
+        @param kind: 'pr', 'pr_reg' or 'iq'
+        @param grid: numpy array of distances or Q values
+        @param d_max: maximum distance
+        @param n_terms: number of terms
+        @param slit_height: slit height, 0 for none
+        @param slit_width: slit width, 0 for none
+    """
+    slit_height = slit_height or 0
+    slit_width = slit_width or 0
+    if kind != 'iq':
+        slit_height = slit_width = 0
+    key = _grid_key(kind, grid, d_max, n_terms, slit_height, slit_width)
+    basis = _basis_cache.get(key)
+    if basis is None:
+        if kind == 'pr':
+            basis = pr_basis(grid, d_max, n_terms)
+        elif kind == 'pr_reg':
+            basis = pr_reg_basis(grid, d_max, n_terms)
+        elif kind == 'iq' and (slit_height>0 or slit_width>0):
+            basis = smeared_iq_basis(grid, d_max, n_terms, slit_height, slit_width)
+        elif kind == 'iq':
+            basis = iq_basis(grid, d_max, n_terms)
+        else:
+            raise ValueError, "Unknown basis type '%s'" % kind
+        # The cached matrix is shared: make sure it is never modified
+        basis.setflags(write=False)
+        _basis_cache.put(key, basis, basis.nbytes)
+    return basis
+
+def evaluate(basis, out, cov=None):
+    """
+        Returns the values of a curve and their uncertainties,
+        or None for the uncertainties if no covariance matrix is given
+
+        @param basis: basis matrix
+        @param out: coefficient vector
+        @param cov: covariance matrix of the coefficients, or None
+    """
+    out = numpy.asarray(out, dtype=float)
+    values = numpy.dot(basis, out)
+    if cov is None:
+        return values, None
+    cov = numpy.asarray(cov, dtype=float)
+    variance = numpy.sum(numpy.dot(basis, cov)*basis, axis=1)
+    return values, numpy.sqrt(numpy.maximum(variance, 0.0))
+
+def get_cache_stats():
+    """
+        Returns the hit/miss statistics of the basis cache
+    """
+    return _basis_cache.get_stats()
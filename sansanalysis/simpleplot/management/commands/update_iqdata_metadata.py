@@ -0,0 +1,64 @@
+import sys, hashlib
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from sansanalysis.simpleplot.models import IqData
+import sansanalysis.simpleplot.manipulations.iqdata as iqdata
+
+class Command(BaseCommand):
+    """
+        Fill the content summary of data sets uploaded before it was
+        computed at upload time
+    """
+    option_list = BaseCommand.option_list + (
+        make_option('--all', action='store_true', dest='all', default=False,
+                    help='Update all data sets instead of only those without a summary'),
+    )
+    help = 'Fill the content summary and content hash of IqData objects'
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        
+        data_sets = IqData.objects.all()
+        if not options['all']:
+            data_sets = data_sets.filter(npts__isnull=True)
+        
+        n_updated = 0
+        n_failed = 0
+        for iq_data in data_sets.iterator():
+            try:
+                # Data sets uploaded before the digest was stored
+                if not iq_data.content_hash:
+                    iq_data.content_hash = _get_file_hash(iq_data.file.path)
+                    IqData.objects.filter(pk=iq_data.id).update(content_hash=iq_data.content_hash)
+                
+                if iqdata.update_metadata(iq_data):
+                    n_updated += 1
+                else:
+                    n_failed += 1
+                    if verbosity>1:
+                        print "Could not read data set %d [%s]" % (iq_data.id, iq_data.name)
+            except:
+                n_failed += 1
+                if verbosity>0:
+                    print "Error updating data set %d: %s" % (iq_data.id, sys.exc_value)
+                
+        if verbosity>0:
+            print "Updated %d data sets, %d could not be read" % (n_updated, n_failed)
+
+def _get_file_hash(path):
+    """
+        Returns the SHA-256 digest of a file
+    """
+    digest = hashlib.sha256()
+    fd = open(path, 'rb')
+    try:
+        while True:
+            chunk = fd.read(64*1024)
+            if not chunk:
+                break
+            digest.update(chunk)
+    finally:
+        fd.close()
+    return digest.hexdigest()
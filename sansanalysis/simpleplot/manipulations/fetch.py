@@ -0,0 +1,95 @@
+"""
+    Download of data files given by URL.
+
+    Downloads are executed as background jobs so that a slow remote
+    server does not hold a request thread. The download is streamed
+    to disk with a timeout on each read, a limit on the total time,
+    and a limit on the number of bytes.
+"""
+import time, urllib2
+
+from django.core.urlresolvers import reverse
+
+from sansanalysis.jobs.job_queue import JobError
+import sansanalysis.settings
+import upload
+import iqdata
+
+class FetchTimeout(Exception):
+    """
+        Raised when a download takes longer than allowed
+    """
+    pass
+
+def _read_chunks(fd, max_time):
+    """
+        Generator returning the content of a remote file in chunks
+        @param fd: file-like object returned by urlopen
+        @param max_time: maximum time allowed for the download, in seconds
+    """
+    deadline = time.time() + max_time
+    for chunk in upload.read_chunks(fd):
+        if time.time() > deadline:
+            raise FetchTimeout, "The download took longer than %g seconds" % max_time
+        yield chunk
+
+def fetch_url(url, timeout=None, max_time=None, max_size=None):
+    """
+        Download a file to a temporary file
+        @param url: URL of the file
+        @param timeout: timeout of each network operation, in seconds
+        @param max_time: maximum time allowed for the download, in seconds
+        @param max_size: maximum size of the file, in bytes
+        @return: upload.StreamedFile object
+    """
+    if timeout is None:
+        timeout = sansanalysis.settings.IQDATA_FETCH_TIMEOUT
+    if max_time is None:
+        max_time = sansanalysis.settings.IQDATA_FETCH_MAX_TIME
+    if max_size is None:
+        max_size = sansanalysis.settings.IQDATA_MAX_UPLOAD_SIZE
+
+    f = urllib2.urlopen(urllib2.Request(url=url), timeout=timeout)
+    try:
+        # Check the announced size before reading anything
+        length = f.info().getheader('Content-Length')
+        if length is not None and int(length) > max_size:
+            raise upload.UploadTooLarge, "The file is larger than %d bytes" % max_size
+        return upload.stream_to_file(_read_chunks(f, max_time), url, max_size)
+    finally:
+        f.close()
+
+def fetch_url_job(job):
+    """
+        Job handler downloading a data file and adding it to the
+        data sets of the owner of the job.
+
+        Job parameters:
+            - url: URL of the data file
+
+        @param job: Job object
+        @return: dictionary with the pk of the IqData object and the URL of its page
+    """
+    url = job.get_parameters()['url']
+    max_size = sansanalysis.settings.IQDATA_MAX_UPLOAD_SIZE
+    try:
+        content = fetch_url(url, max_size=max_size)
+    except upload.UploadTooLarge:
+        raise JobError, "The data file is too large: the maximum size is %d kB" % (max_size/1024)
+    except urllib2.HTTPError, e:
+        # Server errors may go away, client errors won't
+        if e.code < 500:
+            raise JobError, "The data file could not be retrieved: HTTP error %d" % e.code
+        raise
+    except ValueError:
+        raise JobError, "Invalid URL: %s" % url
+
+    iq_data = iqdata.store_uploaded_file(job.owner, url, content)
+
+    # Parse and validate the data now, so that its page loads quickly
+    loader = iqdata.FileDataLoader()
+    if loader.load_file_data(iq_data) is None:
+        raise JobError, ' '.join(loader.get_errors())
+
+    return {'iq_id': iq_data.id,
+            'url': reverse('sansanalysis.simpleplot.views.data_details', args=(iq_data.id,))}
@@ -1,24 +1,389 @@
 """
     Database manipulations to support the simpleplot application
 """
-import sys, math, hashlib, time
+import sys, os, math, copy, hashlib, time, base64
+import numpy
 
 # Import SANS modules
 from sans.dataloader.loader import  Loader
+from sans.dataloader.data_info import Data1D
+from sans.models import qsmearing
 
 # Import Django modules
 from django.core.files import File
+from django.db import transaction
 
 # Import application modules
-from sansanalysis.simpleplot.models import IqData, IqDataPoint, AnonymousSharedData, UserSharedData
+from sansanalysis.simpleplot.models import IqData, IqDataPoint, IqDataArrays, AnonymousSharedData, UserSharedData
 from sansanalysis.app_logging.models import store_error
+from sansanalysis.common.cache import LRUCache
 import sansanalysis.settings
+import sidecar
+import upload
+
+## Error shown when the requested data set is not in the data file
+NO_ENTRY_MSG = "The uploaded data file has no data set number %d."
+## Error shown when some Q values could not be read
+INVALID_X_MSG = "The uploaded data has invalid x values."
+
+## Parsed data sets shared by all loaders of this process
+_data_cache = LRUCache(sansanalysis.settings.IQDATA_CACHE_SIZE)
+
+def get_data_version(iq_data):
+    """
+        Returns a string identifying the current content of a data set.
+        This is the digest of the content of the data file, or, for
+        files uploaded before it was computed, the modification time 
+        of the IqData object, which is saved every time its file is replaced.
+        @param iq_data: IqData object
+    """
+    if iq_data.content_hash:
+        return iq_data.content_hash
+    return iq_data.modified_on.isoformat()
+
+def _get_cache_key(iq_data, entry=0):
+    """
+        Returns the cache key for a data set of an IqData object. 
+        The version of the data is part of the key so that a replaced 
+        file is never served from the cache. Data sets stored in the
+        same file, like identical uploads, share their cache entries.
+        @param iq_data: IqData object
+        @param entry: index of the data set within the data file
+    """
+    if iq_data.content_hash:
+        return (iq_data.content_hash, iq_data.file.name, entry)
+    if iq_data.modified_on is None:
+        return None
+    return (iq_data.id, get_data_version(iq_data), entry)
+
+def _get_data_size(data_info):
+    """
+        Returns the size in bytes of the arrays of a Data1D object
+    """
+    size = 0
+    for item in [data_info.x, data_info.y, data_info.dx, data_info.dy, data_info.dxl, data_info.dxw]:
+        size += getattr(item, 'nbytes', 0)
+    return size
+
+def _get_cached_copy(data_info):
+    """
+        Returns a copy of a cached Data1D object that can be handed
+        to a caller. The arrays are shared between copies and are
+        flagged as read-only to protect the cached data.
+    """
+    for item in [data_info.x, data_info.y, data_info.dx, data_info.dy, data_info.dxl, data_info.dxw]:
+        if hasattr(item, 'flags'):
+            item.flags.writeable = False
+    return copy.copy(data_info)
+
+def _as_float_array(values):
+    """
+        Returns a column as an array of floats. Entries that
+        cannot be converted to a float are set to NaN.
+        @param values: sequence of values
+    """
+    try:
+        return numpy.array(values, dtype=float)
+    except (TypeError, ValueError):
+        # Only columns holding non-numerical entries go through this slow path
+        column = numpy.empty(len(values))
+        for i in range(len(values)):
+            try:
+                column[i] = float(values[i])
+            except (TypeError, ValueError):
+                column[i] = numpy.nan
+        return column
+
+def _check_data(data_info):
+    """
+        Consistency checks for the I(q) and q arrays of a Data1D object
+        @param data_info: Data1D object
+        @return: error message, or None if the data is consistent
+    """
+    if data_info.x is None or data_info.y is None:
+        return "The uploaded data has undefined Q and/or I(Q)."
+     
+    if len(data_info.x) != len(data_info.y):
+        return "The uploaded data has different Q and I(Q) lengths."
+    
+    # Check whether we have errors and whether they are of the same length as I(Q)
+    for m in [data_info.dy, data_info.dx, data_info.dxl, data_info.dxw]:
+        if m is not None and len(m) != len(data_info.y):
+            return "The uploaded data has different I(Q) and dI(Q) lengths."
+    return None
+
+def sanitize_data(data_info):
+    """
+        Replace invalid entries of a Data1D object:
+            - invalid or negative dI(Q) values are set to 0
+            - invalid I(Q) values are set to 0, with an error of 1
+            - invalid Q values are counted but left as is
+        The columns are replaced by arrays of floats.
+        
+        @param data_info: Data1D object, modified in place
+        @return: dictionary with the number of points and the count of each type of correction
+    """
+    x = _as_float_array(data_info.x)
+    y = _as_float_array(data_info.y)
+    
+    report = {'npts': len(x),
+              'invalid_x': int(numpy.isnan(x).sum()),
+              'invalid_y': 0,
+              'invalid_dy': 0,
+              'negative_dy': 0}
+    
+    bad_y = numpy.isnan(y)
+    report['invalid_y'] = int(bad_y.sum())
+    y[bad_y] = 0.0
+    
+    if data_info.dy is not None:
+        dy = _as_float_array(data_info.dy)
+        bad_dy = numpy.isnan(dy)
+        negative_dy = dy<0.0
+        report['invalid_dy'] = int(bad_dy.sum())
+        report['negative_dy'] = int(negative_dy.sum())
+        dy[bad_dy | negative_dy] = 0.0
+        dy[bad_y] = 1.0
+        data_info.dy = dy
+        
+    data_info.x = x
+    data_info.y = y
+    return report
+
+def sort_data(data_info):
+    """
+        Sort the columns of a Data1D object by increasing Q, so that
+        the points of a Q range can be found by binary search.
+        
+        @param data_info: Data1D object, modified in place
+        @return: True if the points had to be reordered
+    """
+    x = numpy.asarray(data_info.x)
+    if len(x)<2 or numpy.all(x[1:]>=x[:-1]):
+        return False
+    
+    order = numpy.argsort(x, kind='mergesort')
+    for name in sidecar.COLUMNS:
+        value = getattr(data_info, name, None)
+        if value is not None and len(value)==len(x):
+            setattr(data_info, name, numpy.asarray(value)[order])
+    return True
+
+def get_q_range_slice(x, qmin=None, qmax=None):
+    """
+        Returns the slice of a sorted Q array covering [qmin, qmax]
+        @param x: Q values, sorted in increasing order
+        @param qmin: minimum Q, or None for no lower bound
+        @param qmax: maximum Q, or None for no upper bound
+    """
+    first = 0
+    last = len(x)
+    if qmin is not None:
+        first = int(numpy.searchsorted(x, qmin, side='left'))
+    if qmax is not None:
+        last = int(numpy.searchsorted(x, qmax, side='right'))
+    return slice(first, max(first, last))
+
+def slice_data(data_info, qmin=None, qmax=None):
+    """
+        Returns a Data1D object whose columns are views of the points
+        of a sorted Data1D object that are within [qmin, qmax]
+        @param data_info: Data1D object, sorted by increasing Q
+        @param qmin: minimum Q, or None for no lower bound
+        @param qmax: maximum Q, or None for no upper bound
+    """
+    x = numpy.asarray(data_info.x)
+    idx = get_q_range_slice(x, qmin, qmax)
+    
+    def _view(value):
+        if value is None or len(value)!=len(x):
+            return value
+        return numpy.asarray(value)[idx]
+    
+    window = Data1D(x[idx], _view(data_info.y), 
+                    dx=_view(data_info.dx), dy=_view(data_info.dy))
+    window.dxl = _view(data_info.dxl)
+    window.dxw = _view(data_info.dxw)
+    return window
+
+def _has_column(values, npts):
+    """
+        Returns True if a column is present and has non-zero values
+    """
+    return values is not None and len(values)==npts and bool(numpy.any(numpy.asarray(values)!=0))
+
+def get_metadata(data_info, n_entries=1):
+    """
+        Returns the summary of a validated data set, as a dictionary
+        of IqData field values
+        @param data_info: validated Data1D object
+        @param n_entries: number of data sets in the data file
+    """
+    x = numpy.asarray(data_info.x)
+    y = numpy.asarray(data_info.y)
+    npts = len(x)
+    valid_x = x[numpy.isfinite(x)]
+    
+    metadata = {'n_entries': n_entries,
+                'npts': npts,
+                'q_min': float(valid_x.min()) if len(valid_x)>0 else None,
+                'q_max': float(valid_x.max()) if len(valid_x)>0 else None,
+                'i_min': float(y.min()) if npts>0 else None,
+                'i_max': float(y.max()) if npts>0 else None,
+                'has_dx': _has_column(data_info.dx, npts),
+                'has_dy': _has_column(data_info.dy, npts),
+                'has_dxl': _has_column(data_info.dxl, npts),
+                'has_dxw': _has_column(data_info.dxw, npts),
+                'smearing': '',
+                'dq_min': None, 'dq_avg': None, 'dq_max': None,
+                'slit_width': None, 'slit_height': None}
+    
+    # Default smearing, as it would be selected for a fit
+    smearer = qsmearing.smear_selection(data_info)
+    if isinstance(smearer, qsmearing.QSmearer):
+        width = numpy.asarray(smearer.width)
+        metadata['smearing'] = 'point'
+        metadata['dq_min'] = float(width.min())
+        metadata['dq_avg'] = float(width.mean())
+        metadata['dq_max'] = float(width.max())
+    elif isinstance(smearer, qsmearing.SlitSmearer):
+        metadata['smearing'] = 'slit'
+        metadata['slit_width'] = float(smearer.width)
+        metadata['slit_height'] = float(smearer.height)
+    return metadata
+
+def update_metadata(iq_data):
+    """
+        Read a data set and store the summary of its content on
+        the IqData object. The modification time of the IqData object
+        is not changed.
+        @param iq_data: IqData object
+        @return: True if the data could be read
+    """
+    loader = FileDataLoader()
+    data_info = loader.load_file_data(iq_data)
+    if data_info is None:
+        return False
+    
+    metadata = get_metadata(data_info, loader.get_n_entries())
+    for key in metadata:
+        setattr(iq_data, key, metadata[key])
+    IqData.objects.filter(pk=iq_data.id).update(**metadata)
+    return True
+
+def _pack_array(values):
+    """
+        Returns an array as a base64-encoded string of little-endian doubles
+        @param values: array, or None
+    """
+    if values is None:
+        return None
+    return base64.b64encode(numpy.asarray(values, dtype='<f8').tostring())
+
+def _unpack_array(text):
+    """
+        Returns the read-only array stored in a string created by _pack_array
+        @param text: encoded string, or None
+    """
+    if text is None:
+        return None
+    return numpy.frombuffer(base64.b64decode(text), dtype='<f8')
+
+@transaction.commit_on_success
+def store_data_arrays(iq_data, data_info, n_entries=1, report=None, entry=0):
+    """
+        Store the validated data points of a data set in the DB,
+        replacing any point previously stored for it.
+        @param iq_data: IqData object
+        @param data_info: validated Data1D object
+        @param n_entries: number of data sets found in the data file
+        @param report: sanitization report of the data set
+        @param entry: index of the data set within the data file
+    """
+    if report is None:
+        report = {}
+    IqDataArrays.objects.filter(iq_data=iq_data, entry=entry).delete()
+    
+    arrays = IqDataArrays(iq_data=iq_data, 
+                          entry=entry,
+                          version=get_data_version(iq_data),
+                          npts=len(data_info.x),
+                          n_entries=n_entries,
+                          x=_pack_array(data_info.x),
+                          y=_pack_array(data_info.y),
+                          dx=_pack_array(data_info.dx),
+                          dy=_pack_array(data_info.dy),
+                          dxl=_pack_array(data_info.dxl),
+                          dxw=_pack_array(data_info.dxw),
+                          invalid_x=report.get('invalid_x', 0),
+                          invalid_y=report.get('invalid_y', 0),
+                          invalid_dy=report.get('invalid_dy', 0),
+                          negative_dy=report.get('negative_dy', 0))
+    arrays.save()
+    return arrays
+
+def _get_stored_arrays(iq_data):
+    """
+        Returns the DB rows holding the data points of the current
+        version of a data set. The rows stored for any data set using 
+        the same file are used, so that identical uploads are only read once.
+        @param iq_data: IqData object
+    """
+    if iq_data.content_hash:
+        return IqDataArrays.objects.filter(version=iq_data.content_hash, 
+                                           iq_data__file=iq_data.file.name)
+    return IqDataArrays.objects.filter(iq_data=iq_data, version=get_data_version(iq_data))
+
+def load_data_arrays(iq_data, entry=0):
+    """
+        Returns the data points stored in the DB for the current version
+        of a data set, or None if they are not available.
+        @param iq_data: IqData object
+        @param entry: index of the data set within the data file
+        @return: (Data1D object, number of data sets in the file, sanitization report)
+    """
+    arrays = _get_stored_arrays(iq_data).filter(entry=entry)[:1]
+    if len(arrays)==0:
+        return None
+    arrays = arrays[0]
+    
+    data_info = Data1D(_unpack_array(arrays.x), _unpack_array(arrays.y),
+                       dx=_unpack_array(arrays.dx), dy=_unpack_array(arrays.dy))
+    data_info.dxl = _unpack_array(arrays.dxl)
+    data_info.dxw = _unpack_array(arrays.dxw)
+    # Rows stored before the points were sorted at load time
+    sort_data(data_info)
+    report = {'npts': arrays.npts,
+              'invalid_x': arrays.invalid_x,
+              'invalid_y': arrays.invalid_y,
+              'invalid_dy': arrays.invalid_dy,
+              'negative_dy': arrays.negative_dy}
+    return data_info, arrays.n_entries, report
+
+def invalidate_cache(iq_data):
+    """
+        Remove the cached data of an IqData object that is not identified 
+        by the content of its file. This should be called before the file 
+        of a data set is replaced.
+        Data identified by its content can't go stale: it is left for
+        other data sets using the same file.
+        @param iq_data: IqData object
+    """
+    return _data_cache.invalidate(lambda key: key[0]==iq_data.id)
+
+def get_cache_stats():
+    """
+        Returns the hit/miss statistics of the data cache
+    """
+    return _data_cache.get_stats()
 
 class FileDataLoader:
     """
     """
     errors = []
     data_info = None
+    report = None
+    n_entries = 0
     
     def has_errors(self):
         """
@@ -29,29 +394,82 @@ class FileDataLoader:
     def get_errors(self):
         return self.errors
     
-    def load_file_data(self, iq_data):
+    def get_report(self):
+        """
+            Returns the sanitization report of the last load
+        """
+        return self.report
+    
+    def get_n_entries(self):
+        """
+            Returns the number of data sets found in the file of the last load
+        """
+        return self.n_entries
+    
+    def load_file_data(self, iq_data, entry=0):
         """
-            Read data file and create associated IqDataPoint entries
+            Read data file and store its validated data points.
+            The data is looked up, in order, in the cache of this process,
+            in the sidecar file, in the DB, and finally read from the file.
+            
+            A data file may hold several data sets. When the file is read,
+            each of them is stored separately so that later requests 
+            only touch the data set they need.
+            
             @param iq_data: IqData object
+            @param entry: index of the data set within the data file
         """
 
         self.errors = []
+        self.report = None
+        self.n_entries = 0
+        
+        # Check whether the data set was already parsed by this process
+        cache_key = _get_cache_key(iq_data, entry)
+        cached = _data_cache.get(cache_key) if cache_key is not None else None
+        if cached is not None:
+            data_info, errors, report, self.n_entries = cached
+            self.errors = list(errors)
+            self.report = dict(report)
+            self.data_info = _get_cached_copy(data_info)
+            return self.data_info
+        
+        # Map the validated columns if they were stored by an earlier load
+        stored = None
+        if sansanalysis.settings.IQDATA_USE_SIDECAR:
+            stored = sidecar.read_sidecar(iq_data.file.path, entry)
+        
+        # Otherwise use the data points stored in the DB
+        if stored is None:
+            stored = load_data_arrays(iq_data, entry)
+            
+        if stored is not None:
+            data_info, self.n_entries, self.report = stored
+            if self.report['invalid_x']>0:
+                self.errors.append(INVALID_X_MSG)
+            return self._set_data(cache_key, data_info)
+        
+        # Avoid reading the file again for a data set it doesn't have
+        if entry>0:
+            known = _get_stored_arrays(iq_data).values_list('n_entries', flat=True)[:1]
+            if len(known)>0 and entry>=known[0]:
+                self.n_entries = known[0]
+                self.errors.append(NO_ENTRY_MSG % (entry+1))
+                return
         
         # Check whether we already have stored data for this set.
         # If so, delete them. To sync with the IqData table, this should
         # be done regardless of whether we can load the file or not. 
-        data = IqDataPoint.objects.filter(iq_data=iq_data).order_by('x')
-        for item in data:
-            item.delete()
+        IqDataPoint.objects.filter(iq_data=iq_data).delete()
+        IqDataArrays.objects.filter(iq_data=iq_data).delete()
         
         # Load data from file
         try:
             #reader = ascii_reader.Reader()
             #data_info = reader.read(iq.file.path)
-            data_info = Loader().load(iq_data.file.path)
-            if data_info.__class__==list:
-                data_info = data_info[0]
-                self.errors.append("The uploaded data file has more than a single data set: only the first was loaded.")
+            entries = Loader().load(iq_data.file.path)
+            if entries.__class__!=list:
+                entries = [entries]
         except:
             # Log the error and raise for the view to respond with an error page
             error_msg = "iqdata.load_file_data: error reading file %s\n%s" % (iq_data.name, sys.exc_value)
@@ -59,71 +477,87 @@ class FileDataLoader:
             self.errors.append("The uploaded data file is not in a format that can be processed.")
             return
         
-        # Consistency checks for I(q) and q arrays
-        if data_info.x is None or data_info.y is None:
-            self.errors.append("The uploaded data has undefined Q and/or I(Q).")
-            return
-         
-        if len(data_info.x) != len(data_info.y):
-            self.errors.append("The uploaded data has different Q and I(Q) lengths.")
+        self.n_entries = len(entries)
+        if entry<0 or entry>=self.n_entries:
+            self.errors.append(NO_ENTRY_MSG % (entry+1))
             return
         
-        # Check whether we have errors and whether they are of the same length as I(Q)
-        if data_info.dy is not None and len(data_info.dy) != len(data_info.y):
-            self.errors.append("The uploaded data has different I(Q) and dI(Q) lengths.")
-            return
+        # Validate and store each data set, keeping only the requested one
+        data_info = None
+        for i in range(self.n_entries):
+            error_msg = _check_data(entries[i])
+            if error_msg is not None:
+                if i==entry:
+                    self.errors.append(error_msg)
+                    return
+                continue
+            
+            report = sanitize_data(entries[i])
+            sort_data(entries[i])
+            self._store(iq_data, entries[i], report, i)
+            if i==entry:
+                data_info = entries[i]
+                self.report = report
+            # Do not keep a reference to the data sets we don't need
+            entries[i] = None
         
-        for m in [data_info.dy, data_info.dx, data_info.dxl, data_info.dxw]:
-            if m is not None and len(m) != len(data_info.y):
-                self.errors.append("The uploaded data has different I(Q) and dI(Q) lengths.")
-                return
+        if self.report['invalid_x']>0:
+            self.errors.append(INVALID_X_MSG)
+                
+        return self._set_data(cache_key, data_info)
         
-        # Check for invalid data
-        for i in range(len(data_info.x)):
-            if data_info.dy is not None:
-                try:
-                    float(data_info.dy[i])
-                except:
-                    data_info.dy[i]=0.0
-                if data_info.dy[i]<0.0:
-                    data_info.dy[i]=0.0
-                    
-            try:
-                float(data_info.y[i])
-            except:
-                data_info.y[i]=0.0
-                if data_info.dy is not None:
-                    data_info.dy[i]=1.0
+    def _store(self, iq_data, data_info, report, entry):
+        """
+            Store the validated data points of a data set in the DB
+            and in its sidecar file
+            @param iq_data: IqData object
+            @param data_info: validated Data1D object
+            @param report: sanitization report of the data set
+            @param entry: index of the data set within the data file
+        """
+        try:
+            store_data_arrays(iq_data, data_info, self.n_entries, report, entry)
+        except:
+            error_msg = "iqdata.load_file_data: could not store data points for %s\n%s" % (iq_data.name, sys.exc_value)
+            store_error(user=None, url=None, text=error_msg, method='iqdata.load_file_data', build=sansanalysis.settings.APP_VERSION)
             
+        # Keep the validated columns for the next load
+        if sansanalysis.settings.IQDATA_USE_SIDECAR:
             try:
-                float(data_info.x[i])
+                sidecar.write_sidecar(iq_data.file.path, data_info, self.n_entries, report, entry)
             except:
-                self.errors.append("The uploaded data has invalid x values.")
-                
-        if False:
-            # Store to DB
-            for i in range(len(data_info.x)):
-                dp = IqDataPoint(iq_data=iq_data,
-                                 x=data_info.x[i], 
-                                 y=data_info.y[i])
-                
-                if data_info.dx is not None:
-                    dp.dx = data_info.dx[i]
-                
-                if data_info.dy is not None:
-                    dp.dy = data_info.dy[i]
-                
-                if data_info.dxl is not None:
-                    dp.dxl = data_info.dxl[i]
-                
-                if data_info.dxw is not None:
-                    dp.dxw = data_info.dxw[i]
-                
-                dp.save()
+                error_msg = "iqdata.load_file_data: could not write sidecar for %s\n%s" % (iq_data.name, sys.exc_value)
+                store_error(user=None, url=None, text=error_msg, method='iqdata.load_file_data', build=sansanalysis.settings.APP_VERSION)
+        
+    def _set_data(self, cache_key, data_info):
+        """
+            Store a validated Data1D object in the data cache and
+            return the copy that should be handed to the caller
+            @param cache_key: cache key, or None if the data shouldn't be cached
+            @param data_info: Data1D object
+        """
+        if cache_key is not None:
+            _data_cache.put(cache_key, (data_info, list(self.errors), dict(self.report), self.n_entries),
+                            _get_data_size(data_info))
+            data_info = _get_cached_copy(data_info)
                 
         self.data_info = data_info
         return data_info
         
+    def load_q_range(self, iq_data, qmin=None, qmax=None, entry=0):
+        """
+            Read a data set and return the points within [qmin, qmax].
+            The returned columns are views of the loaded data.
+            @param iq_data: IqData object
+            @param qmin: minimum Q, or None for no lower bound
+            @param qmax: maximum Q, or None for no upper bound
+            @param entry: index of the data set within the data file
+        """
+        data_info = self.load_file_data(iq_data, entry)
+        if data_info is None:
+            return None
+        return slice_data(data_info, qmin, qmax)
+        
 
         
 def get_anonymous_shared_data(key):
@@ -221,10 +655,82 @@ def load_sample_data(user):
     """
     # The sample file from the test folder
     filename = sansanalysis.settings.SAMPLE_LOCATION+'sphere_80.txt'
-    data = open(filename, 'r')
-    content = File(data)
+    data = open(filename, 'rb')
+    try:
+        content = upload.stream_to_file(upload.read_chunks(data), 'sample_data.txt')
+    finally:
+        data.close()
     iq = IqData()
     iq.owner = user.id
     iq.name  = 'sample_data.txt'
-    iq.file.save('sample_data.txt', content)  
+    save_data_file(iq, 'sample_data.txt', content)
+    update_metadata(iq)
     return iq.id
+
+def store_uploaded_file(owner, file_name, content):
+    """
+        Store an uploaded data file for a user. If the user already
+        has a data set with the same name, its file is replaced.
+        
+        @param owner: ID of the user uploading the file
+        @param file_name: name of the uploaded file
+        @param content: upload.StreamedFile object
+        @return: IqData object
+    """
+    # Search to see whether a file with that name exists.
+    # Check whether the file is owned by the user before deleting it.
+    # If it's not, just create a new file with the same name.
+    old_name = None
+    iq_entries = IqData.objects.filter(name__endswith=file_name, owner=owner)
+    if len(iq_entries)>0:                
+        iq_data = iq_entries[0]
+        old_name = iq_data.file.name
+        # Make sure that the old content is not served from the cache
+        invalidate_cache(iq_data)
+    else:
+        # No entry was found, create one
+        iq_data = IqData()
+        iq_data.owner = owner
+        iq_data.name  = file_name
+    
+    # Store the new file before releasing the old one, since
+    # they are the same stored file if the content didn't change
+    save_data_file(iq_data, file_name, content)
+    if old_name:
+        release_data_file(iq_data.file.storage, old_name)
+        
+    # Read the data once to store its summary
+    try:
+        update_metadata(iq_data)
+    except:
+        error_msg = "iqdata.store_uploaded_file: could not compute metadata for %s\n%s" % (iq_data.name, sys.exc_value)
+        store_error(user=None, url=None, text=error_msg, method='iqdata.store_uploaded_file', build=sansanalysis.settings.APP_VERSION)
+    return iq_data
+
+def release_data_file(storage, name):
+    """
+        Remove a reference to a stored data file. The sidecar files
+        are removed along with the data file once it is no longer used.
+        @param storage: storage of the IqData files
+        @param name: name of the file in the storage
+    """
+    path = storage.path(name)
+    storage.delete(name)
+    if not storage.exists(name):
+        sidecar.remove_sidecar(path)
+
+def save_data_file(iq_data, file_name, content):
+    """
+        Save an uploaded data file for an IqData object, along with 
+        the digest of its content. The IqData object is saved.
+        
+        @param iq_data: IqData object
+        @param file_name: name of the uploaded file
+        @param content: upload.StreamedFile object
+    """
+    try:
+        iq_data.file.save(file_name, content, save=False)
+        iq_data.content_hash = content.content_hash
+        iq_data.save()
+    finally:
+        content.discard()
@@ -1,13 +1,70 @@
 import sys, numpy, time, math
 import hashlib
 
+from django.db import transaction
+from django.core.urlresolvers import reverse
+from django.utils import simplejson
+
 # Application imports
 import sansanalysis.simpleplot.calculations.invert_pr as invert_pr
+import sansanalysis.simpleplot.calculations.pr_basis as pr_basis
 from sansanalysis.simpleplot.models import PrInversion, PrOutput, IqData, PrCoefficients, AnonymousSharedPr, UserSharedPr
 import sansanalysis.simpleplot.manipulations.iqdata as iqdata
 from sansanalysis.app_logging.models import store_error
+from sansanalysis.common.cache import LRUCache
+from sansanalysis.jobs import job_queue
+from sansanalysis.jobs.job_queue import JobError
 import sansanalysis.settings
 
+## Prepared inputs of the invertor {(data set cache key, q_min, q_max): inputs}
+_inputs_cache = LRUCache(sansanalysis.settings.PR_INPUTS_CACHE_SIZE)
+## Outputs of complete D_max scans {(data set cache key, parameters, D_max values): outputs}
+_scan_cache = LRUCache(sansanalysis.settings.PR_SCAN_CACHE_SIZE)
+
+## Factorizations of regularization paths {(data set cache key, parameters): RegularizationPath}
+_path_cache = LRUCache(sansanalysis.settings.PR_PATH_CACHE_SIZE)
+
+## Quality maps over D_max and alpha {(data set cache key, parameters, D_max values, alpha values): map}
+_map_cache = LRUCache(sansanalysis.settings.PR_MAP_CACHE_SIZE)
+
+## Inversion parameters, other than D_max, that change the outputs of a D_max scan
+SCAN_PARAMETERS = ['n_terms', 'alpha', 'has_bck', 'slit_height', 'slit_width', 'q_min', 'q_max']
+## Inversion parameters that change the factorization of a regularization path
+PATH_PARAMETERS = ['d_max', 'n_terms', 'has_bck', 'slit_height', 'slit_width', 'q_min', 'q_max']
+## Inversion parameters, other than D_max and alpha, that change a quality map
+MAP_PARAMETERS = ['n_terms', 'has_bck', 'slit_height', 'slit_width', 'q_min', 'q_max']
+
+def get_inversion_inputs(iq_data, data_info, q_min=None, q_max=None):
+    """
+        Returns the inputs of the invertor for a data set and
+        a Q range, from the cache if possible. Missing or null
+        errors are replaced by ones.
+        
+        The inputs are cached by data version and Q range, so that
+        the estimates, the D_max exploration and the inversions of
+        the same data share them.
+        
+        @param iq_data: IqData object
+        @param data_info: Data1D object for the data set
+        @param q_min: minimum Q, or None for no bound
+        @param q_max: maximum Q, or None for no bound
+    """
+    key = iqdata._get_cache_key(iq_data)
+    if key is not None:
+        key = (key, q_min, q_max)
+        inputs = _inputs_cache.get(key)
+        if inputs is not None:
+            return inputs
+    
+    dy = data_info.dy
+    if dy is None or len(dy) != len(data_info.x) or not numpy.any(dy):
+        dy = numpy.ones(len(data_info.x))
+    inputs = invert_pr.prepare_inputs(data_info.x, data_info.y, dy, q_min, q_max)
+    
+    if key is not None:
+        _inputs_cache.put(key, inputs, inputs['x'].nbytes+inputs['y'].nbytes+inputs['err'].nbytes)
+    return inputs
+
 def get_pr_output_id(pr_id):
     """
         Returns a PrOutput ID for a given PrInversion pk
@@ -32,9 +89,12 @@ class PrInvertor:
         """
         return len(self.errors)>0
     
-    def __call__(self, iq_id, form_data, user_id):
+    def __call__(self, iq_id, form_data, user_id, callback=None):
         """
             Called after a P(r) inversion POST 
+            @param callback: function called with the fraction of the work
+                completed, once the data is loaded and once the inversion
+                is done, or None
         """
         self.errors = []
         self.messages = []
@@ -57,11 +117,13 @@ class PrInvertor:
                 store_error(user=None, url=None, text=error_msg, method='prdata.PrInvertor.__call__', build=sansanalysis.settings.APP_VERSION)
                 raise RuntimeError, "Data loader could not read the data file [ID=%s]." % str(iq.id)
             
-            if data_info.dy is None or len(data_info.dy) != len(data_info.x) or all(v == 0 for v in data_info.dy):
-                data_info.dy = numpy.ones(len(data_info.x))
-
+            inputs = get_inversion_inputs(iq, data_info, form_data['q_min'], form_data['q_max'])
+            if callback is not None:
+                callback(0.25)
             invertor = invert_pr.PrCalculation(form_data)
-            iqfit, prfit, out_pars = invertor(data_info)
+            iqfit, prfit, out_pars = invertor(data_info, inputs)
+            if callback is not None:
+                callback(0.75)
             
             # Keep track of errors
             self.messages.extend(invertor.messages)
@@ -70,54 +132,7 @@ class PrInvertor:
             # Store inversion data
             q_min = form_data['q_min'] if form_data['q_min'] is not None else min(iqfit['x'])
             q_max = form_data['q_max'] if form_data['q_max'] is not None else max(iqfit['x'])
-            problem = PrInversion(iq_data     = iq,
-                                  user_id     = user_id,
-                                  has_bck     = form_data['has_bck'],
-                                  d_max       = form_data['d_max'],
-                                  n_terms     = form_data['n_terms'],
-                                  slit_height = form_data['slit_height'],
-                                  slit_width  = form_data['slit_width'],
-                                  alpha       = form_data['alpha'],
-                                  q_min       = q_min,
-                                  q_max       = q_max)
-            problem.save()    
-            
-            # Store inversion output
-            try:
-                output = PrOutput(inversion = problem,
-                                  chi2 = out_pars['chi2'],
-                                  rg   = out_pars['rg'],
-                                  bck  = out_pars['bck'],
-                                  iq_zero = out_pars['iq_zero'],
-                                  osc  = out_pars['osc'],
-                                  pos_frac = out_pars['pos_frac'],
-                                  pos_frac_1sigma = out_pars['pos_frac_1sigma'])
-                output.save()
-            except:
-                output = PrOutput(inversion = problem,
-                                  chi2 = 0,
-                                  rg   = 0,
-                                  bck  = 0,
-                                  iq_zero = 0,
-                                  osc  = 0,
-                                  pos_frac = 0,
-                                  pos_frac_1sigma = 0)
-                output.save()
-                
-                error_msg = "Could not save PrOutput\n"
-                error_msg += "chi2=%s; rg=%s, bck=%s, iq0=%s, osc=%s, pos=%s, sig=%s" % (out_pars['chi2'],
-                                                                                         out_pars['rg'],
-                                                                                         out_pars['bck'],
-                                                                                         out_pars['iq_zero'],
-                                                                                         out_pars['osc'],
-                                                                                         out_pars['pos_frac'],
-                                                                                         out_pars['pos_frac_1sigma'])
-                store_error(user=None, url=None, text=error_msg, method='prdata.PrInvertor.__call__', build=sansanalysis.settings.APP_VERSION)
-                raise
-                
-            # Store output coefficients and covariance matrix
-            self._save_coefficients(output, out_pars['coeff'], out_pars['cov'])
-            #self._check_coefficients_storage(output.id, out_pars['coeff'], out_pars['cov'])
+            problem = self._save_inversion(iq, user_id, form_data, q_min, q_max, out_pars)
             
         except:
             error_msg = "Could not compute P(r)\n%s" % sys.exc_value
@@ -129,9 +144,68 @@ class PrInvertor:
         
         return iqfit, prfit, problem.id
 
+    @transaction.commit_on_success
+    def _save_inversion(self, iq, user_id, form_data, q_min, q_max, out_pars):
+        """
+            Store a P(r) inversion, its output and its coefficients to DB.
+            Nothing is stored if any of them can't be saved, so that
+            an inversion with an output is always complete.
+            Errors are left for the caller to log.
+            
+            @param iq: IqData object
+            @param user_id: pk of the user
+            @param form_data: inversion parameters, as given by PrForm
+            @param q_min: minimum Q of the inversion
+            @param q_max: maximum Q of the inversion
+            @param out_pars: output parameters, coefficients and covariance matrix
+            @return: PrInversion object
+        """
+        problem = PrInversion(iq_data     = iq,
+                              user_id     = user_id,
+                              fingerprint = get_fingerprint(iq, form_data),
+                              has_bck     = form_data['has_bck'],
+                              d_max       = form_data['d_max'],
+                              n_terms     = form_data['n_terms'],
+                              slit_height = form_data['slit_height'],
+                              slit_width  = form_data['slit_width'],
+                              alpha       = form_data['alpha'],
+                              q_min       = q_min,
+                              q_max       = q_max)
+        problem.save()    
+        
+        # Store inversion output
+        try:
+            output = PrOutput(inversion = problem,
+                              chi2 = out_pars['chi2'],
+                              rg   = out_pars['rg'],
+                              bck  = out_pars['bck'],
+                              iq_zero = out_pars['iq_zero'],
+                              osc  = out_pars['osc'],
+                              pos_frac = out_pars['pos_frac'],
+                              pos_frac_1sigma = out_pars['pos_frac_1sigma'])
+            output.save()
+        except:
+            # The error is logged by the caller: an error stored here
+            # would be rolled back with the inversion
+            error_msg = "Could not save PrOutput: %s\n" % sys.exc_value
+            error_msg += "chi2=%s; rg=%s, bck=%s, iq0=%s, osc=%s, pos=%s, sig=%s" % (out_pars['chi2'],
+                                                                                     out_pars['rg'],
+                                                                                     out_pars['bck'],
+                                                                                     out_pars['iq_zero'],
+                                                                                     out_pars['osc'],
+                                                                                     out_pars['pos_frac'],
+                                                                                     out_pars['pos_frac_1sigma'])
+            raise RuntimeError, error_msg
+            
+        # Store output coefficients and covariance matrix
+        self._save_coefficients(output, out_pars['coeff'], out_pars['cov'])
+        #self._check_coefficients_storage(output.id, out_pars['coeff'], out_pars['cov'])
+        return problem
+        
     def _save_coefficients(self, pr_output, out, cov):
         """
-            Store P(r) inversion output coefficents to DB
+            Store P(r) inversion output coefficents to DB.
+            Called within the transaction of _save_inversion.
             @param pr_output: PrOutput model object
             @param out: output coefficient
             @param cov: covariance matrix
@@ -143,7 +217,7 @@ class PrInvertor:
                                value      = out[i])
             c.save()
             
-            if False:
+            if sansanalysis.settings.PR_STORE_COVARIANCE:
                 for j in range(len(out)):
                     cc = PrCoefficients(proutput   = pr_output,
                                          type       = 1,
@@ -158,20 +232,14 @@ class PrInvertor:
             @param out: output coefficient
             @param cov: covariance matrix
         """
-        t_0 = time.time()
         c = PrCoefficients.objects.filter(proutput__pk=pr_output_id, type=0).order_by('main_index')
+        out = numpy.asarray(c.values_list('value', flat=True), dtype=float)
         
-        out = numpy.zeros(len(c))
-        cov = numpy.zeros([len(c), len(c)])
-        
-        for i in range(len(c)):
-            out[i] = c[i].value
-        
-            cc = PrCoefficients.objects.filter(proutput__pk=pr_output_id, type=1, main_index=i).order_by('sec_index')
-            for j in range(len(cc)):
-                cov[i][j] = cc[j].value
-        
-        elapsed = time.time()-t_0
+        # The covariance matrix is left to zero if it was not stored
+        cov = numpy.zeros([len(out), len(out)])
+        cc = PrCoefficients.objects.filter(proutput__pk=pr_output_id, type=1).values_list('main_index', 'sec_index', 'value')
+        for i, j, value in cc:
+            cov[i][j] = value
            
         return out, cov
     
@@ -213,29 +281,26 @@ class PrInvertor:
             raise RuntimeError, "No PrOutput model object found with pk=%d" % pr_output_id 
         
         iq_data = pr[0].inversion.iq_data
+        parameters = pr[0].inversion.get_parameters()
+        
+        # Only the points within the Q range of the inversion are needed
+        qmin = parameters['q_min'] if parameters['q_min'] else None
+        qmax = parameters['q_max'] if parameters['q_max'] else None
+        
         loader = iqdata.FileDataLoader()
-        data_info = loader.load_file_data(iq_data)
+        data_info = loader.load_q_range(iq_data, qmin, qmax)
         if data_info is None:
             error_msg = "Could not read file [iq_id=%s]" % str(iq_data.id)
             store_error(user=None, url=None, text=error_msg, method='prdata.PrInvertor.get_iq_calc', build=sansanalysis.settings.APP_VERSION)
             raise RuntimeError, "Data loader could not read the data file [ID=%s]." % str(iq_data.id)
-      
-        if data_info.dy is None or len(data_info.dy) != len(data_info.x) or all(v == 0 for v in data_info.dy):
-            data_info.dy = numpy.ones(len(data_info.x))
         
         out, cov = self._load_coefficients(pr_output_id)
         
-        parameters = pr[0].inversion.get_parameters()
-        
         invertor = invert_pr.PrCalculation(parameters)
+        if parameters['has_bck'] and pr[0].bck is not None:
+            invertor.invertor.background = pr[0].bck
         
-        qmin = parameters['q_min'] if parameters['q_min'] else min(data_info.x)
-        qmax = parameters['q_max'] if parameters['q_max'] else max(data_info.x)
-        
-        xdist = []
-        for x in data_info.x:
-            if x>=qmin and x<=qmax:
-                xdist.append(x) 
+        xdist = data_info.x
         
         iq_calc = invertor.get_iq_calc(xdist, out, cov)
         
@@ -249,9 +314,16 @@ class PrInvertor:
                 'dy':None}
         
         
-    def get_pr(self, pr_output_id):
+    def get_pr(self, pr_output_id, npts=None):
         """
+            Returns P(r) and its uncertainty, when the covariance
+            matrix of the inversion is available
+            
+            @param pr_output_id: pk of PrOutput item
+            @param npts: number of points, PR_OUTPUT_NPTS by default
         """
+        if npts is None:
+            npts = sansanalysis.settings.PR_OUTPUT_NPTS
         
         pr = PrOutput.objects.filter(pk=pr_output_id)
         if len(pr)==0:
@@ -261,11 +333,11 @@ class PrInvertor:
         
         invertor = invert_pr.PrCalculation(pr[0].inversion.get_parameters())
         
-        r, pr_calc = invertor.get_pr(out, cov)
+        r, pr_calc, pr_err = invertor.get_pr(out, cov, npts)
         return {'iq_id':pr[0].inversion.iq_data.id,
                 'x':r,
                 'y':pr_calc,
-                'dy':None}
+                'dy':pr_err}
         
     def get_outputs(self, pr_output_id):
         """
@@ -324,11 +396,9 @@ class PrInvertor:
                 store_error(user=None, url=None, text=error_msg, method='prdata.PrInvertor.estimate', build=sansanalysis.settings.APP_VERSION)
                 raise RuntimeError, "Data loader could not read the data file [ID=%s]." % str(iq.id)
            
-            if data_info.dy is None or len(data_info.dy) != len(data_info.x) or all(v == 0 for v in data_info.dy):
-                data_info.dy = numpy.ones(len(data_info.x))
-
+            inputs = get_inversion_inputs(iq, data_info, form_data['q_min'], form_data['q_max'])
             invertor = invert_pr.PrCalculation(form_data)
-            n_terms, alpha, message = invertor.estimate(data_info)
+            n_terms, alpha, message = invertor.estimate(data_info, inputs)
             return n_terms, alpha
             
         except:
@@ -337,35 +407,462 @@ class PrInvertor:
         
 
     def explore_dmax(self, iq_id, form_data, user_id, min=None, max=None, npts=25):
+        """
+            Returns the outputs of the P(r) inversion for a range of D_max
+            
+            @param iq_id: pk of IqData object
+            @param form_data: inversion parameters, as given by PrForm
+            @param user_id: pk of the user
+            @param min: minimum value for D_max, or None
+            @param max: maximum value for D_max, or None
+            @param npts: number of points for D_max
+            @return: dictionary of outputs, see scan_dmax
+        """
         # Check that a data set is available
         # Get the data information to be displayed
         [iq] = IqData.objects.filter(pk=iq_id)
         
         try:
-            # Load data from file
-            #TODO: replace this by DB access
-            loader = iqdata.FileDataLoader()
-            data_info = loader.load_file_data(iq)
-            if data_info is None:
-                error_msg = "Could not read file [iq_id=%s]" % str(iq.id)
-                store_error(user=None, url=None, text=error_msg, method='prdata.PrInvertor.explore_dmax', build=sansanalysis.settings.APP_VERSION)
-                raise RuntimeError, "Data loader could not read the data file [ID=%s]." % str(iq.id)
-           
-            if data_info.dy is None or len(data_info.dy) != len(data_info.x) or all(v == 0 for v in data_info.dy):
-                data_info.dy = numpy.ones(len(data_info.x))
-
-            invertor = invert_pr.PrCalculation(form_data)
-            results = invertor.explore_dmax(data_info, min, max, npts)
-            
-            return {'iq_id':iq_id,
-                'x':results.d_max,
-                'y':results.chi2,
-                'dy':None}
+            return scan_dmax(iq, form_data, min, max, npts)
         except:
             store_error(user=None, url=None, text=sys.exc_value, method='prdata.PrInvertor.explore_dmax', build=sansanalysis.settings.APP_VERSION)
             raise
         
+def _get_scan_key(iq_data, parameters, d_values):
+    """
+        Returns the cache key of a D_max scan, or None
+        if the data set can't be cached
+        @param iq_data: IqData object
+        @param parameters: inversion parameters
+        @param d_values: list of D_max values
+    """
+    key = iqdata._get_cache_key(iq_data)
+    if key is None:
+        return None
+    return (key, tuple([parameters[name] for name in SCAN_PARAMETERS]), tuple(d_values))
+
+def get_cached_scan(iq_data, parameters, min=None, max=None, npts=25):
+    """
+        Returns the outputs of a D_max scan if they are in the cache,
+        or None. Takes the same arguments as scan_dmax.
+    """
+    d_values = invert_pr.get_dmax_values(parameters['d_max'], min, max, npts)
+    key = _get_scan_key(iq_data, parameters, d_values)
+    if key is None:
+        return None
+    return _scan_cache.get(key)
+
+def cache_scan(iq_data, parameters, min, max, npts, result):
+    """
+        Store the outputs of a complete D_max scan computed by
+        another process, like a job worker. Takes the same arguments
+        as scan_dmax, plus the result it returned.
+    """
+    d_values = invert_pr.get_dmax_values(parameters['d_max'], min, max, npts)
+    key = _get_scan_key(iq_data, parameters, d_values)
+    if key is not None:
+        result = {'points': result['points'], 'errors': result['errors']}
+        _scan_cache.put(key, result, len(simplejson.dumps(result)))
+
+def scan_dmax(iq_data, parameters, min=None, max=None, npts=25, processes=1, callback=None):
+    """
+        Returns the outputs of the P(r) inversion for a range of D_max.
+        Complete scans are cached by data version, inversion parameters
+        and D_max values.
+        
+        @param iq_data: IqData object
+        @param parameters: inversion parameters, as given by PrForm
+        @param min: minimum value for D_max, or None
+        @param max: maximum value for D_max, or None
+        @param npts: number of points for D_max
+        @param processes: number of processes, or None for one per CPU
+        @param callback: function called with the outputs completed so far
+            after each inversion. The scan stops if it returns False.
+        @return: dictionary with the list of outputs for each D_max,
+            sorted by D_max ('points'), and the list of error messages
+            of the failed inversions ('errors')
+    """
+    d_values = invert_pr.get_dmax_values(parameters['d_max'], min, max, npts)
+    key = _get_scan_key(iq_data, parameters, d_values)
+    if key is not None:
+        result = _scan_cache.get(key)
+        if result is not None:
+            return result
+    
+    loader = iqdata.FileDataLoader()
+    data_info = loader.load_file_data(iq_data)
+    if data_info is None:
+        error_msg = "Could not read file [iq_id=%s]" % str(iq_data.id)
+        store_error(user=None, url=None, text=error_msg, method='prdata.scan_dmax', build=sansanalysis.settings.APP_VERSION)
+        raise RuntimeError, "Data loader could not read the data file [ID=%s]." % str(iq_data.id)
+    inputs = get_inversion_inputs(iq_data, data_info, parameters['q_min'], parameters['q_max'])
+    
+    def _get_result(points):
+        points = sorted(points, key=lambda item: item['d_max'])
+        return {'points': [item for item in points if not item.has_key('error')],
+                'errors': [item['error'] for item in points if item.has_key('error')]}
+    
+    points = []
+    scan = invert_pr.scan_dmax(inputs, parameters, d_values, processes)
+    try:
+        for item in scan:
+            points.append(item)
+            if callback is not None and callback(_get_result(points)) is False:
+                break
+    finally:
+        scan.close()
+    
+    result = _get_result(points)
+    if key is not None and len(points)==len(d_values):
+        _scan_cache.put(key, result, len(simplejson.dumps(result)))
+    return result
+    
+def explore_dmax_job(job):
+    """
+        Job handler computing the outputs of the P(r) inversion
+        for a range of D_max values. The inversions are shared among
+        a pool of PR_SCAN_PROCESSES processes. The outputs are stored
+        in the result of the job as they are completed, so that they
+        can be shown before the end of the scan.
+        
+        Job parameters:
+            - iq_id: pk of the IqData object
+            - parameters: inversion parameters, as given by PrForm
+            - min, max: D_max range, or None for the default range
+            - npts: number of D_max values
+        
+        @param job: Job object
+        @return: dictionary with the pk of the IqData object, the list
+            of outputs for each D_max, sorted by D_max, and the list of
+            error messages of the failed inversions
+    """
+    job_parameters = job.get_parameters()
+    try:
+        iq = IqData.objects.get(pk=job_parameters['iq_id'])
+    except IqData.DoesNotExist:
+        raise JobError, "The data set no longer exists"
+    
+    npts = job_parameters['npts']
+    def _update(result):
+        result['iq_id'] = iq.id
+        job_queue.set_progress(job, (len(result['points'])+len(result['errors']))/float(npts), result)
+        return not job_queue.is_cancelled(job)
+    
+    try:
+        result = scan_dmax(iq, job_parameters['parameters'], job_parameters['min'], job_parameters['max'], npts,
+                           processes=sansanalysis.settings.PR_SCAN_PROCESSES, callback=_update)
+    except RuntimeError:
+        raise JobError, sys.exc_value
+    result = dict(result)
+    result['iq_id'] = iq.id
+    return result
+        
+def regularization_path(iq_data, parameters, alphas, npts=None):
+    """
+        Returns the outputs of the P(r) inversion for a list of alpha values.
+        The factorization the solutions are computed from is cached by data
+        version and inversion parameters, other than alpha, so that any
+        number of alpha values can be solved for without inverting again.
+        
+        @param iq_data: IqData object
+        @param parameters: inversion parameters, as given by PrForm
+        @param alphas: array of alpha values, in increasing order
+        @param npts: number of points of P(r), PR_OUTPUT_NPTS if None
+        @return: dictionary of solutions, see PrCalculation.solve_regularization_path,
+            with the distances ('r') and the P(r) values for each alpha,
+            one row per alpha ('pr')
+    """
+    if npts is None:
+        npts = sansanalysis.settings.PR_OUTPUT_NPTS
+    calculation = invert_pr.PrCalculation(parameters)
+    
+    path = None
+    key = iqdata._get_cache_key(iq_data)
+    if key is not None:
+        key = (key, tuple([parameters[name] for name in PATH_PARAMETERS]))
+        path = _path_cache.get(key)
+    if path is None:
+        loader = iqdata.FileDataLoader()
+        data_info = loader.load_file_data(iq_data)
+        if data_info is None:
+            error_msg = "Could not read file [iq_id=%s]" % str(iq_data.id)
+            store_error(user=None, url=None, text=error_msg, method='prdata.regularization_path', build=sansanalysis.settings.APP_VERSION)
+            raise RuntimeError, "Data loader could not read the data file [ID=%s]." % str(iq_data.id)
+        inputs = get_inversion_inputs(iq_data, data_info, parameters['q_min'], parameters['q_max'])
+        path = calculation.get_regularization_path(data_info, inputs)
+        if key is not None:
+            _path_cache.put(key, path, path.get_size())
+    
+    solutions = calculation.solve_regularization_path(path, alphas)
+    r = numpy.linspace(0, parameters['d_max'], npts)
+    basis = pr_basis.get_basis('pr', r, parameters['d_max'], parameters['n_terms'])
+    solutions['r'] = r
+    solutions['pr'] = numpy.dot(solutions['coeff'], basis.T)
+    return solutions
+    
+def _get_map_key(iq_data, parameters, d_values, alphas):
+    """
+        Returns the cache key of a quality map, or None
+        if the data set can't be cached
+        @param iq_data: IqData object
+        @param parameters: inversion parameters
+        @param d_values: list of D_max values
+        @param alphas: list of alpha values
+    """
+    key = iqdata._get_cache_key(iq_data)
+    if key is None:
+        return None
+    return (key, tuple([parameters[name] for name in MAP_PARAMETERS]),
+            tuple([float(v) for v in d_values]), tuple([float(v) for v in alphas]))
+
+def get_cached_map(iq_data, parameters, d_values, alphas):
+    """
+        Returns a quality map if it is in the cache, or None.
+        Takes the same arguments as quality_map.
+    """
+    key = _get_map_key(iq_data, parameters, d_values, alphas)
+    if key is None:
+        return None
+    return _map_cache.get(key)
+
+def cache_map(iq_data, parameters, d_values, alphas, result):
+    """
+        Store a complete quality map computed by another process,
+        like a job worker. Takes the same arguments as quality_map,
+        plus the result it returned.
+    """
+    key = _get_map_key(iq_data, parameters, d_values, alphas)
+    if key is not None:
+        result = dict([(name, result[name]) for name in ['d_max', 'alpha', 'chi2', 'osc', 'pos_frac', 'rg', 'skipped', 'errors']])
+        _map_cache.put(key, result, len(simplejson.dumps(result)))
+
+def quality_map(iq_data, parameters, d_values, alphas, processes=1, callback=None):
+    """
+        Returns the outputs of the P(r) inversion over a grid of D_max
+        and alpha values. Complete maps are cached by data version,
+        inversion parameters and grid.
+        
+        Cells where chi2 is much larger than at the smallest alpha for the
+        same D_max are not evaluated further, see PR_MAP_MAX_CHI2_RATIO.
+        
+        @param iq_data: IqData object
+        @param parameters: inversion parameters, as given by PrForm
+        @param d_values: list of D_max values
+        @param alphas: list of alpha values, in increasing order
+        @param processes: number of processes, or None for one per CPU
+        @param callback: function called with the map completed so far
+            after each D_max value. The map stops if it returns False.
+        @return: dictionary with the D_max values ('d_max'), the alpha
+            values ('alpha'), the maps of chi2, oscillation, positive
+            fraction and Rg ('chi2', 'osc', 'pos_frac', 'rg'), as lists
+            with one row per D_max and None where a value was not computed,
+            the number of cells skipped ('skipped') and the error messages
+            of the failed D_max values ('errors')
+    """
+    d_values = [float(v) for v in d_values]
+    alphas = [float(v) for v in alphas]
+    key = _get_map_key(iq_data, parameters, d_values, alphas)
+    if key is not None:
+        result = _map_cache.get(key)
+        if result is not None:
+            return result
+    
+    loader = iqdata.FileDataLoader()
+    data_info = loader.load_file_data(iq_data)
+    if data_info is None:
+        error_msg = "Could not read file [iq_id=%s]" % str(iq_data.id)
+        store_error(user=None, url=None, text=error_msg, method='prdata.quality_map', build=sansanalysis.settings.APP_VERSION)
+        raise RuntimeError, "Data loader could not read the data file [ID=%s]." % str(iq_data.id)
+    inputs = get_inversion_inputs(iq_data, data_info, parameters['q_min'], parameters['q_max'])
+    
+    def _get_result(rows):
+        result = {'d_max': d_values, 'alpha': alphas,
+                  'skipped': sum([row.get('skipped', 0) for row in rows.values()]),
+                  'errors': [rows[d_max]['error'] for d_max in d_values if rows.has_key(d_max) and rows[d_max].has_key('error')]}
+        for name in ['chi2', 'osc', 'pos_frac', 'rg']:
+            result[name] = [rows[d_max].get(name, [None]*len(alphas)) if rows.has_key(d_max) else [None]*len(alphas)
+                            for d_max in d_values]
+        return result
+    
+    rows = {}
+    scan = invert_pr.map_dmax_alpha(inputs, parameters, d_values, alphas, processes,
+                                    sansanalysis.settings.PR_MAP_MAX_CHI2_RATIO)
+    try:
+        for row in scan:
+            rows[row['d_max']] = row
+            if callback is not None and callback(_get_result(rows)) is False:
+                break
+    finally:
+        scan.close()
+    
+    result = _get_result(rows)
+    if key is not None and len(rows)==len(d_values):
+        _map_cache.put(key, result, len(simplejson.dumps(result)))
+    return result
+
+def quality_map_job(job):
+    """
+        Job handler computing a quality map of the P(r) inversion over
+        a grid of D_max and alpha values. The D_max values are shared
+        among a pool of PR_SCAN_PROCESSES processes. The map is stored
+        in the result of the job as its rows are completed.
+        
+        Job parameters:
+            - iq_id: pk of the IqData object
+            - parameters: inversion parameters, as given by PrForm
+            - d_values: list of D_max values
+            - alphas: list of alpha values, in increasing order
+        
+        @param job: Job object
+        @return: dictionary with the pk of the IqData object and
+            the map, see quality_map
+    """
+    job_parameters = job.get_parameters()
+    try:
+        iq = IqData.objects.get(pk=job_parameters['iq_id'])
+    except IqData.DoesNotExist:
+        raise JobError, "The data set no longer exists"
+    
+    n_dmax = len(job_parameters['d_values'])
+    completed = [0]
+    def _update(result):
+        completed[0] += 1
+        result['iq_id'] = iq.id
+        job_queue.set_progress(job, completed[0]/float(n_dmax), result)
+        return not job_queue.is_cancelled(job)
+    
+    try:
+        result = quality_map(iq, job_parameters['parameters'], job_parameters['d_values'], job_parameters['alphas'],
+                             processes=sansanalysis.settings.PR_SCAN_PROCESSES, callback=_update)
+    except RuntimeError:
+        raise JobError, sys.exc_value
+    result = dict(result)
+    result['iq_id'] = iq.id
+    return result
+    
+def get_fingerprint(iq_data, parameters):
+    """
+        Returns the fingerprint of a P(r) inversion: the SHA-256 digest of
+        the version of the data and of every parameter of PrInversion, as
+        requested. Requests with the same fingerprint give the same result.
+        
+        @param iq_data: IqData object
+        @param parameters: inversion parameters, as given by PrForm
+    """
+    values = [iqdata.get_data_version(iq_data)]
+    for name in sorted(PrInversion().get_parameters().keys()):
+        value = parameters.get(name, None)
+        if isinstance(value, bool) or value is None:
+            pass
+        elif name == 'n_terms':
+            value = int(value)
+        else:
+            value = float(value)
+        values.append((name, value))
+    return hashlib.sha256(repr(values)).hexdigest()
+
+def find_inversion(iq_data, user_id, fingerprint):
+    """
+        Returns the pk of the latest complete inversion of a user for a
+        data set with a given fingerprint, or None
         
+        @param iq_data: IqData object
+        @param user_id: pk of the user
+        @param fingerprint: fingerprint of the inversion, see get_fingerprint
+    """
+    # Inversions stored before they were saved in a single transaction
+    # may have an output without coefficients
+    outputs = PrOutput.objects.filter(inversion__iq_data=iq_data, inversion__user_id=user_id,
+                                      inversion__fingerprint=fingerprint,
+                                      prcoefficients__type=0).order_by('-inversion__created_on')
+    pr_ids = outputs.values_list('inversion__id', flat=True)[:1]
+    if len(pr_ids)==0:
+        return None
+    return pr_ids[0]
+
+def submit_inversion(iq_data, parameters, user_id):
+    """
+        Submit a P(r) inversion job, unless the same inversion was
+        already computed or is being computed for the user
+        
+        @param iq_data: IqData object
+        @param parameters: inversion parameters, as given by PrForm
+        @param user_id: pk of the user
+        @return: the pk of an existing PrInversion with the same
+            fingerprint and None, or None and the Job computing it
+    """
+    fingerprint = get_fingerprint(iq_data, parameters)
+    pr_id = find_inversion(iq_data, user_id, fingerprint)
+    if pr_id is not None:
+        return pr_id, None
+    
+    # Identical files uploaded as different data sets have the same fingerprint
+    job = job_queue.find_active('invert_pr', user_id, fingerprint)
+    if job is not None and job.get_parameters()['iq_id'] != iq_data.id:
+        job = None
+    if job is None:
+        job = job_queue.submit('invert_pr', user_id, {'iq_id': iq_data.id, 'parameters': parameters},
+                               max_attempts=sansanalysis.settings.PR_JOB_MAX_ATTEMPTS, fingerprint=fingerprint)
+    return None, job
+
+def submit_analysis_job(kind, iq_data, job_parameters, user_id):
+    """
+        Submit a D_max scan or quality map job, unless the same job
+        is already waiting or running for the user, or was completed.
+        The result of a completed job is in the DB, so that it can be
+        served by any process even if it is not in its cache.
+        
+        @param kind: job kind, 'explore_dmax' or 'pr_map'
+        @param iq_data: IqData object
+        @param job_parameters: parameters of the job
+        @param user_id: pk of the user
+        @return: Job object
+        @raise JobLimitError: if the user has too many jobs waiting or running
+    """
+    fingerprint = hashlib.sha256(simplejson.dumps([iqdata.get_data_version(iq_data), job_parameters],
+                                                  sort_keys=True)).hexdigest()
+    job = job_queue.find_done(kind, user_id, fingerprint)
+    if job is None:
+        job = job_queue.find_active(kind, user_id, fingerprint)
+    if job is None:
+        job = job_queue.submit(kind, user_id, job_parameters, max_attempts=1, fingerprint=fingerprint)
+    return job
+
+def invert_job(job):
+    """
+        Job handler performing a P(r) inversion and storing its outputs.
+        Progress is reported before and after the inversion, so that a
+        worker is not considered dead while the data is being loaded or
+        the outputs stored, see JOB_RUNNING_TIMEOUT.
+        
+        Job parameters:
+            - iq_id: pk of the IqData object
+            - parameters: inversion parameters, as given by PrForm
+        
+        @param job: Job object
+        @return: dictionary with the pk of the IqData object, the pk of
+            the PrInversion object and the URL of the page showing it
+    """
+    job_parameters = job.get_parameters()
+    try:
+        iq = IqData.objects.get(pk=job_parameters['iq_id'])
+    except IqData.DoesNotExist:
+        raise JobError, "The data set no longer exists"
+    
+    # The job may have been cancelled while waiting in the queue
+    if job_queue.is_cancelled(job):
+        raise JobError, "The inversion was cancelled"
+    
+    # The same inversion may have been completed since the job was submitted
+    pr_id = find_inversion(iq, job.owner, get_fingerprint(iq, job_parameters['parameters']))
+    if pr_id is None:
+        invertor = PrInvertor()
+        iq_dist, pr_dist, pr_id = invertor(iq.id, job_parameters['parameters'], job.owner,
+                                           callback=lambda progress: job_queue.set_progress(job, progress))
+    return {'iq_id': iq.id,
+            'pr_id': pr_id,
+            'url': reverse('sansanalysis.simpleplot.views.invert', args=(iq.id, pr_id))}
+    
 def get_pr_shared_key(pr, create=False):
     """
         Get a key for a given PrInversion object to be shared.
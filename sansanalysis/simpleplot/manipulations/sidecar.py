@@ -0,0 +1,167 @@
+"""
+    Binary column files stored next to uploaded data files.
+
+    Once a data file has been parsed and validated, its columns are
+    written to a sidecar file that can be memory-mapped on the next
+    access instead of being parsed again. The mapped pages are shared
+    by all the server processes reading the same data set.
+    Files holding several data sets have one sidecar file per data set.
+
+    File layout (little-endian):
+        - header of HEADER_SIZE bytes: magic string, format version,
+          number of points, column mask, size and modification time
+          of the source file, and the counts of the sanitization report
+        - one block of float64 values per column present in the data,
+          in the order given by COLUMNS, with the points sorted by Q
+"""
+import os, struct
+import numpy
+
+from sans.dataloader.data_info import Data1D
+
+## Format version, to be incremented whenever the content of the file changes
+VERSION = 3
+## Magic string identifying sidecar files
+MAGIC = 'SANSIQ\0\0'
+## Extension appended to the name of the source file
+EXTENSION = '.iqbin'
+## Size of the header, in bytes
+HEADER_SIZE = 64
+## Data1D columns, in the order they are stored
+COLUMNS = ['x', 'y', 'dx', 'dy', 'dxl', 'dxw']
+
+# magic, version, npts, column mask, number of data sets in the source file,
+# source modification time, source size, sanitization counts
+_HEADER_FORMAT = '<8sIIIIdQIIII'
+## Sanitization report items, in the order they are stored
+REPORT_ITEMS = ['invalid_x', 'invalid_y', 'invalid_dy', 'negative_dy']
+
+def get_sidecar_path(path, entry=0):
+    """
+        Returns the path of the sidecar file for a given data file
+        @param path: path of the data file
+        @param entry: index of the data set within the data file
+    """
+    if entry==0:
+        return path + EXTENSION
+    return "%s.%d%s" % (path, entry, EXTENSION)
+
+def write_sidecar(path, data_info, n_entries=1, report=None, entry=0):
+    """
+        Write the validated columns of a Data1D object next to its source file.
+        The file is first written under a temporary name and then renamed so
+        that readers never see a partial file.
+
+        @param path: path of the source data file
+        @param data_info: validated Data1D object
+        @param n_entries: number of data sets found in the source file
+        @param report: sanitization report of the data set
+        @param entry: index of the data set within the source file
+    """
+    info = os.stat(path)
+    npts = len(data_info.x)
+
+    mask = 0
+    columns = []
+    for i in range(len(COLUMNS)):
+        value = getattr(data_info, COLUMNS[i], None)
+        if value is not None and len(value)==npts:
+            mask |= 1<<i
+            columns.append(numpy.asarray(value, dtype='<f8'))
+
+    if report is None:
+        report = {}
+    counts = [report.get(item, 0) for item in REPORT_ITEMS]
+    header = struct.pack(_HEADER_FORMAT, MAGIC, VERSION, npts, mask, n_entries,
+                         info.st_mtime, info.st_size, *counts)
+    header += '\0'*(HEADER_SIZE-len(header))
+
+    sidecar_path = get_sidecar_path(path, entry)
+    tmp_path = "%s.%d.tmp" % (sidecar_path, os.getpid())
+    fd = open(tmp_path, 'wb')
+    try:
+        fd.write(header)
+        for item in columns:
+            fd.write(item.tostring())
+    finally:
+        fd.close()
+
+    # Windows will not rename over an existing file
+    if os.name=='nt' and os.path.exists(sidecar_path):
+        os.remove(sidecar_path)
+    os.rename(tmp_path, sidecar_path)
+
+def read_sidecar(path, entry=0):
+    """
+        Memory-map the sidecar file of a data file.
+        Returns None if the sidecar is missing, was written with another
+        format version, or is older than the source file.
+
+        @param path: path of the source data file
+        @param entry: index of the data set within the source file
+        @return: (Data1D object, number of data sets in the source file, sanitization report)
+    """
+    sidecar_path = get_sidecar_path(path, entry)
+    try:
+        source_info = os.stat(path)
+        fd = open(sidecar_path, 'rb')
+        try:
+            header = fd.read(HEADER_SIZE)
+        finally:
+            fd.close()
+    except (OSError, IOError):
+        return None
+
+    if len(header)<HEADER_SIZE:
+        return None
+
+    fields = struct.unpack(_HEADER_FORMAT, header[:struct.calcsize(_HEADER_FORMAT)])
+    magic, version, npts, mask, n_entries, mtime, size = fields[:7]
+    if magic!=MAGIC or version!=VERSION \
+        or mtime!=source_info.st_mtime or size!=source_info.st_size:
+        return None
+
+    present = [COLUMNS[i] for i in range(len(COLUMNS)) if mask & (1<<i)]
+    if npts==0 or 'x' not in present or 'y' not in present:
+        return None
+
+    try:
+        columns = numpy.memmap(sidecar_path, dtype='<f8', mode='r',
+                               offset=HEADER_SIZE, shape=(len(present), npts))
+    except (ValueError, IOError):
+        # The file is truncated
+        return None
+
+    report = dict(zip(REPORT_ITEMS, fields[7:]))
+    report['npts'] = npts
+
+    values = {}
+    for i in range(len(present)):
+        values[present[i]] = columns[i]
+
+    data_info = Data1D(values['x'], values['y'], dx=values.get('dx', None), dy=values.get('dy', None))
+    data_info.dxl = values.get('dxl', None)
+    data_info.dxw = values.get('dxw', None)
+    return data_info, n_entries, report
+
+def remove_sidecar(path):
+    """
+        Remove the sidecar files of a data file, if they exist
+        @param path: path of the source data file
+    """
+    directory, name = os.path.split(path)
+    try:
+        files = os.listdir(directory or '.')
+    except OSError:
+        return
+    
+    for item in files:
+        if not (item.startswith(name) and item.endswith(EXTENSION)):
+            continue
+        # Only remove name.iqbin and name.<entry>.iqbin
+        entry = item[len(name):-len(EXTENSION)]
+        if entry=='' or (entry.startswith('.') and entry[1:].isdigit()):
+            try:
+                os.remove(os.path.join(directory, item))
+            except OSError:
+                pass
@@ -0,0 +1,98 @@
+"""
+    Streaming of uploaded data files to disk.
+
+    Uploaded content is written to a temporary file in chunks, while
+    its digest is computed in the same pass. The temporary file is
+    then moved into the storage of the IqData object, so that the
+    content is never held in memory as a whole.
+"""
+import os, tempfile, hashlib
+
+from django.core.files import File
+import sansanalysis.settings
+
+class UploadTooLarge(Exception):
+    """
+        Raised when an uploaded file is larger than the allowed size
+    """
+    pass
+
+class StreamedFile(File):
+    """
+        Uploaded content written to a temporary file.
+        The storage moves the temporary file instead of copying it.
+    """
+    def __init__(self, path, name, content_hash, size):
+        """
+            @param path: path of the temporary file
+            @param name: original name of the file
+            @param content_hash: hex digest of the content
+            @param size: size of the content, in bytes
+        """
+        File.__init__(self, open(path, 'rb'), name)
+        ## Path of the temporary file
+        self.path = path
+        ## SHA-256 hex digest of the content
+        self.content_hash = content_hash
+        self._size = size
+
+    def temporary_file_path(self):
+        return self.path
+
+    def discard(self):
+        """
+            Close and remove the temporary file, if it wasn't moved
+        """
+        self.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+def read_chunks(fd, chunk_size=None):
+    """
+        Generator returning the content of a file-like object in chunks
+        @param fd: file-like object with a read method
+        @param chunk_size: size of the chunks, in bytes
+    """
+    if chunk_size is None:
+        chunk_size = sansanalysis.settings.IQDATA_UPLOAD_CHUNK_SIZE
+    while True:
+        chunk = fd.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+def stream_to_file(chunks, name, max_size=None):
+    """
+        Write uploaded content to a temporary file and compute its digest.
+
+        @param chunks: iterable of strings
+        @param name: original name of the file
+        @param max_size: maximum size of the content, in bytes
+        @return: StreamedFile object
+        @raise UploadTooLarge: the content is larger than max_size
+    """
+    if max_size is None:
+        max_size = sansanalysis.settings.IQDATA_MAX_UPLOAD_SIZE
+
+    digest = hashlib.sha256()
+    size = 0
+    fd, path = tempfile.mkstemp(suffix='.upload',
+                                dir=getattr(sansanalysis.settings, 'FILE_UPLOAD_TEMP_DIR', None))
+    try:
+        output = os.fdopen(fd, 'wb')
+        try:
+            for chunk in chunks:
+                size += len(chunk)
+                if size > max_size:
+                    raise UploadTooLarge, "The uploaded file is larger than %d bytes" % max_size
+                digest.update(chunk)
+                output.write(chunk)
+        finally:
+            output.close()
+    except:
+        os.remove(path)
+        raise
+
+    return StreamedFile(path, name, digest.hexdigest(), size)
@@ -1,9 +1,10 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
 from django.conf import settings
 from django.core.files.storage import FileSystemStorage
 from django.contrib.auth.models import User
 
-import os
+import os, hashlib
 
 class OverwriteStorage(FileSystemStorage):
     
@@ -17,6 +18,120 @@ class OverwriteStorage(FileSystemStorage):
             os.remove(os.path.join(settings.MEDIA_ROOT, name))
         return name
     
+class StoredBlob(models.Model):
+    """
+        File stored by ContentAddressedStorage, with the number
+        of objects referring to it
+    """
+    ## Name of the file in the storage
+    name = models.CharField(max_length=255, unique=True)
+    ## SHA-256 digest of the content
+    content_hash = models.CharField(max_length=64)
+    ## Size in bytes
+    size = models.IntegerField(default=0)
+    ## Number of objects referring to the file
+    refcount = models.IntegerField(default=0)
+    ## Created on
+    created_on = models.DateTimeField('Created', auto_now_add=True)
+
+class ContentAddressedStorage(FileSystemStorage):
+    """
+        File system storage where files are named after the digest
+        of their content, so that identical files are stored once.
+        The extension of the original name is kept since it is used 
+        to select a data reader.
+        
+        Each save adds a reference to the stored file, and each delete 
+        removes one. The file is removed when it has no reference left.
+        
+        The reference count is updated first in each transaction, which
+        locks the StoredBlob row until the file is written or removed, so
+        that a save and a delete of the same content are never interleaved.
+    """
+    ## Number of times a save tries to add a reference to a file removed
+    ## by concurrent deletes before failing
+    max_reference_attempts = 5
+    
+    def _get_content_hash(self, content):
+        """
+            Returns the SHA-256 digest of the content of a file.
+            The digest computed when the file was uploaded is used if available.
+        """
+        content_hash = getattr(content, 'content_hash', None)
+        if content_hash:
+            return content_hash
+        digest = hashlib.sha256()
+        content.seek(0)
+        for chunk in content.chunks():
+            digest.update(chunk)
+        content.seek(0)
+        return digest.hexdigest()
+    
+    def _save(self, name, content):
+        content_hash = self._get_content_hash(content)
+        directory = os.path.dirname(name)
+        extension = os.path.splitext(name)[1].lower()
+        name = os.path.join(directory, content_hash[:2], content_hash+extension)
+        
+        # The row may be removed by a concurrent delete between
+        # its creation and the update that locks it
+        for i in range(self.max_reference_attempts):
+            if self._add_reference(name, content_hash, content):
+                return name
+        raise IOError, "Could not add a reference to %s after %d attempts" % (name, self.max_reference_attempts)
+    
+    @transaction.commit_on_success
+    def _add_reference(self, name, content_hash, content):
+        """
+            Add a reference to a stored file, writing it if needed
+            @return: False if the StoredBlob row was removed before it could be locked
+        """
+        blob, created = StoredBlob.objects.get_or_create(name=name, 
+                                                         defaults={'content_hash': content_hash,
+                                                                   'size': content.size})
+        if StoredBlob.objects.filter(pk=blob.id).update(refcount=F('refcount')+1)==0:
+            return False
+        
+        # Identical content is only written once. The file is written under
+        # another name and moved in place, so that a file written by another
+        # process in the meantime is simply replaced by the same content.
+        if not self.exists(name):
+            tmp_name = FileSystemStorage._save(self, name+'.tmp', content)
+            os.rename(self.path(tmp_name), self.path(name))
+        return True
+    
+    def delete(self, name):
+        if not StoredBlob.objects.filter(name=name).exists():
+            # Files stored before content addressing are not shared
+            FileSystemStorage.delete(self, name)
+            return
+        self._remove_reference(name)
+    
+    @transaction.commit_on_success
+    def _remove_reference(self, name):
+        """
+            Remove a reference to a stored file, and the file
+            if it has no reference left
+        """
+        blobs = StoredBlob.objects.filter(name=name)
+        blobs.filter(refcount__gt=0).update(refcount=F('refcount')-1)
+        
+        # The row is locked by the update: the count can be checked again
+        # and the file removed before any other save of the same content
+        for blob in blobs:
+            if blob.refcount <= 0:
+                blob.delete()
+                FileSystemStorage.delete(self, name)
+            
+    def get_refcount(self, name):
+        """
+            Returns the number of references to a stored file
+        """
+        try:
+            return StoredBlob.objects.get(name=name).refcount
+        except StoredBlob.DoesNotExist:
+            return 0
+    
 class IqData(models.Model):
     """
 
@@ -24,7 +139,7 @@ class IqData(models.Model):
     ## Data file
     #TODO: turn on overwrite once the view can search for existing data
     #storage = OverwriteStorage()
-    storage = FileSystemStorage()
+    storage = ContentAddressedStorage()
     file = models.FileField(upload_to='iq_data', storage=storage)
     ## Original name
     name = models.CharField(max_length=100)
@@ -34,6 +149,35 @@ class IqData(models.Model):
     created_on = models.DateTimeField('Created', auto_now_add=True)
     ## Last modified
     modified_on = models.DateTimeField('Modified', auto_now=True)
+    ## SHA-256 digest of the content of the data file
+    content_hash = models.CharField(max_length=64, blank=True, default='')
+    
+    # Summary of the content of the data file, filled when the file is uploaded.
+    # The numbers refer to the first data set of the file.
+    ## Number of data sets in the data file
+    n_entries = models.IntegerField(null=True)
+    ## Number of points
+    npts = models.IntegerField(null=True)
+    ## Q range
+    q_min = models.FloatField(null=True)
+    q_max = models.FloatField(null=True)
+    ## I(Q) range
+    i_min = models.FloatField(null=True)
+    i_max = models.FloatField(null=True)
+    ## Resolution columns present in the data
+    has_dx  = models.BooleanField(default=False)
+    has_dy  = models.BooleanField(default=False)
+    has_dxl = models.BooleanField(default=False)
+    has_dxw = models.BooleanField(default=False)
+    ## Smearing type found in the data: 'point', 'slit', or empty for none
+    smearing = models.CharField(max_length=20, blank=True, default='')
+    ## Summary of the Q resolution, for point smearing
+    dq_min = models.FloatField(null=True)
+    dq_avg = models.FloatField(null=True)
+    dq_max = models.FloatField(null=True)
+    ## Slit dimensions, for slit smearing
+    slit_width  = models.FloatField(null=True)
+    slit_height = models.FloatField(null=True)
 
     def get_user_name(self):
         """
@@ -47,6 +191,12 @@ class IqData(models.Model):
             # The data set will then appear as owned by "System" to the user with the link.
             return "System"
     get_user_name.short_description = 'User name'
+    
+    def has_metadata(self):
+        """
+            Returns True if the summary of the data file is available
+        """
+        return self.npts is not None
 
     
 #class IqDataInfo(models.Model):
@@ -81,6 +231,53 @@ class IqDataPoint(models.Model):
         return self.iq_data.name
     get_file_name.short_description = 'File name'
 
+class IqDataArrays(models.Model):
+    """
+        Validated data points of an IqData object, stored as packed
+        arrays in a single row per data set found in the data file. 
+        Each array is a base64-encoded string of little-endian doubles.
+    """
+    ## Associated data set
+    iq_data = models.ForeignKey(IqData)
+    ## Index of the data set within the data file
+    entry = models.IntegerField(default=0)
+    ## Version of the data set the arrays were read from
+    version = models.CharField(max_length=64)
+    ## Number of points
+    npts = models.IntegerField()
+    ## Number of data sets found in the data file
+    n_entries = models.IntegerField(default=1)
+    # Q values
+    x   = models.TextField()
+    # I(Q) values
+    y   = models.TextField()
+    # Error on Q
+    dx  = models.TextField(null=True)
+    # Error on I(Q)
+    dy  = models.TextField(null=True)
+    ## Slit smearing length
+    dxl = models.TextField(null=True)
+    ## Slit smearing width
+    dxw = models.TextField(null=True)
+    ## Number of invalid Q values
+    invalid_x = models.IntegerField(default=0)
+    ## Number of invalid I(Q) values that were replaced
+    invalid_y = models.IntegerField(default=0)
+    ## Number of invalid dI(Q) values that were replaced
+    invalid_dy = models.IntegerField(default=0)
+    ## Number of negative dI(Q) values that were replaced
+    negative_dy = models.IntegerField(default=0)
+    
+    class Meta:
+        unique_together = ('iq_data', 'entry')
+    
+    def get_file_name(self):
+        """
+            Return the name of the file when it was originally loaded
+        """
+        return self.iq_data.name
+    get_file_name.short_description = 'File name'
+
 class RecentData(models.Model):
     """
         Recent IqData accessed by the user
@@ -137,6 +334,9 @@ class PrInversion(models.Model):
     ## Maximum Q-value
     q_max       = models.FloatField(null=True)
     
+    ## Digest of the data version and of the requested parameters, see prdata.get_fingerprint
+    fingerprint = models.CharField(max_length=64, blank=True, default='', db_index=True)
+    
     ## Time stamp
     created_on = models.DateTimeField('Timestamp', auto_now_add=True)
     
@@ -0,0 +1,246 @@
+"""
+    Encoding of plot data sent to the pages.
+
+    Curves are sent column by column, either as JSON or as packed
+    little-endian floats:
+
+        - json: {"columns": [...], "npts": N, "npts_full": M,
+                 "data": {name: [...]}, "ticks_x": ..., "ticks_y": ...,
+                 "messages": [...]}
+          Views may add entries of their own, like the status of the job
+          computing the curve.
+          Values are written with a given number of significant digits.
+          Values that are not finite are written as null.
+        - f32, f64: the columns one after the other, as 32-bit or 64-bit
+          floats. The column names, the number of points and the ticks
+          are given in the X-Plot-Columns, X-Plot-Points, X-Plot-Points-Full,
+          X-Plot-Ticks-X and X-Plot-Ticks-Y headers.
+
+    The format is selected with the 'format' GET argument and the number
+    of significant digits of the JSON format with the 'precision' argument.
+
+    Curves with more than PLOT_MAX_POINTS points are decimated, in which
+    case npts_full is the number of points before decimation. The
+    'max_points' and 'decimation' GET arguments select the number of points
+    and the method, and 'full=1' asks for all the points.
+
+    Plot-ready columns can be kept in a process-level cache under a key
+    identifying the curve (kind of curve, version of its input, scales).
+    Responses built from a key carry an ETag derived from it, so that a
+    browser revalidating an unchanged curve gets a 304 response without
+    the curve being computed or loaded again.
+"""
+import hashlib
+import numpy
+
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils import simplejson
+
+from sansanalysis.common.cache import LRUCache
+from sansanalysis.simpleplot.calculations import decimate
+import sansanalysis.settings
+
+## Plot-ready columns {key: (columns, ticks_x, ticks_y, messages, npts_full)}
+_payload_cache = LRUCache(sansanalysis.settings.PLOT_DATA_CACHE_SIZE)
+
+## Column names of points returned by view_util.get_plot_arrays
+PLOT_COLUMNS = ['x', 'y', 'dx', 'dy_low', 'dy_high']
+## Column names of curves without error bars
+CURVE_COLUMNS = ['x', 'y']
+## Column names of the outputs of a D_max scan, x being D_max
+SCAN_COLUMNS = ['x', 'chi2', 'rg', 'iq_zero', 'bck', 'osc', 'pos_frac', 'pos_frac_1sigma']
+## Column names of the outputs of a regularization path, x being alpha
+PATH_COLUMNS = ['x', 'chi2', 'residual', 'reg_norm', 'gcv', 'bck']
+## Column names of the cells of a quality map, x being D_max and y alpha
+MAP_COLUMNS = ['x', 'y', 'chi2', 'osc', 'pos_frac', 'rg']
+
+FORMAT_JSON = 'json'
+## Binary formats and the corresponding little-endian numpy types
+BINARY_FORMATS = {'f32': '<f4', 'f64': '<f8'}
+
+## Range of precision values accepted from the request
+MIN_PRECISION = 1
+MAX_PRECISION = 17
+## Smallest number of points a curve can be decimated to
+MIN_POINTS = 10
+
+def get_payload_options(request):
+    """
+        Returns the format and precision requested for plot data
+        @param request: HTTP request, with optional 'format' and 'precision' GET arguments
+    """
+    fmt = request.GET.get('format', FORMAT_JSON)
+    if fmt != FORMAT_JSON and not BINARY_FORMATS.has_key(fmt):
+        fmt = FORMAT_JSON
+    try:
+        precision = int(request.GET.get('precision', sansanalysis.settings.PLOT_DATA_PRECISION))
+    except ValueError:
+        precision = sansanalysis.settings.PLOT_DATA_PRECISION
+    precision = min(max(precision, MIN_PRECISION), MAX_PRECISION)
+    return fmt, precision
+
+def get_decimation_options(request):
+    """
+        Returns the maximum number of points, or None for no limit,
+        and the decimation method requested for plot data
+        @param request: HTTP request, with optional 'max_points', 'decimation' and 'full' GET arguments
+    """
+    method = request.GET.get('decimation', sansanalysis.settings.PLOT_DECIMATION)
+    if method not in decimate.METHODS:
+        method = sansanalysis.settings.PLOT_DECIMATION
+    if request.GET.get('full', '0') == '1':
+        return None, method
+    try:
+        max_points = int(request.GET.get('max_points', sansanalysis.settings.PLOT_MAX_POINTS))
+    except ValueError:
+        max_points = sansanalysis.settings.PLOT_MAX_POINTS
+    return max(max_points, MIN_POINTS), method
+
+def _encode_json_array(values, precision):
+    """
+        Returns a JSON array of numbers as a string
+        @param values: numpy array
+        @param precision: number of significant digits
+    """
+    fmt = "%%.%dg" % precision
+    items = [fmt % v for v in values.tolist()]
+    not_finite = numpy.flatnonzero(~numpy.isfinite(values))
+    for i in not_finite:
+        items[i] = 'null'
+    return "[%s]" % ','.join(items)
+
+def encode_json(columns, names, ticks_x=None, ticks_y=None, precision=None, messages=None, npts_full=None, extra=None):
+    """
+        Returns plot data as a JSON string
+        @param columns: list of numpy arrays of equal length
+        @param names: list of column names
+        @param ticks_x: ticks of the x axis, or None
+        @param ticks_y: ticks of the y axis, or None
+        @param precision: number of significant digits
+        @param messages: list of messages for the user
+        @param npts_full: number of points before decimation, if the curve was decimated
+        @param extra: dictionary of additional entries, or None
+    """
+    if precision is None:
+        precision = sansanalysis.settings.PLOT_DATA_PRECISION
+    npts = len(columns[0]) if len(columns)>0 else 0
+    if npts_full is None:
+        npts_full = npts
+    data = ','.join(['"%s":%s' % (name, _encode_json_array(numpy.asarray(col, dtype=float), precision)) \
+                     for name, col in zip(names, columns)])
+    extra_entries = ''.join([',%s:%s' % (simplejson.dumps(key), simplejson.dumps(value)) for key, value in (extra or {}).items()])
+    return '{"columns":%s,"npts":%d,"npts_full":%d,"data":{%s},"ticks_x":%s,"ticks_y":%s,"messages":%s%s}' % (simplejson.dumps(names),
+                                                                                                             npts, npts_full, data,
+                                                                                                             simplejson.dumps(ticks_x),
+                                                                                                             simplejson.dumps(ticks_y),
+                                                                                                             simplejson.dumps(messages or []),
+                                                                                                             extra_entries)
+
+def encode_binary(columns, fmt='f64'):
+    """
+        Returns plot data as packed little-endian floats, column after column
+        @param columns: list of numpy arrays of equal length
+        @param fmt: 'f32' or 'f64'
+    """
+    dtype = BINARY_FORMATS[fmt]
+    return ''.join([numpy.asarray(col, dtype=float).astype(dtype).tostring() for col in columns])
+
+def plot_response(request, columns, names, ticks_x=None, ticks_y=None, max_age=None, messages=None, npts_full=None, extra=None):
+    """
+        Returns an HTTP response with plot data in the format requested
+        @param request: HTTP request
+        @param columns: list of numpy arrays of equal length
+        @param names: list of column names
+        @param ticks_x: ticks of the x axis, or None
+        @param ticks_y: ticks of the y axis, or None
+        @param max_age: time, in seconds, the browser may keep the response,
+            or None if it must not be kept
+        @param messages: list of messages for the user, only sent in the JSON format
+        @param npts_full: number of points before decimation, if the curve was decimated
+        @param extra: dictionary of additional entries, only sent in the JSON format
+    """
+    fmt, precision = get_payload_options(request)
+    npts = len(columns[0]) if len(columns)>0 else 0
+    if npts_full is None:
+        npts_full = npts
+    if fmt == FORMAT_JSON:
+        response = HttpResponse(encode_json(columns, names, ticks_x, ticks_y, precision, messages, npts_full, extra),
+                                mimetype="application/json")
+    else:
+        response = HttpResponse(encode_binary(columns, fmt), mimetype="application/octet-stream")
+        response['X-Plot-Columns'] = ','.join(names)
+        response['X-Plot-Points'] = str(npts)
+        response['X-Plot-Points-Full'] = str(npts_full)
+        response['X-Plot-Ticks-X'] = simplejson.dumps(ticks_x)
+        response['X-Plot-Ticks-Y'] = simplejson.dumps(ticks_y)
+
+    if max_age is None:
+        response['Cache-Control'] = 'no-cache'
+    else:
+        response['Cache-Control'] = 'private, max-age=%d' % max_age
+    return response
+
+def get_etag(key, request):
+    """
+        Returns the strong ETag of the response for a given curve
+        in the format requested
+        @param key: key identifying the curve, as given to cached_plot_response
+        @param request: HTTP request
+    """
+    fmt, precision = get_payload_options(request)
+    if fmt != FORMAT_JSON:
+        precision = None
+    return '"%s"' % hashlib.sha1(repr((key, fmt, precision))).hexdigest()
+
+def _matches_etag(request, etag):
+    """
+        Returns True if the If-None-Match header of the request matches an ETag
+        @param request: HTTP request
+        @param etag: ETag of the response
+    """
+    header = request.META.get('HTTP_IF_NONE_MATCH', None)
+    if header is None:
+        return False
+    tags = [tag.strip() for tag in header.split(',')]
+    return etag in tags or '*' in tags
+
+def cached_plot_response(request, key, compute, names, max_age=None):
+    """
+        Returns an HTTP response with plot data for a given curve,
+        from the cache if possible. Requests with an ETag matching
+        the curve get a 304 response.
+        
+        @param request: HTTP request
+        @param key: tuple identifying the curve, including the version of its input
+            and the decimation options
+        @param compute: function returning the columns, the ticks of
+            the x and y axes, the list of messages for the curve and the
+            number of points before decimation
+        @param names: list of column names
+        @param max_age: time, in seconds, the browser may keep the response,
+            or None if it must revalidate it
+    """
+    etag = get_etag(key, request)
+    if _matches_etag(request, etag):
+        response = HttpResponseNotModified()
+    else:
+        payload = _payload_cache.get(key)
+        if payload is None:
+            payload = compute()
+            columns = payload[0]
+            _payload_cache.put(key, payload, sum([numpy.asarray(col).nbytes for col in columns]))
+        columns, ticks_x, ticks_y, messages, npts_full = payload
+        response = plot_response(request, columns, names, ticks_x, ticks_y, messages=messages, npts_full=npts_full)
+    
+    response['ETag'] = etag
+    if max_age is None:
+        response['Cache-Control'] = 'private, max-age=0, must-revalidate'
+    else:
+        response['Cache-Control'] = 'private, max-age=%d' % max_age
+    return response
+
+def get_cache_stats():
+    """
+        Returns the hit/miss statistics of the plot data cache
+    """
+    return _payload_cache.get_stats()
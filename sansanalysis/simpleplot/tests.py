@@ -2,20 +2,39 @@
 import unittest
 import hashlib
 import random
+import os
+import math
+import numpy
 
 # Import Django modules
 from django.contrib.auth.models import User
 from django.core.files import File
+from django.contrib.sessions.backends.db import SessionStore
+from django.utils import simplejson
 
 # Import SANS modules
 from sans.dataloader.data_info import Data1D
+from sans.pr.invertor import Invertor
 
 # Import application modules
-from sansanalysis.simpleplot.models import IqData, IqDataPoint, AnonymousSharedData, UserSharedData
+from sansanalysis.simpleplot.models import IqData, IqDataPoint, IqDataArrays, AnonymousSharedData, UserSharedData, PrInversion, PrOutput
+from sansanalysis.common.cache import LRUCache
+from sansanalysis.jobs.models import Job, DONE
+from sansanalysis.jobs import job_queue
 import manipulations.iqdata as iqdata
+import manipulations.sidecar as sidecar
+import manipulations.upload as upload
+import manipulations.prdata as prdata
+import view_util
+import calculations.decimate as decimate
+import calculations.pr_basis as pr_basis
+import calculations.invert_pr as invert_pr
+import plot_payload
 
 TESTUSER = hashlib.md5("SANSTESTUSER1").hexdigest()
 TESTFILE = "test_simpleplot_data.txt"
+PR_PARAMETERS = {'d_max': 160.0, 'n_terms': 10, 'alpha': 0.0001, 'has_bck': False,
+                 'q_min': None, 'q_max': None, 'slit_height': None, 'slit_width': None}
 #TESTFILE = hashlib.md5("sphere_80.txt").hexdigest()
 
 class iqdata_tests(unittest.TestCase):
@@ -67,6 +86,727 @@ class iqdata_tests(unittest.TestCase):
         self.assertEqual(data.__class__, Data1D)
         self.assertEqual(len(data.x), 99)
         
+    def test_fileloader_cache(self):
+        """
+            Check that a second load is served from the data cache
+        """
+        d = self._create_new_iqdata()
+        iqdata.FileDataLoader().load_file_data(d)
+        hits = iqdata.get_cache_stats()['hits']
+        data = iqdata.FileDataLoader().load_file_data(d)
+        self.assertEqual(iqdata.get_cache_stats()['hits'], hits+1)
+        self.assertEqual(len(data.x), 99)
+        
+        # Cached arrays are shared and should not be modified in place
+        self.assertFalse(data.y.flags.writeable)
+        
+        # Invalidating the data set should force a new read
+        self.assertTrue(iqdata.invalidate_cache(d)>0)
+        misses = iqdata.get_cache_stats()['misses']
+        iqdata.FileDataLoader().load_file_data(d)
+        self.assertEqual(iqdata.get_cache_stats()['misses'], misses+1)
+        
+    def test_sidecar(self):
+        """
+            Check that a parsed data set is read back from its sidecar file
+        """
+        d = self._create_new_iqdata()
+        data = iqdata.FileDataLoader().load_file_data(d)
+        self.assertTrue(os.path.exists(sidecar.get_sidecar_path(d.file.path)))
+        
+        # Drop the in-memory copy to force a read from disk
+        iqdata._data_cache.clear()
+        mapped = iqdata.FileDataLoader().load_file_data(d)
+        self.assertTrue(isinstance(mapped.x, numpy.memmap))
+        self.assertTrue(numpy.all(mapped.x==data.x))
+        self.assertTrue(numpy.all(mapped.y==data.y))
+        
+        # A sidecar older than its source file is ignored
+        os.utime(d.file.path, (0, 0))
+        self.assertEqual(sidecar.read_sidecar(d.file.path), None)
+        
+    def test_data_arrays(self):
+        """
+            Check that the data points are stored in a single row
+            and can be served without reading the data file
+        """
+        d = self._create_new_iqdata()
+        data = iqdata.FileDataLoader().load_file_data(d)
+        self.assertEqual(IqDataPoint.objects.filter(iq_data=d).count(), 0)
+        self.assertEqual(IqDataArrays.objects.filter(iq_data=d).count(), 1)
+        
+        stored = iqdata.load_data_arrays(d)
+        self.assertNotEqual(stored, None)
+        data_info, n_entries, report = stored
+        self.assertEqual(n_entries, 1)
+        self.assertEqual(report['npts'], 99)
+        self.assertTrue(numpy.all(data_info.x==data.x))
+        self.assertTrue(numpy.all(data_info.dy==data.dy))
+        
+        # Without the cache and sidecar, the DB copy is used. The data file
+        # is shared by all the data sets of the same content: it is only
+        # moved aside for the test
+        iqdata._data_cache.clear()
+        sidecar.remove_sidecar(d.file.path)
+        os.rename(d.file.path, d.file.path+'.moved')
+        try:
+            data = iqdata.FileDataLoader().load_file_data(d)
+            self.assertEqual(len(data.x), 99)
+        finally:
+            os.rename(d.file.path+'.moved', d.file.path)
+        
+    def test_multiple_entries(self):
+        """
+            Check that each data set of a multi-entry file can be loaded
+        """
+        data = open('simpleplot/test/two_entries.xml', 'r')
+        d = IqData()
+        d.owner = self.user.id
+        d.name  = TESTFILE
+        d.file.save("two_entries.xml", File(data))
+        
+        loader = iqdata.FileDataLoader()
+        first = loader.load_file_data(d)
+        self.assertEqual(loader.get_n_entries(), 2)
+        self.assertEqual(len(first.x), 10)
+        self.assertEqual(IqDataArrays.objects.filter(iq_data=d).count(), 2)
+        
+        # The second data set is served from its own sidecar
+        iqdata._data_cache.clear()
+        second = loader.load_file_data(d, 1)
+        self.assertEqual(len(second.x), 8)
+        self.assertTrue(isinstance(second.x, numpy.memmap))
+        self.assertEqual(iqdata.get_cache_stats()['entries'], 1)
+        
+        self.assertEqual(loader.load_file_data(d, 2), None)
+        self.assertTrue(loader.has_errors())
+        
+    def test_streamed_upload(self):
+        """
+            Check that uploaded content is hashed while written to disk
+        """
+        content = upload.stream_to_file(["0.1 1.0\n", "0.2 2.0\n"], "upload.txt", max_size=100)
+        self.assertEqual(content.size, 16)
+        self.assertEqual(content.content_hash, hashlib.sha256("0.1 1.0\n0.2 2.0\n").hexdigest())
+        
+        d = IqData()
+        d.owner = self.user.id
+        d.name  = TESTFILE
+        iqdata.save_data_file(d, "upload.txt", content)
+        self.assertEqual(IqData.objects.get(pk=d.id).content_hash, content.content_hash)
+        self.assertFalse(os.path.exists(content.path))
+        self.assertEqual(open(d.file.path).read(), "0.1 1.0\n0.2 2.0\n")
+        
+        # The size cap is enforced while streaming
+        self.assertRaises(upload.UploadTooLarge, upload.stream_to_file, ["0123456789"]*3, "upload.txt", 25)
+        
+    def test_content_addressed_storage(self):
+        """
+            Check that identical uploads share one stored file
+        """
+        content = "0.1 1.0\n0.2 2.0\n%g\n" % random.random()
+        first = iqdata.store_uploaded_file(self.user.id, "first.txt", upload.stream_to_file([content], "first.txt"))
+        second = iqdata.store_uploaded_file(self.user.id, "second.txt", upload.stream_to_file([content], "second.txt"))
+        self.assertEqual(first.file.name, second.file.name)
+        self.assertTrue(first.content_hash in first.file.name)
+        self.assertTrue(first.file.name.endswith('.txt'))
+        
+        storage = first.file.storage
+        self.assertEqual(storage.get_refcount(first.file.name), 2)
+        
+        # Replacing the content of one data set leaves the other one intact
+        name = first.file.name
+        first = iqdata.store_uploaded_file(self.user.id, "first.txt", upload.stream_to_file([content+"\n"], "first.txt"))
+        self.assertNotEqual(first.file.name, name)
+        self.assertEqual(storage.get_refcount(name), 1)
+        self.assertTrue(storage.exists(name))
+        
+        # The file is removed with its last reference
+        iqdata.release_data_file(storage, name)
+        self.assertFalse(storage.exists(name))
+        
+        # A file left in place, for instance by a concurrent save of the
+        # same content, is used rather than stored under another name
+        content = "0.1 1.0\n0.2 2.0\n%g\n" % random.random()
+        content_hash = hashlib.sha256(content).hexdigest()
+        name = os.path.join('iq_data', content_hash[:2], content_hash+'.txt')
+        if not os.path.isdir(os.path.dirname(storage.path(name))):
+            os.makedirs(os.path.dirname(storage.path(name)))
+        fd = open(storage.path(name), 'w')
+        fd.write(content)
+        fd.close()
+        third = iqdata.store_uploaded_file(self.user.id, "third.txt", upload.stream_to_file([content], "third.txt"))
+        self.assertEqual(third.file.name, name)
+        self.assertEqual(storage.get_refcount(name), 1)
+        
+        # Release the files stored by the test. The file of the second
+        # data set was already released above.
+        second.delete()
+        for d in [first, third]:
+            name = d.file.name
+            d.delete()
+            iqdata.release_data_file(storage, name)
+            self.assertFalse(storage.exists(name))
+        
+    def test_metadata(self):
+        """
+            Check that the summary of the data is stored at upload time
+        """
+        data = open('simpleplot/test/latex_smeared_slit.xml', 'rb')
+        content = upload.stream_to_file(upload.read_chunks(data), "latex_smeared_slit.xml")
+        data.close()
+        d = iqdata.store_uploaded_file(self.user.id, "latex_smeared_slit.xml", content)
+        
+        d = IqData.objects.get(pk=d.id)
+        self.assertTrue(d.has_metadata())
+        data_info = iqdata.FileDataLoader().load_file_data(d)
+        self.assertEqual(d.npts, len(data_info.x))
+        self.assertEqual(d.n_entries, 1)
+        self.assertEqual(d.q_min, min(data_info.x))
+        self.assertEqual(d.q_max, max(data_info.x))
+        self.assertTrue(d.has_dy)
+        self.assertTrue(d.has_dxl)
+        self.assertFalse(d.has_dx)
+        self.assertEqual(d.smearing, 'slit')
+        self.assertAlmostEqual(d.slit_height, 0.117)
+        
+    def test_sanitize_data(self):
+        """
+            Check that invalid entries are replaced in bulk
+        """
+        data = Data1D(x=[0.1, 0.2, 0.3, 0.4],
+                      y=[1.0, numpy.nan, 3.0, 4.0],
+                      dy=[0.1, 0.1, -0.3, numpy.nan])
+        report = iqdata.sanitize_data(data)
+        self.assertEqual(report['npts'], 4)
+        self.assertEqual(report['invalid_y'], 1)
+        self.assertEqual(report['negative_dy'], 1)
+        self.assertEqual(report['invalid_dy'], 1)
+        self.assertEqual(report['invalid_x'], 0)
+        self.assertEqual(list(data.y), [1.0, 0.0, 3.0, 4.0])
+        self.assertEqual(list(data.dy), [0.1, 1.0, 0.0, 0.0])
+        
+        # Non-numerical entries are treated as invalid
+        data = Data1D(x=[0.1, 'a'], y=[1.0, 2.0])
+        report = iqdata.sanitize_data(data)
+        self.assertEqual(report['invalid_x'], 1)
+        self.assertEqual(data.dy, None)
+        
+    def test_q_range(self):
+        """
+            Check that a Q range is served as views of the sorted data
+        """
+        data = Data1D(x=numpy.asarray([0.3, 0.1, 0.4, 0.2]),
+                      y=numpy.asarray([3.0, 1.0, 4.0, 2.0]),
+                      dy=numpy.asarray([0.3, 0.1, 0.4, 0.2]))
+        self.assertTrue(iqdata.sort_data(data))
+        self.assertEqual(list(data.x), [0.1, 0.2, 0.3, 0.4])
+        self.assertEqual(list(data.dy), [0.1, 0.2, 0.3, 0.4])
+        self.assertFalse(iqdata.sort_data(data))
+        
+        window = iqdata.slice_data(data, 0.2, 0.3)
+        self.assertEqual(list(window.x), [0.2, 0.3])
+        self.assertEqual(list(window.y), [2.0, 3.0])
+        self.assertTrue(window.y.base is data.y)
+        self.assertEqual(len(iqdata.slice_data(data, 0.5, None).x), 0)
+        
+        d = self._create_new_iqdata()
+        full = iqdata.FileDataLoader().load_file_data(d)
+        qmin, qmax = full.x[10], full.x[20]
+        window = iqdata.FileDataLoader().load_q_range(d, qmin, qmax)
+        self.assertEqual(len(window.x), 11)
+        self.assertEqual(window.x[0], qmin)
+        
+    def test_lru_eviction(self):
+        """
+            Check that the least recently used items are evicted first
+        """
+        cache = LRUCache(max_bytes=30)
+        cache.put('a', 1, 10)
+        cache.put('b', 2, 10)
+        cache.put('c', 3, 10)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('d', 4, 10)
+        self.assertFalse('b' in cache)
+        self.assertTrue('a' in cache)
+        self.assertEqual(cache.get_stats()['evictions'], 1)
+        self.assertEqual(cache.size, 30)
+        # Items larger than the cache are not stored
+        self.assertFalse(cache.put('e', 5, 40))
+        
+    def test_session_reference(self):
+        """
+            Check that only a reference to the data set is kept in the session
+        """
+        class _Request(object):
+            session = SessionStore()
+        request = _Request()
+        plot_data, errors = view_util.get_iq_data_dict(request, self.iq_data)
+        self.assertEqual(len(plot_data['x']), 99)
+        self.assertEqual(sorted(request.session['iq'].keys()), ['entry', 'iq_id', 'n_entries', 'version'])
+        self.assertEqual(request.session['iq']['version'], iqdata.get_data_version(self.iq_data))
+        self.assertTrue(len(request.session.encode(dict(request.session.items())))<1024)
+        
+    def test_plot_data(self):
+        """
+            Check the plot points for all scale combinations against a point-by-point computation
+        """
+        import math
+        x = numpy.array([0.01, 0.02, 0.03, 0.04, 0.05])
+        y = numpy.array([10.0, -1.0, 2.0, 0.0, 1.0])
+        dy = numpy.array([1.0, 0.5, 3.0, 0.1, -2.0])
+        plot_data = {'x':x, 'y':y, 'dy':dy}
+        
+        for scale_x in ['linear', 'log']:
+            for scale_y in ['linear', 'log']:
+                points, ticks_x, ticks_y = view_util.get_plot_data(plot_data, scale_x, scale_y)
+                expected = []
+                for i in range(len(x)):
+                    if (scale_x=='log' or scale_y=='log') and y[i]<=0:
+                        continue
+                    err_min, err_max = float(dy[i]), float(dy[i])
+                    if scale_y=='log':
+                        err_min = math.log(y[i])-math.log(y[i]-dy[i]) if y[i]-dy[i]>0 else math.log(y[i])
+                        err_max = math.log(y[i]+dy[i])-math.log(y[i]) if y[i]+dy[i]>0 else 0
+                    expected.append([math.log10(x[i]) if scale_x=='log' else float(x[i]),
+                                     math.log10(y[i]) if scale_y=='log' else float(y[i]),
+                                     0, err_min, err_max])
+                self.assertEqual(len(points), len(expected))
+                for p, e in zip(points, expected):
+                    self.assertEqual([type(v) for v in p], [type(v) for v in e])
+                    for v_p, v_e in zip(p, e):
+                        self.assertAlmostEqual(v_p, v_e, 12)
+                self.assertEqual(ticks_x is None, scale_x=='linear')
+                self.assertEqual(ticks_y is None, scale_y=='linear')
+        
+        # Without errors, the error columns are zeros
+        points, ticks_x, ticks_y = view_util.get_plot_data({'x':x, 'y':y, 'dy':None}, 'log', 'log')
+        self.assertEqual([p[2:] for p in points], [[0, 0, 0]]*3)
+        
+    def test_plot_payload(self):
+        """
+            Check the JSON and binary encodings of plot data
+        """
+        x = numpy.array([0.01, 0.02, 0.03])
+        y = numpy.array([1.0/3.0, numpy.nan, 2.0])
+        
+        payload = simplejson.loads(plot_payload.encode_json([x, y], plot_payload.CURVE_COLUMNS, precision=4))
+        self.assertEqual(payload['columns'], ['x', 'y'])
+        self.assertEqual(payload['npts'], 3)
+        self.assertEqual(payload['data']['x'], [0.01, 0.02, 0.03])
+        self.assertEqual(payload['data']['y'], [0.3333, None, 2.0])
+        self.assertEqual(payload['ticks_x'], None)
+        
+        for fmt, dtype in [('f32', '<f4'), ('f64', '<f8')]:
+            content = plot_payload.encode_binary([x, y], fmt)
+            self.assertEqual(len(content), 2*3*numpy.dtype(dtype).itemsize)
+            values = numpy.fromstring(content, dtype=dtype)
+            self.assertTrue(numpy.allclose(values[:3], x))
+            self.assertEqual(values[5], numpy.asarray(y[2], dtype=dtype))
+        
+        # Columns from view_util should give the same points as get_plot_data
+        plot_data = {'x':x, 'y':numpy.array([1.0, 2.0, 3.0]), 'dy':numpy.array([0.1, 0.2, 0.3])}
+        columns, is_set, ticks_x, ticks_y = view_util.get_plot_arrays(plot_data, 'log', 'log')
+        payload = simplejson.loads(plot_payload.encode_json(columns, plot_payload.PLOT_COLUMNS, ticks_x, ticks_y, precision=17))
+        points, ticks_x, ticks_y = view_util.get_plot_data(plot_data, 'log', 'log')
+        for i in range(len(points)):
+            self.assertEqual([payload['data'][c][i] for c in plot_payload.PLOT_COLUMNS], points[i])
+        self.assertEqual(str(payload['ticks_y']).replace("u'", "'"), ticks_y)
+        
+    def test_plot_payload_cache(self):
+        """
+            Check that cached curves are not computed again and that ETags are honored
+        """
+        class _Request(object):
+            def __init__(self, GET={}, META={}):
+                self.GET = GET
+                self.META = META
+        calls = []
+        def _compute():
+            calls.append(1)
+            return [numpy.array([1.0, 2.0]), numpy.array([3.0, 4.0])], None, None, [], 2
+        
+        key = ('test', random.random())
+        response = plot_payload.cached_plot_response(_Request(), key, _compute, plot_payload.CURVE_COLUMNS)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        response = plot_payload.cached_plot_response(_Request(), key, _compute, plot_payload.CURVE_COLUMNS)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(len(calls), 1)
+        
+        # Revalidation of an unchanged curve
+        response = plot_payload.cached_plot_response(_Request(META={'HTTP_IF_NONE_MATCH': etag}), key,
+                                                     _compute, plot_payload.CURVE_COLUMNS)
+        self.assertEqual(response.status_code, 304)
+        
+        # Each format has its own ETag
+        response = plot_payload.cached_plot_response(_Request(GET={'format': 'f32'}, META={'HTTP_IF_NONE_MATCH': etag}), key,
+                                                     _compute, plot_payload.CURVE_COLUMNS)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(len(calls), 1)
+        
+    def test_decimation(self):
+        """
+            Check that decimated curves keep their end points and extrema
+        """
+        x = numpy.linspace(0.001, 1.0, 10000)
+        y = numpy.sin(50*x)
+        y[4321] = 10.0
+        
+        for method in decimate.METHODS:
+            indices = decimate.decimate(x, y, 500, method)
+            self.assertTrue(len(indices)<=502)
+            self.assertEqual(indices[0], 0)
+            self.assertEqual(indices[-1], len(x)-1)
+            self.assertTrue(numpy.all(numpy.diff(indices)>0))
+            self.assertTrue(4321 in indices)
+        
+        # Short curves are not decimated
+        self.assertEqual(decimate.decimate(x[:100], y[:100], 500), None)
+        
+        # Error bars follow the selected points
+        plot_data = {'x':x, 'y':y+2.0, 'dy':0.1*x}
+        columns, is_set, ticks_x, ticks_y = view_util.get_plot_arrays(plot_data, 'linear', 'linear')
+        columns, is_set, n_full = view_util.decimate_plot_arrays(columns, is_set, 500)
+        self.assertEqual(n_full, 10000)
+        self.assertEqual(len(columns[0]), 500)
+        self.assertTrue(numpy.allclose(columns[3], 0.1*columns[0]))
+        
+    def test_pr_basis(self):
+        """
+            Check that the basis matrices give the same curves as the invertor
+        """
+        invertor = Invertor()
+        invertor.d_max = 160.0
+        out = numpy.array([1.2, -0.4, 0.3, 0.05, -0.02])
+        cov = numpy.diag([0.01, 0.02, 0.03, 0.04, 0.05])
+        
+        r = numpy.linspace(0, invertor.d_max, 31)
+        pr, pr_err = pr_basis.evaluate(pr_basis.get_basis('pr', r, invertor.d_max, len(out)), out, cov)
+        q = numpy.linspace(0.001, 0.5, 40)
+        iq, iq_err = pr_basis.evaluate(pr_basis.get_basis('iq', q, invertor.d_max, len(out)), out)
+        self.assertEqual(iq_err, None)
+        for i in range(len(r)):
+            self.assertAlmostEqual(pr[i], invertor.pr(out, r[i]), 6)
+        for i in range(len(q)):
+            self.assertAlmostEqual(iq[i], invertor.iq(out, q[i]), 6)
+        
+        # The uncertainty vanishes at both ends of the distribution
+        self.assertAlmostEqual(pr_err[0], 0.0, 6)
+        self.assertAlmostEqual(pr_err[-1], 0.0, 6)
+        self.assertTrue(numpy.all(pr_err[1:-1]>0))
+        
+        # The matrices are computed once for a given grid
+        stats = pr_basis.get_cache_stats()
+        pr_basis.get_basis('pr', r.copy(), invertor.d_max, len(out))
+        self.assertEqual(pr_basis.get_cache_stats()['hits'], stats['hits']+1)
+        
+    def test_pr_smeared_basis(self):
+        """
+            Check that the smeared basis gives the same I(q) as the invertor
+        """
+        invertor = Invertor()
+        invertor.d_max = 160.0
+        out = numpy.array([1.2, -0.4, 0.3, 0.05, -0.02])
+        q = numpy.linspace(0.001, 0.5, 40)
+        
+        for height, width in [(0.05, 0), (0, 0.01), (0.05, 0.01)]:
+            invertor.slit_height = height
+            invertor.slit_width = width
+            basis = pr_basis.get_basis('iq', q, invertor.d_max, len(out), slit_height=height, slit_width=width)
+            iq = pr_basis.evaluate(basis, out)[0]
+            for i in range(len(q)):
+                self.assertAlmostEqual(iq[i], invertor.iq_smeared(out, q[i]), 6)
+        
+        # The slit geometry is part of the cache key
+        unsmeared = pr_basis.get_basis('iq', q, invertor.d_max, len(out))
+        self.assertFalse(numpy.allclose(unsmeared, basis))
+        
+    def test_inversion_inputs(self):
+        """
+            Check the preparation of the invertor inputs and their reuse
+        """
+        x = numpy.asarray([-0.1, 0.0, 0.1, 0.2, 0.3, 0.4])
+        y = numpy.asarray([5.0, 5.0, 4.0, 1.0, 0.25, 0.04])
+        inputs = invert_pr.prepare_inputs(x, y, None, q_min=0.15, q_max=None)
+        self.assertEqual(list(inputs['x']), [0.2, 0.3, 0.4])
+        scale = 0.05*math.sqrt(1.0)
+        self.assertAlmostEqual(inputs['err'][1], scale*math.sqrt(0.25)+0.01)
+        self.assertEqual(len(inputs['messages']), 2)
+        
+        # Points with a Q that is not a number are sorted last and left out
+        x = numpy.asarray([0.1, 0.2, 0.3, numpy.nan, numpy.nan])
+        y = numpy.asarray([4.0, 1.0, 0.25, 1.0, 1.0])
+        inputs = invert_pr.prepare_inputs(x, y, numpy.ones(5))
+        self.assertEqual(list(inputs['x']), [0.1, 0.2, 0.3])
+        self.assertEqual(len(inputs['err']), 3)
+        self.assertEqual(inputs['messages'], ["2 q-values were skipped because they were not numbers."])
+        
+        # Points with no error are rejected, unless they are outside the Q range
+        dy = numpy.asarray([1.0, 0.0, 1.0, 1.0, 1.0])
+        self.assertRaises(RuntimeError, invert_pr.prepare_inputs, x, y, dy)
+        inputs = invert_pr.prepare_inputs(x, y, dy, q_min=0.25)
+        self.assertEqual(list(inputs['err']), [1.0])
+        
+        # Inputs are shared by all calculations on the same data and Q range
+        d = self._create_new_iqdata()
+        data_info = iqdata.FileDataLoader().load_file_data(d)
+        inputs = prdata.get_inversion_inputs(d, data_info, None, 0.2)
+        self.assertTrue(prdata.get_inversion_inputs(d, data_info, None, 0.2) is inputs)
+        self.assertFalse(prdata.get_inversion_inputs(d, data_info, None, 0.1) is inputs)
+        self.assertTrue(numpy.all(inputs['err']==1.0))
+        self.assertEqual(data_info.dy, None)
+        
+    def test_dmax_scan(self):
+        """
+            Check that a D_max scan gives the same outputs in a process pool
+        """
+        d = self._create_new_iqdata()
+        data_info = iqdata.FileDataLoader().load_file_data(d)
+        inputs = prdata.get_inversion_inputs(d, data_info)
+        d_values = invert_pr.get_dmax_values(160.0, npts=6)
+        self.assertEqual(d_values[0], 120.0)
+        self.assertEqual(d_values[-1], 200.0)
+        
+        serial = list(invert_pr.scan_dmax(inputs, PR_PARAMETERS, d_values, processes=1))
+        parallel = list(invert_pr.scan_dmax(inputs, PR_PARAMETERS, d_values, processes=2))
+        parallel.sort(key=lambda item: item['d_max'])
+        self.assertEqual([item['d_max'] for item in serial], d_values)
+        for i in range(len(d_values)):
+            self.assertAlmostEqual(serial[i]['chi2'], parallel[i]['chi2'])
+            self.assertAlmostEqual(serial[i]['rg'], parallel[i]['rg'])
+        
+    def test_dmax_scan_job(self):
+        """
+            Check that a D_max scan executed as a job stores its outputs
+        """
+        d = self._create_new_iqdata()
+        job = job_queue.submit('explore_dmax', self.user.id, {'iq_id': d.id,
+                                                              'parameters': PR_PARAMETERS,
+                                                              'min': 100.0, 'max': 200.0, 'npts': 5})
+        self.assertEqual(job_queue.run_pending(kinds=['explore_dmax'], max_jobs=1), 1)
+        job = Job.objects.get(pk=job.id)
+        self.assertEqual(job.status, DONE)
+        result = job.get_result()
+        self.assertEqual(result['iq_id'], d.id)
+        self.assertEqual([item['d_max'] for item in result['points']], [100.0, 125.0, 150.0, 175.0, 200.0])
+        
+        # A scan requested again is served by the same job, even once it is done
+        job_parameters = {'iq_id': str(d.id), 'parameters': PR_PARAMETERS, 'min': 100.0, 'max': 200.0, 'npts': 3}
+        job = prdata.submit_analysis_job('explore_dmax', d, job_parameters, self.user.id)
+        self.assertEqual(prdata.submit_analysis_job('explore_dmax', d, job_parameters, self.user.id).id, job.id)
+        self.assertEqual(job_queue.run_pending(kinds=['explore_dmax'], max_jobs=1), 1)
+        self.assertEqual(prdata.submit_analysis_job('explore_dmax', d, job_parameters, self.user.id).id, job.id)
+        self.assertEqual(Job.objects.filter(kind='explore_dmax', owner=self.user.id, fingerprint=job.fingerprint).count(), 1)
+        
+    def test_inversion_job(self):
+        """
+            Check that a P(r) inversion executed as a job stores its outputs
+        """
+        d = self._create_new_iqdata()
+        job = job_queue.submit('invert_pr', self.user.id, {'iq_id': d.id, 'parameters': PR_PARAMETERS})
+        self.assertEqual(job_queue.run_pending(kinds=['invert_pr'], max_jobs=1), 1)
+        job = Job.objects.get(pk=job.id)
+        self.assertEqual(job.status, DONE)
+        pr = PrInversion.objects.get(pk=job.get_result()['pr_id'])
+        self.assertEqual(pr.iq_data.id, d.id)
+        self.assertEqual(pr.user_id, self.user.id)
+        self.assertNotEqual(prdata.get_pr_output_id(pr.id), None)
+        
+        # Progress is reported before and after the inversion, which
+        # keeps the job from being taken for an abandoned one
+        progress = []
+        prdata.PrInvertor()(d.id, PR_PARAMETERS, self.user.id, callback=progress.append)
+        self.assertEqual(progress, [0.25, 0.75])
+        
+        # Cancelled inversions are not computed
+        job = job_queue.submit('invert_pr', self.user.id, {'iq_id': d.id, 'parameters': PR_PARAMETERS})
+        job_queue.cancel(job)
+        self.assertEqual(job_queue.run_pending(kinds=['invert_pr'], max_jobs=1), 0)
+        
+    def test_inversion_reuse(self):
+        """
+            Check that identical inversion requests share their result
+        """
+        d = self._create_new_iqdata()
+        fingerprint = prdata.get_fingerprint(d, PR_PARAMETERS)
+        parameters = dict(PR_PARAMETERS)
+        parameters['d_max'] = 160
+        self.assertEqual(prdata.get_fingerprint(d, parameters), fingerprint)
+        parameters['alpha'] = 0.001
+        self.assertNotEqual(prdata.get_fingerprint(d, parameters), fingerprint)
+        
+        # A second request attaches to the queued job
+        pr_id, job = prdata.submit_inversion(d, PR_PARAMETERS, self.user.id)
+        self.assertEqual(pr_id, None)
+        self.assertEqual(prdata.submit_inversion(d, PR_PARAMETERS, self.user.id)[1].id, job.id)
+        
+        # Once computed, the result is returned without a new job
+        self.assertEqual(job_queue.run_pending(kinds=['invert_pr'], max_jobs=1), 1)
+        result = Job.objects.get(pk=job.id).get_result()
+        self.assertEqual(prdata.submit_inversion(d, PR_PARAMETERS, self.user.id), (result['pr_id'], None))
+        self.assertEqual(PrInversion.objects.filter(fingerprint=fingerprint, iq_data=d).count(), 1)
+        
+        # An output without coefficients is not a complete inversion
+        incomplete = PrInversion(iq_data=d, user_id=self.user.id, fingerprint=fingerprint, has_bck=False,
+                                 d_max=160.0, n_terms=10, alpha=0.0001, slit_height=0, slit_width=0)
+        incomplete.save()
+        PrOutput(inversion=incomplete, chi2=0, rg=0, bck=0, iq_zero=0, osc=0, pos_frac=0, pos_frac_1sigma=0).save()
+        self.assertEqual(prdata.find_inversion(d, self.user.id, fingerprint), result['pr_id'])
+        
+    def test_dmax_scan_cache(self):
+        """
+            Check that a D_max scan gives all the outputs and is computed once
+        """
+        d = self._create_new_iqdata()
+        self.assertEqual(prdata.get_cached_scan(d, PR_PARAMETERS, 100.0, 200.0, 3), None)
+        result = prdata.scan_dmax(d, PR_PARAMETERS, 100.0, 200.0, 3)
+        self.assertEqual(len(result['points']), 3)
+        for name in plot_payload.SCAN_COLUMNS[1:]:
+            self.assertTrue(result['points'][0].has_key(name))
+        
+        self.assertTrue(prdata.get_cached_scan(d, PR_PARAMETERS, 100.0, 200.0, 3) is result)
+        self.assertTrue(prdata.scan_dmax(d, PR_PARAMETERS, 100.0, 200.0, 3) is result)
+        
+        # Other inversion parameters give another scan
+        parameters = dict(PR_PARAMETERS)
+        parameters['alpha'] = 0.01
+        self.assertEqual(prdata.get_cached_scan(d, parameters, 100.0, 200.0, 3), None)
+        
+    def test_cached_inversion(self):
+        """
+            Check that the inversion from the cached basis matrices
+            gives the same outputs as the invertor
+        """
+        d = self._create_new_iqdata()
+        data_info = iqdata.FileDataLoader().load_file_data(d)
+        inputs = prdata.get_inversion_inputs(d, data_info)
+        for has_bck in [False, True]:
+            parameters = dict(PR_PARAMETERS)
+            parameters['has_bck'] = has_bck
+            calculation = invert_pr.PrCalculation(parameters)
+            calculation._setup_inversion(None, inputs)
+            out, cov = calculation.invert(inputs)
+            outputs = calculation.get_outputs(out, cov)
+            
+            expected = invert_pr.PrCalculation(parameters)
+            expected._setup_inversion(None, inputs)
+            expected_out, expected_cov = expected.invertor.invert(expected.invertor.nfunc)
+            self.assertEqual(out.shape, expected_out.shape)
+            self.assertEqual(cov.shape, expected_cov.shape)
+            self.assertTrue(out.flags['C_CONTIGUOUS'] and cov.flags['C_CONTIGUOUS'])
+            self.assertTrue(numpy.allclose(out, expected_out, rtol=1e-5))
+            self.assertTrue(numpy.allclose(cov, expected_cov, rtol=1e-4))
+            self.assertAlmostEqual(outputs['chi2']/expected.invertor.chi2, 1.0, 5)
+            self.assertAlmostEqual(outputs['rg'], expected.invertor.rg(expected_out), 4)
+        
+        # The I(q) basis of the data is computed once
+        stats = pr_basis.get_cache_stats()
+        calculation.invert(inputs)
+        self.assertTrue(pr_basis.get_cache_stats()['hits']>stats['hits'])
+        self.assertEqual(pr_basis.get_cache_stats()['misses'], stats['misses'])
+        
+    def test_quality_map(self):
+        """
+            Check that a quality map gives the same outputs in a process
+            pool, skips poor fits and is cached
+        """
+        d = self._create_new_iqdata()
+        data_info = iqdata.FileDataLoader().load_file_data(d)
+        inputs = prdata.get_inversion_inputs(d, data_info)
+        d_values = invert_pr.get_dmax_values(160.0, npts=4)
+        alphas = invert_pr.get_alpha_values(1e-6, 1e6, 7)
+        
+        serial = list(invert_pr.map_dmax_alpha(inputs, PR_PARAMETERS, d_values, alphas, processes=1))
+        serial_chi2 = [row['chi2'] for row in serial]
+        parallel = list(invert_pr.map_dmax_alpha(inputs, PR_PARAMETERS, d_values, alphas, processes=2))
+        parallel.sort(key=lambda item: item['d_max'])
+        for i in range(len(d_values)):
+            self.assertEqual(serial[i]['rg'], parallel[i]['rg'])
+        
+        # The chi2 of a cell matches a single inversion
+        parameters = dict(PR_PARAMETERS)
+        parameters['alpha'] = alphas[2]
+        calculation = invert_pr.PrCalculation(parameters)
+        calculation.invertor.d_max = d_values[1]
+        calculation.invert(calculation._setup_inversion(None, inputs))
+        self.assertAlmostEqual(serial[1]['chi2'][2]/calculation.invertor.chi2, 1.0, 6)
+        
+        # Cells with a much larger chi2 than the best fit of their D_max are skipped
+        skipped = list(invert_pr.map_dmax_alpha(inputs, PR_PARAMETERS, d_values, alphas, max_chi2_ratio=10.0))
+        self.assertTrue(skipped[0]['skipped']>0)
+        self.assertEqual(skipped[0]['rg'][-1], None)
+        self.assertEqual(skipped[0]['chi2'], serial[0]['chi2'])
+        
+        # The outputs of the cells that were not skipped are all computed
+        for row in serial+skipped:
+            self.assertFalse(row.has_key('error'))
+            n_cells = len(alphas)-row['skipped']
+            for name in ['osc', 'pos_frac', 'rg']:
+                self.assertTrue(numpy.all(numpy.isfinite(numpy.asarray(row[name][:n_cells], dtype=float))))
+        
+        result = prdata.quality_map(d, PR_PARAMETERS, d_values, alphas)
+        self.assertEqual(len(result['chi2']), len(d_values))
+        self.assertEqual(len(result['chi2'][0]), len(alphas))
+        self.assertTrue(prdata.quality_map(d, PR_PARAMETERS, d_values, alphas) is result)
+        
+        # Maps are computed by a job, and cached when the job is done
+        d_values = [float(v) for v in d_values]
+        alphas = [float(v) for v in alphas[:3]]
+        job = job_queue.submit('pr_map', self.user.id, {'iq_id': d.id,
+                                                        'parameters': PR_PARAMETERS,
+                                                        'd_values': d_values,
+                                                        'alphas': alphas})
+        self.assertEqual(job_queue.run_pending(kinds=['pr_map'], max_jobs=1), 1)
+        job = Job.objects.get(pk=job.id)
+        self.assertEqual(job.status, DONE)
+        self.assertEqual(job.progress, 1.0)
+        result = job.get_result()
+        self.assertEqual(result['iq_id'], d.id)
+        self.assertTrue(numpy.allclose(result['chi2'], [row[:3] for row in serial_chi2]))
+        prdata._map_cache.clear()
+        self.assertEqual(prdata.get_cached_map(d, PR_PARAMETERS, d_values, alphas), None)
+        prdata.cache_map(d, PR_PARAMETERS, d_values, alphas, result)
+        self.assertEqual(prdata.get_cached_map(d, PR_PARAMETERS, d_values, alphas)['rg'], result['rg'])
+        
+    def test_regularization_path(self):
+        """
+            Check that the regularization path gives the least-squares
+            solution for each alpha and that its factorization is cached
+        """
+        d = self._create_new_iqdata()
+        data_info = iqdata.FileDataLoader().load_file_data(d)
+        inputs = prdata.get_inversion_inputs(d, data_info)
+        parameters = dict(PR_PARAMETERS)
+        parameters['has_bck'] = True
+        path = invert_pr.PrCalculation(parameters).get_regularization_path(data_info, inputs)
+        alphas = invert_pr.get_alpha_values(1e-6, 1e2, 9)
+        solutions = path.solve(alphas)
+        
+        # Solve the stacked system directly for one alpha
+        weights = 1.0/inputs['err']
+        design = pr_basis.get_basis('iq', inputs['x'], 160.0, 10)*weights[:,numpy.newaxis]
+        design = numpy.hstack([weights[:,numpy.newaxis], design])
+        r = 160.0/20*numpy.arange(20)
+        reg = numpy.hstack([numpy.zeros([20, 1]), 160.0/20*pr_basis.get_basis('pr_reg', r, 160.0, 10)])
+        stacked = numpy.vstack([design, math.sqrt(alphas[4])*reg])
+        b = numpy.concatenate([inputs['y']*weights, numpy.zeros(20)])
+        coeff = numpy.linalg.lstsq(stacked, b)[0]
+        self.assertTrue(numpy.allclose(solutions['bck'][4], coeff[0], rtol=1e-6))
+        self.assertTrue(numpy.allclose(solutions['coeff'][4], coeff[1:], rtol=1e-6))
+        
+        # The fit gets worse and the solution smoother as alpha increases
+        self.assertTrue(numpy.all(numpy.diff(solutions['residual'])>=0))
+        self.assertTrue(numpy.all(numpy.diff(solutions['reg_norm'])<=0))
+        
+        result = prdata.regularization_path(d, parameters, alphas, npts=31)
+        self.assertEqual(result['pr'].shape, (9, 31))
+        self.assertTrue(result['alpha_gcv'] in alphas)
+        stats = prdata._path_cache.get_stats()
+        prdata.regularization_path(d, parameters, alphas[:3])
+        self.assertEqual(prdata._path_cache.get_stats()['hits'], stats['hits']+1)
+        
     def test_shared_key(self):
         """
             Check that we can get and generate a shared key 
@@ -12,7 +12,13 @@ urlpatterns = patterns('sansanalysis.simpleplot.views',
     (r'^(?P<iq_id>\d+)/details/$', 'data_details'),
     (r'^dashboard/$', 'select_data'),
     (r'^(?P<iq_id>\d+)/pr_estimate/$', 'get_estimates'),
-    (r'^(?P<iq_id>\d+)/explore_pr/$', 'explore_dmax'),
+    (r'^(?P<iq_id>\d+)/explore_pr/data/$', 'explore_dmax_data'),
+    (r'^(?P<iq_id>\d+)/explore_pr/submit/$', 'explore_dmax_submit'),
+    (r'^(?P<iq_id>\d+)/pr_path/$', 'pr_path_data'),
+    (r'^(?P<iq_id>\d+)/pr_map/$', 'pr_map_data'),
+    (r'^(?P<iq_id>\d+)/pr_map/submit/$', 'pr_map_submit'),
+    (r'^(?P<iq_id>\d+)/data/$', 'iq_plot_data'),
+    (r'^(?P<iq_id>\d+)/invert/(?P<pr_id>\d+)/data/$', 'pr_plot_data'),
     (r'^(?P<iq_id>\d+)/share/$', 'share_data'),
     (r'^share/(?P<key>\w+)/$', 'access_shared_data'),
     (r'^share/(?P<key>\w+)/store$', 'store_data'),
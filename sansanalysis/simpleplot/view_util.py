@@ -1,5 +1,6 @@
 # Python imports
-import sys, math
+import sys, math, urllib
+import numpy
 
 # Django imports
 from django.core.urlresolvers import reverse
@@ -17,6 +18,7 @@ import sansanalysis.settings
 # Data manipulations
 import manipulations.iqdata
 import manipulations.prdata
+import calculations.decimate
 
 DATA_SCALE_X_QSTRING = 'scale_x'
 DATA_SCALE_Y_QSTRING = 'scale_y'
@@ -422,63 +424,106 @@ class ModelFitSorter(BaseSorter):
 
 
 
-def get_plot_data(plot_data, scale_x='linear', scale_y='linear'):
+def _as_column(values, is_set=None):
     """
-        Get the information needed to plot I(q)
+        Returns an array as a list of Python numbers.
+        Entries that are not set are returned as the integer 0,
+        which is how missing error bars are sent to the plots.
+        
+        @param values: numpy array
+        @param is_set: boolean array, or None if all entries are set
+    """
+    if is_set is None or is_set.all():
+        return values.tolist()
+    if not is_set.any():
+        return [0]*len(values)
+    return [v if s else 0 for v, s in zip(values.tolist(), is_set.tolist())]
+
+def _get_ticks(values, axis, protect=False):
+    """
+        Returns the major ticks of a log axis as a list
+        of [log10(value), label] pairs
+        
+        @param values: numpy array of the values along the axis
+        @param axis: name of the axis, for error reporting
+        @param protect: if True, return a default range when no value is positive
+    """
+    _ticks = []
+    try:
+        y_raw = values[values>0]
+
+        if protect and len(y_raw)==0:
+            return [-0.1,0.1]
+        
+        min_y = int(math.floor(math.log10(min(y_raw))))
+        max_y = int(math.ceil(math.log10(max(y_raw))))
+        if max_y==min_y:
+            max_y = min_y + 1
+        n_ticks = int(math.ceil((max_y-min_y)/5.0))
+        for i in range(min_y, max_y, n_ticks):
+            value = 1.0+i*1.0
+            _ticks.append([value, "%g" % math.pow(10,value)])
+    except:
+        # Log the error and raise for the view to respond with an error page
+        error_msg = "Error scaling %s data\n%s" % (axis, sys.exc_value)
+        store_error(user=None, url=None, text=error_msg, method='view_util.get_plot_data', build=sansanalysis.settings.APP_VERSION)
+        raise
+                           
+    return _ticks
+
+def get_plot_arrays(plot_data, scale_x='linear', scale_y='linear'):
+    """
+        Get the columns needed to plot a distribution
+        
+        The columns are x, y, dx (always 0), and the lower and upper
+        error bars on y. x and y are transformed to log10 for log scales
+        and points with y<=0 are left out when either scale is log.
+        Error bars on a log scale are the natural-log distances
+        between y and y-dy, and between y+dy and y.
         
+        @param plot_data: dictionary with 'x', 'y' and 'dy' arrays
+        @param scale_x: 'linear' or 'log'
+        @param scale_y: 'linear' or 'log'
+        @return: list of column arrays, list of boolean arrays telling
+            which entries of each column are defined, and the ticks of the
+            x and y axes as lists (None for linear axes)
     """
-    # Check that a data set is available
-    # Get the data information to be displayed
-    iq_data = []
     ticks_y = None
     ticks_x = None
     
-    if plot_data is None:
-        return iq_data, ticks_x, ticks_y
-
-    def _get_ticks(axis, protect=False):
-        _ticks = []
-        try:
-            y_raw = [ y for y in plot_data[axis] if y>0 ]
-
-            if protect and len(y_raw)==0:
-                return str([-0.1,0.1])
-            
-            min_y = int(math.floor(math.log10(min(y_raw))))
-            max_y = int(math.ceil(math.log10(max(y_raw))))
-            if max_y==min_y:
-                max_y = min_y + 1
-            n_ticks = int(math.ceil((max_y-min_y)/5.0))
-            for i in range(min_y, max_y, n_ticks):
-                value = 1.0+i*1.0
-                _ticks.append([value, "%g" % math.pow(10,value)])
-        except:
-            # Log the error and raise for the view to respond with an error page
-            error_msg = "Error scaling %s data\n%s" % (axis, sys.exc_value)
-            store_error(user=None, url=None, text=error_msg, method='view_util.get_plot_data', build=sansanalysis.settings.APP_VERSION)
-            raise
-                               
-        return str(_ticks)
+    if plot_data is None or not (scale_x in ['linear', 'log'] and scale_y in ['linear', 'log']):
+        columns = [numpy.zeros(0) for i in range(5)]
+        return columns, [numpy.zeros(0, dtype=bool) for c in columns], ticks_x, ticks_y
 
+    x = numpy.asarray(plot_data['x'], dtype=float)
+    y = numpy.asarray(plot_data['y'], dtype=float)
+    n_points = len(x)
 
     # Read the requested data, and check it.
+    err_min = numpy.zeros(n_points)
+    err_max = numpy.zeros(n_points)
+    min_is_set = numpy.zeros(n_points, dtype=bool)
+    max_is_set = numpy.zeros(n_points, dtype=bool)
     try:
-        err_min = [0]*len(plot_data['x'])
-        err_max = [0]*len(plot_data['x'])        
-        if plot_data['dy'] is not None and len(plot_data['x']) == len(plot_data['dy']):
-            for i in range(len(plot_data['x'])):
-                if scale_y=='linear':
-                    err_min[i] = plot_data['dy'][i]
-                    err_max[i] = plot_data['dy'][i]
-                elif scale_y=='log':
-                    value = float(plot_data['y'][i])
-                    if value>0:
-                        delta = float(plot_data['dy'][i])
-                        value_min = value-delta
-                        value_max = value+delta
-                        if value_min>0: err_min[i] = math.log(value)-math.log(value_min)
-                        else: err_min[i] = math.log(value)
-                        if value_max>0: err_max[i] = math.log(value_max)-math.log(value)
+        if plot_data['dy'] is not None and n_points == len(plot_data['dy']):
+            dy = numpy.asarray(plot_data['dy'], dtype=float)
+            if scale_y=='linear':
+                err_min = dy
+                err_max = dy
+                min_is_set[:] = True
+                max_is_set[:] = True
+            elif scale_y=='log':
+                positive = y>0
+                value_min = y-dy
+                value_max = y+dy
+                with numpy.errstate(divide='ignore', invalid='ignore'):
+                    log_y = numpy.log(numpy.where(positive, y, 1.0))
+                    log_min = numpy.log(numpy.where(value_min>0, value_min, 1.0))
+                    log_max = numpy.log(numpy.where(value_max>0, value_max, 1.0))
+                err_min = numpy.where(value_min>0, log_y-log_min, log_y)
+                err_max = log_max-log_y
+                min_is_set = positive
+                max_is_set = positive & (value_max>0)
     except:
         # Log the error and raise for the view to respond with an error page
         error_msg = "Error processing error bars\n%s" % sys.exc_value
@@ -486,21 +531,21 @@ def get_plot_data(plot_data, scale_x='linear', scale_y='linear'):
         
         
     try:                    
-        if scale_x=='linear' and scale_y=='linear':            
-            iq_data = [ [plot_data['x'][i], plot_data['y'][i], 0, err_min[i], err_max[i] ] for i in range(len(plot_data['x'])) ]
-        
-        elif scale_x=='linear' and scale_y=='log':
-            iq_data = [ [plot_data['x'][i], math.log10(float(plot_data['y'][i])), 0, err_min[i], err_max[i] ] for i in range(len(plot_data['x'])) if float(plot_data['y'][i])>0 ]
-            ticks_y = _get_ticks('y', protect=True)
+        # Only positive values are shown when either axis is on a log scale
+        if scale_x=='log' or scale_y=='log':
+            mask = y>0
+            x, y = x[mask], y[mask]
+            err_min, err_max = err_min[mask], err_max[mask]
+            min_is_set, max_is_set = min_is_set[mask], max_is_set[mask]
         
-        elif scale_x=='log' and scale_y=='linear':
-            iq_data = [ [math.log10(float(plot_data['x'][i])), plot_data['y'][i], 0, err_min[i], err_max[i] ] for i in range(len(plot_data['x'])) if float(plot_data['y'][i])>0 ]
-            ticks_x = _get_ticks('x')
-        
-        elif scale_x=='log' and scale_y=='log':
-            iq_data = [ [math.log10(float(plot_data['x'][i])), math.log10(float(plot_data['y'][i])), 0, err_min[i], err_max[i] ] for i in range(len(plot_data['x'])) if float(plot_data['y'][i])>0 ]
-            ticks_y = _get_ticks('y', protect=True)
-            ticks_x = _get_ticks('x')
+        if scale_x=='log':
+            if (x<=0).any():
+                raise ValueError, "math domain error"
+            ticks_x = _get_ticks(numpy.asarray(plot_data['x'], dtype=float), 'x')
+            x = numpy.log10(x)
+        if scale_y=='log':
+            ticks_y = _get_ticks(numpy.asarray(plot_data['y'], dtype=float), 'y', protect=True)
+            y = numpy.log10(y)
 
     except:
         # Log the error and raise for the view to respond with an error page
@@ -508,62 +553,143 @@ def get_plot_data(plot_data, scale_x='linear', scale_y='linear'):
         store_error(user=None, url=None, text=error_msg, method='view_util.get_plot_data', build=sansanalysis.settings.APP_VERSION)
         raise
 
+    columns = [x, y, numpy.zeros(len(x)), err_min, err_max]
+    is_set = [None, None, numpy.zeros(len(x), dtype=bool), min_is_set, max_is_set]
+    return columns, is_set, ticks_x, ticks_y
+
+def decimate_plot_arrays(columns, is_set, max_points=None, method=calculations.decimate.LTTB):
+    """
+        Reduce the number of points of the columns returned by get_plot_arrays.
+        The points are selected on the transformed x and y columns, so that
+        the shape of the curve is preserved in the scales it is shown in.
+        
+        @param columns: list of column arrays
+        @param is_set: list of boolean arrays, or None, for each column
+        @param max_points: maximum number of points, or None to keep all points
+        @param method: decimation method, see calculations.decimate
+        @return: reduced columns and boolean arrays, and the number of points before reduction
+    """
+    n_full = len(columns[0])
+    indices = calculations.decimate.decimate(columns[0], columns[1], max_points, method)
+    if indices is None:
+        return columns, is_set, n_full
+    columns = [c[indices] for c in columns]
+    is_set = [s[indices] if s is not None else None for s in is_set]
+    return columns, is_set, n_full
+
+def get_plot_data(plot_data, scale_x='linear', scale_y='linear', max_points=None, method=calculations.decimate.LTTB):
+    """
+        Get the information needed to plot I(q)
+        
+        The result is a list of [x, y, 0, err_min, err_max] points,
+        as computed by get_plot_arrays, and the ticks as strings
+        that can be inserted in a page.
+        
+        @param plot_data: dictionary with 'x', 'y' and 'dy' arrays
+        @param scale_x: 'linear' or 'log'
+        @param scale_y: 'linear' or 'log'
+        @param max_points: maximum number of points, or None to keep all points
+        @param method: decimation method, see calculations.decimate
+    """
+    columns, is_set, ticks_x, ticks_y = get_plot_arrays(plot_data, scale_x, scale_y)
+    columns, is_set, n_full = decimate_plot_arrays(columns, is_set, max_points, method)
+    
+    iq_data = map(list, zip(*[_as_column(c, s) for c, s in zip(columns, is_set)]))
+    if ticks_x is not None:
+        ticks_x = str(ticks_x)
+    if ticks_y is not None:
+        ticks_y = str(ticks_y)
     return iq_data, ticks_x, ticks_y
 
-def get_iq_data_dict(request, iq):
-    session_iq = request.session.get('iq', default=None)
+def get_iq_data_dict(request, iq, entry=0):
+    """
+        Returns the data points of a data set.
+        
+        The arrays are served by the data loader, which keeps recently
+        used data sets in a server-side cache. Only a reference to the
+        data set is kept in the session, so that the session stays small
+        whatever the size of the data.
+        
+        @param iq: IqData object
+        @param entry: index of the data set within the data file
+    """
+    loader = manipulations.iqdata.FileDataLoader()
+    data_info = loader.load_file_data(iq, entry)
+    if data_info is None:
+        error_msg = "Could not read file [iq_id=%s]" % str(iq.id)
+        store_error(user=None, url=None, text=error_msg, method='view_util.get_plottable_iq', build=sansanalysis.settings.APP_VERSION)
+        raise RuntimeError, "Data loader could not read the data file [ID=%s]." % str(iq.id)
     
     # Errors not fully implemented
     errors = []
+    if loader.has_errors():
+        errors.extend(loader.get_errors())
     
-    if session_iq is None or \
-        (not session_iq.has_key('iq_id')) or \
-        session_iq['iq_id']!=iq.id:
-        
-        #errors.append("Data was loaded [remove this]")
-        # Load data from file
-        loader = manipulations.iqdata.FileDataLoader()
-        data_info = loader.load_file_data(iq)
-        if data_info is None:
-            error_msg = "Could not read file [iq_id=%s]" % str(iq.id)
-            store_error(user=None, url=None, text=error_msg, method='view_util.get_plottable_iq', build=sansanalysis.settings.APP_VERSION)
-            raise RuntimeError, "Data loader could not read the data file [ID=%s]." % str(iq.id)
-        
-        # Check for loading errors
-        if loader.has_errors():
-            errors.extend(loader.get_errors())
-    
-        # Store session data
-        session_iq = {'iq_id':iq.id,
-                      'x':data_info.x,
-                      'y':data_info.y,
-                      'dy':data_info.dy}
+    # Only update the session when the reference changes, to avoid
+    # saving the session on every request
+    session_iq = {'iq_id':iq.id,
+                  'version':manipulations.iqdata.get_data_version(iq),
+                  'entry':entry,
+                  'n_entries':loader.get_n_entries()}
+    if request.session.get('iq', default=None) != session_iq:
         request.session['iq'] = session_iq
     
-    return session_iq, errors
+    plot_data = {'x':data_info.x,
+                 'y':data_info.y,
+                 'dy':data_info.dy}
+    return plot_data, errors
 
 
 def get_qrange_iq(request, iq):
     """
-        Return the Q range for a given data set
-        
-        #TODO: this should be a DB query. We should have this stored as meta data.
+        Return the Q range for a given data set.
+        The range is read from the metadata stored at upload time, if available.
     """
-    session_iq, errors = get_iq_data_dict(request, iq)
-    return min(session_iq['x']), max(session_iq['x'])
+    if iq.has_metadata():
+        return iq.q_min, iq.q_max
+    plot_data, errors = get_iq_data_dict(request, iq)
+    return min(plot_data['x']), max(plot_data['x'])
 
 
 
-def get_plottable_iq(request, iq):
+def get_plottable_iq(request, iq, entry=0):
     
-    session_iq, errors = get_iq_data_dict(request, iq)
+    plot_data, errors = get_iq_data_dict(request, iq, entry)
     
     scale_x = request.session.get(DATA_SCALE_X_QSTRING, default='linear')
     scale_y = request.session.get(DATA_SCALE_Y_QSTRING, default='linear')
-    iq_data, ticks_x, ticks_y = get_plot_data(session_iq, scale_x, scale_y)
+    iq_data, ticks_x, ticks_y = get_plot_data(plot_data, scale_x, scale_y)
     
     return  iq_data, ticks_x, ticks_y, errors
 
+def get_n_entries_iq(request, iq):
+    """
+        Return the number of data sets found in the file of a data set.
+        The number is read from the metadata stored at upload time, if available,
+        or else from the reference stored in the session by the last call to get_iq_data_dict
+    """
+    if iq.has_metadata() and iq.n_entries is not None:
+        return iq.n_entries
+    session_iq = request.session.get('iq', default=None)
+    if session_iq is None or session_iq.get('iq_id', None)!=iq.id \
+        or session_iq.get('version', None)!=manipulations.iqdata.get_data_version(iq):
+        return 1
+    return session_iq.get('n_entries', 1)
+
+
+def get_data_url(view, args, **query):
+    """
+        Returns the URL of a plot data endpoint
+        
+        @param view: dotted name of the view
+        @param args: positional arguments of the view
+        @param query: GET arguments
+    """
+    url = reverse(view, args=args)
+    if len(query)>0:
+        url += '?' + urllib.urlencode(sorted(query.items()))
+    return url
+
 
 def has_shared_data_info(request, iq):
     """
@@ -2,9 +2,9 @@ from django.shortcuts import get_object_or_404, render_to_response
 from django.template.loader import render_to_string
 from django.core.urlresolvers import reverse
 from django.http import HttpResponseRedirect, HttpResponse, Http404
-from django.core.files.base import ContentFile
 from django import forms
 from django.contrib.auth.decorators import login_required
+from django.utils.html import escape
 
 from django.template import RequestContext
 import urllib2
@@ -15,16 +15,26 @@ import sansanalysis.settings
 import sansanalysis.common.view_util as common_view_util
 
 import view_util
+import plot_payload
 
 
 from django.contrib.auth.models import User
 from sansanalysis.simpleplot.models import IqData, RecentData, PrInversion, UserSharedData
 from sansanalysis.app_logging.models import store_error
 import math, os, sys, traceback
+import numpy
 
 # Data manipulations
 import manipulations.iqdata
 import manipulations.prdata
+import manipulations.upload
+import calculations.invert_pr as invert_pr
+from sansanalysis.jobs import job_queue
+from sansanalysis.jobs.job_queue import JobLimitError
+from sansanalysis.jobs.models import Job, DONE
+
+## Allowance for the multipart encoding of an upload, in bytes
+UPLOAD_OVERHEAD = 64*1024
 
 def confirm_access(view):
     """
@@ -83,7 +93,8 @@ def invert(request, iq_id, pr_id=None):
     _process_plot_scale(request)
     
     try:
-        iq_data, ticks_x, ticks_y, errors = view_util.get_plottable_iq(request, iq)        
+        # The curves are loaded by the page, but check that the data can be read
+        plot_data, errors = view_util.get_iq_data_dict(request, iq)        
     except:
         # Send user to error page
         error_msg = 'invert() could not process stored data\n%s' % sys.exc_value
@@ -92,8 +103,8 @@ def invert(request, iq_id, pr_id=None):
                                   {'error': 'Error ID = %s: Could not process stored data' % str(err_id)},
                                   context_instance=RequestContext(request))
     
-    iq_dist = None
-    pr_dist = None
+    pr_output_id = None
+    shown_pr_id = None
     pr_outputs = None
     messages = []
     
@@ -101,21 +112,23 @@ def invert(request, iq_id, pr_id=None):
     if request.method == 'POST': # If the form has been submitted...
         form = PrForm(request.POST) # A form bound to the POST data
         if form.is_valid(): # All validation rules pass
-            # Provide and error box for computation-related errors.
+            # The inversion is executed by a background job.
+            # The page polls the job until the P(r) is available.
+            # Inversions computed before are shown right away.
             try:
-                invertor = manipulations.prdata.PrInvertor()
-                iq_dist, pr_dist, pr_id = invertor(iq_id, form.cleaned_data, request.user.id) 
-                      
+                pr_id, job = manipulations.prdata.submit_inversion(iq, form.cleaned_data, request.user.id)
                 request.session['pr_params'] = form.cleaned_data
+                if pr_id is not None:
+                    return HttpResponseRedirect(reverse('sansanalysis.simpleplot.views.invert', args=(iq_id, pr_id)))
+                return HttpResponseRedirect(reverse('sansanalysis.simpleplot.views.invert', args=(iq_id,))+'?job=%d' % job.id)
+            except JobLimitError:
+                messages = [str(sys.exc_value)+". Please wait for them to complete before submitting a new inversion."]
             except:
-                error_msg = "invert() could not compute P(r)\n%s" % sys.exc_value
+                error_msg = "invert() could not submit P(r) inversion\n%s" % sys.exc_value
                 err_id = store_error(user=request.user, url=request.path, text=error_msg, method='simpleplot.views.invert', is_shown=True, build=sansanalysis.settings.APP_VERSION)
                 return render_to_response('simpleplot/error.html',
                                           {'error': "Error ID = %s: Could not compute P(r)" % str(err_id)},
                                           context_instance=RequestContext(request))
-                
-            return HttpResponseRedirect(reverse('sansanalysis.simpleplot.views.invert', args=(iq_id,
-                                                                                          pr_id,)))              
     else:
         # Fill the form with the last computed P(r)
         prfit = None
@@ -132,13 +145,9 @@ def invert(request, iq_id, pr_id=None):
                 # Get the pk of the PrOutput associated with this fit, if available
                 pr_output_id = manipulations.prdata.get_pr_output_id(prfit[0].id)
                 if pr_output_id is not None:
-                    iq_dist = invertor.get_iq_calc(pr_output_id)
-                    pr_dist = invertor.get_pr(pr_output_id)
+                    shown_pr_id = prfit[0].id
                     pr_params = prfit[0].get_parameters()
                     pr_outputs = invertor.get_outputs(pr_output_id)
-                    # Get the user alerts
-                    if len(invertor.messages)>0:
-                        messages = invertor.messages
                 else:
                     messages = ["Warning: No output parameters could be retrieved for this fit. The inversion may not have completed properly."]
             except:
@@ -161,11 +170,28 @@ def invert(request, iq_id, pr_id=None):
     outscale_x = request.session.get(view_util.OUTPUT_SCALE_X_QSTRING, default='linear')
     outscale_y = request.session.get(view_util.OUTPUT_SCALE_Y_QSTRING, default='linear')
     
-    iq_calc, iq_ticks_x, iq_ticks_y = view_util.get_plot_data(iq_dist, scale_x, scale_y)    
-    pr_calc, pr_ticks_x, pr_ticks_y = view_util.get_plot_data(pr_dist, outscale_x, outscale_y)    
+    version = manipulations.iqdata.get_data_version(iq)
     
-    iq_calc_str = str(iq_calc) if len(iq_calc)>0 else None
-    pr_calc_str = str(pr_calc) if len(pr_calc)>0 else None
+    # The curves are loaded by the page from the data endpoints
+    iq_data_url = view_util.get_data_url('sansanalysis.simpleplot.views.iq_plot_data', (iq.id,),
+                                         scale_x=scale_x, scale_y=scale_y, v=version)
+    iq_calc_url = None
+    pr_data_url = None
+    if pr_output_id is not None:
+        iq_calc_url = view_util.get_data_url('sansanalysis.simpleplot.views.pr_plot_data', (iq.id, shown_pr_id),
+                                             curve='iq', scale_x=scale_x, scale_y=scale_y, v=version)
+        pr_data_url = view_util.get_data_url('sansanalysis.simpleplot.views.pr_plot_data', (iq.id, shown_pr_id),
+                                             curve='pr', scale_x=outscale_x, scale_y=outscale_y)
+    
+    # Pending inversion
+    job_status_url = None
+    job_cancel_url = None
+    job_id = request.GET.get('job', None)
+    if job_id is not None and job_id.isdigit():
+        jobs = Job.objects.filter(pk=int(job_id), kind='invert_pr', owner=request.user.id)
+        if len(jobs)>0 and jobs[0].get_parameters()['iq_id']==iq.id:
+            job_status_url = reverse('sansanalysis.jobs.views.job_status', args=(jobs[0].id,))
+            job_cancel_url = reverse('sansanalysis.jobs.views.cancel_job', args=(jobs[0].id,))
     
     # Action list
     actions = []
@@ -191,19 +217,17 @@ def invert(request, iq_id, pr_id=None):
                                                       reverse('sansanalysis.simpleplot.views.data_details', args=(iq_id,)), iq.name) 
     
     # Prepare the response
-    template_args = {'iq_data':str(iq_data),
+    template_args = {'iq_data_url': iq_data_url,
                        'form': form,
-                       'ticks_x': ticks_x,
-                       'ticks_y': ticks_y,
                        'iq_id': iq_id,
-                       'iq_calc': iq_calc_str,
+                       'iq_calc_url': iq_calc_url,
                        'iq_name':iq.name,
-                       'output_data': pr_calc_str,
+                       'pr_data_url': pr_data_url,
                        'output_xscale': outscale_x,
                        'output_yscale': outscale_y,
-                       'output_ticks_x': pr_ticks_x,
-                       'output_ticks_y': pr_ticks_y,
                        'pr_outputs': pr_outputs,
+                       'job_status_url': job_status_url,
+                       'job_cancel_url': job_cancel_url,
                        'actions': actions,
                        'breadcrumbs': breadcrumbs,
                        'user_alert': messages}
@@ -219,7 +243,8 @@ class UploadFileForm(forms.Form):
     """
     # http://dl.dropbox.com/u/16900303/5731_frame1_Iq.xml
     file  = forms.FileField(required=False)
-    data_url = forms.URLField(required=False, verify_exists=True)
+    # The URL is checked when the file is downloaded
+    data_url = forms.URLField(required=False, verify_exists=False)
 
 @login_required
 def select_data(request):
@@ -233,36 +258,40 @@ def select_data(request):
     
     # Upload form
     error_msg = None
-    if request.method == 'POST':
+    max_size = sansanalysis.settings.IQDATA_MAX_UPLOAD_SIZE
+    too_large_msg = "The uploaded file is too large: the maximum size is %d kB" % (max_size/1024)
+    
+    # Reject large uploads before the request body is read
+    if request.method == 'POST' and \
+        int(request.META.get('CONTENT_LENGTH', 0) or 0) > max_size + UPLOAD_OVERHEAD:
+        form = UploadFileForm()
+        error_msg = too_large_msg
+        
+    elif request.method == 'POST':
         form = UploadFileForm(request.POST, request.FILES)
         
-        if form.is_valid():
-            # Prepare to save data to disk
-            if 'file' in request.FILES:
-                file_name = request.FILES['file'].name
-                file_content = ContentFile(request.FILES['file'].read())
-            else:
-                data_url = request.POST['data_url']
-                f = urllib2.urlopen(urllib2.Request(url=data_url))
-                file_content = ContentFile(f.read())
-                file_name = data_url
-            # Search to see whether a file with that name exists.
-            # Check whether the file is owned by the user before deleting it.
-            # If it's not, just create a new file with the same name.
-            iq_entries = IqData.objects.filter(name__endswith=file_name, owner=request.user.id)
-            if len(iq_entries)>0:                
-                iq_data = iq_entries[0]
-                iq_data.file.delete(False)
-            else:
-                # No entry was found, create one
-                iq_data = IqData()
-                iq_data.owner = request.user.id
-                iq_data.name  = file_name
-            
-            iq_data.file.save(file_name, file_content)
-            
-            return HttpResponseRedirect(reverse('sansanalysis.simpleplot.views.data_details', args=(iq_data.id,)))
-        else:
+        if form.is_valid() and 'file' in request.FILES:
+            # Stream the data to disk
+            file_name = request.FILES['file'].name
+            try:
+                if request.FILES['file'].size > max_size:
+                    raise manipulations.upload.UploadTooLarge
+                file_content = manipulations.upload.stream_to_file(request.FILES['file'].chunks(), file_name, max_size)
+                iq_data = manipulations.iqdata.store_uploaded_file(request.user.id, file_name, file_content)
+                return HttpResponseRedirect(reverse('sansanalysis.simpleplot.views.data_details', args=(iq_data.id,)))
+            except manipulations.upload.UploadTooLarge:
+                error_msg = too_large_msg
+                
+        elif form.is_valid() and form.cleaned_data['data_url']:
+            # Remote files are downloaded by a background job.
+            # The dashboard polls the job until the data is available.
+            try:
+                job = job_queue.submit('fetch_url', request.user.id, {'url': form.cleaned_data['data_url']})
+                return HttpResponseRedirect(reverse('sansanalysis.simpleplot.views.select_data')+'?job=%d' % job.id)
+            except JobLimitError:
+                error_msg = "%s. Please wait for them to complete before retrieving another file." % sys.exc_value
+        
+        elif error_msg is None:
             error_msg = "Enter a valid file path or a valid URL"
             if 'file' in request.FILES:
                 file_name = request.FILES['file'].name
@@ -292,6 +321,11 @@ def select_data(request):
                      'sample_url': reverse('sansanalysis.simpleplot.views.sample_data')
                      }
     
+    # Pending download of a remote data file
+    job_id = request.GET.get('job', None)
+    if job_id is not None and job_id.isdigit():
+        template_args['job_status_url'] = reverse('sansanalysis.jobs.views.job_status', args=(int(job_id),))
+        
     if error_msg is not None:
         template_args['user_alert']=[error_msg]
         
@@ -431,6 +465,8 @@ def _process_plot_scale(request):
 def data_details(request, iq_id):
     """
         Present details about the data.
+        The data set to show, for files holding more than one,
+        is selected with the 'entry' GET argument.
         
         #TODO: show meta data information if available
         
@@ -443,7 +479,13 @@ def data_details(request, iq_id):
     _process_plot_scale(request)
     
     try:
-        iq_data, ticks_x, ticks_y, errors = view_util.get_plottable_iq(request, iq)
+        entry = int(request.GET.get('entry', 0))
+    except ValueError:
+        entry = 0
+    
+    try:
+        # The points are loaded by the page, but check that the data can be read
+        plot_data, errors = view_util.get_iq_data_dict(request, iq, entry)
     except:
         # Send user to error page
         err_id = store_error(user=request.user, url=request.path, text=sys.exc_value, method='simpleplot.views.data_details', is_shown=True, build=sansanalysis.settings.APP_VERSION)
@@ -457,11 +499,23 @@ def data_details(request, iq_id):
     # Prepare the response
     breadcrumbs = "<a href='%s'>Home</a> &rsaquo; %s" % (reverse('sansanalysis.simpleplot.views.home'), iq.name) 
     
-    template_args = {  'iq_data':str(iq_data),
+    # Links to the other data sets of the file
+    n_entries = view_util.get_n_entries_iq(request, iq)
+    entries = []
+    if n_entries>1:
+        entries = [{'index': i, 'label': str(i+1), 'selected': i==entry} for i in range(n_entries)]
+    
+    scale_x = request.session.get(view_util.DATA_SCALE_X_QSTRING, default='linear')
+    scale_y = request.session.get(view_util.DATA_SCALE_Y_QSTRING, default='linear')
+    iq_data_url = view_util.get_data_url('sansanalysis.simpleplot.views.iq_plot_data', (iq.id,),
+                                         entry=entry, scale_x=scale_x, scale_y=scale_y,
+                                         v=manipulations.iqdata.get_data_version(iq))
+    
+    template_args = {  'iq_data_url': iq_data_url,
                        'iq_id': iq_id,
                        'iq_name':iq.name,
-                       'ticks_x': ticks_x,
-                       'ticks_y': ticks_y,
+                       'entries': entries,
+                       'entry': entry,
                        'actions': actions,
                        'user_alert': errors,
                        'breadcrumbs': breadcrumbs}
@@ -493,52 +547,513 @@ def get_estimates(request, iq_id):
         resp = "<?xml version=\"1.0\" encoding=\"ISO-8859-1\"?>\n<pr>\n<alpha>N/A</alpha>\n<n_terms>N/A</n_terms>\n</pr>" 
         return HttpResponse(resp, mimetype="text/xml")
 
+def _get_explore_parameters(request):
+    """
+        Returns the inversion parameters and the D_max exploration
+        range given as GET arguments: expl_min, expl_max and expl_npt
+    """
+    f = PrForm(request.GET)
+    if not f.is_valid():
+        raise RuntimeError, "PrForm could not be validated"
+    
+    expl_min = None
+    expl_max = None
+    expl_npt = 25
+    try:
+        value_in = request.GET.get('expl_min',None)
+        if value_in is not None:
+            expl_min = float(value_in)
+        
+        value_in = request.GET.get('expl_max',None)    
+        if value_in is not None:
+            expl_max = float(value_in)
+        
+        expl_npt = int(request.GET.get('expl_npt',25))
+    except:
+        err_mess = "_get_explore_parameters: could not process exploration range\n"
+        err_mess += "  Min:%s / Max:%s / Npts:%s\n" % (str(expl_min), str(expl_max), str(expl_npt))
+        err_mess += "  %s" % sys.exc_value
+        store_error(user=request.user, url=request.path, text=err_mess, method='simpleplot._get_explore_parameters', build=sansanalysis.settings.APP_VERSION)
+    
+    expl_npt = min(max(expl_npt, 1), sansanalysis.settings.PR_SCAN_MAX_NPTS)
+    return f.cleaned_data, expl_min, expl_max, expl_npt
+
+def _get_plot_scale(request, session_x, session_y):
+    """
+        Returns the plot scales given by the 'scale_x' and 'scale_y'
+        GET arguments, or else those stored in the session
+        
+        @param session_x: session key of the x scale
+        @param session_y: session key of the y scale
+    """
+    scale_x = request.GET.get('scale_x', request.session.get(session_x, 'linear'))
+    scale_y = request.GET.get('scale_y', request.session.get(session_y, 'linear'))
+    return scale_x, scale_y
+
+@confirm_access
+def iq_plot_data(request, iq_id):
+    """
+        Ajax call returning the points of a data set.
+        
+        GET arguments:
+            - entry: index of the data set within the data file
+            - scale_x, scale_y: plot scales, by default those of the session
+            - v: version of the data set. The browser may keep the
+                 response if it matches the current version.
+            - format, precision, max_points, decimation, full: see plot_payload
+        
+        The points are cached by data version, entry, scales and decimation.
+        
+        @param iq_id: pk of IqData object
+    """
+    iq = get_object_or_404(IqData, pk=iq_id)
+    try:
+        entry = int(request.GET.get('entry', 0))
+    except ValueError:
+        entry = 0
+    scale_x, scale_y = _get_plot_scale(request, view_util.DATA_SCALE_X_QSTRING, view_util.DATA_SCALE_Y_QSTRING)
+    max_points, method = plot_payload.get_decimation_options(request)
+    version = manipulations.iqdata.get_data_version(iq)
+    
+    def _compute():
+        plot_data, errors = view_util.get_iq_data_dict(request, iq, entry)
+        columns, is_set, ticks_x, ticks_y = view_util.get_plot_arrays(plot_data, scale_x, scale_y)
+        columns, is_set, n_full = view_util.decimate_plot_arrays(columns, is_set, max_points, method)
+        return columns, ticks_x, ticks_y, errors, n_full
+    
+    max_age = None
+    if request.GET.get('v', None) == version:
+        max_age = sansanalysis.settings.PLOT_DATA_MAX_AGE
+    try:
+        return plot_payload.cached_plot_response(request, ('iq', version, entry, scale_x, scale_y, max_points, method), _compute,
+                                                 plot_payload.PLOT_COLUMNS, max_age=max_age)
+    except:
+        err_mess = "iq_plot_data failed: %s" % sys.exc_value
+        store_error(user=request.user, url=request.path, text=err_mess, method='simpleplot.iq_plot_data', build=sansanalysis.settings.APP_VERSION)
+        columns, is_set, ticks_x, ticks_y = view_util.get_plot_arrays(None)
+        return plot_payload.plot_response(request, columns, plot_payload.PLOT_COLUMNS)
+
 @login_required
-def explore_dmax(request, iq_id):
+@confirm_access
+def pr_plot_data(request, iq_id, pr_id):
     """
-         Ajax call
-    """ 
-    try:        
-        form_data = {}
-        f = PrForm(request.GET)
-        if f.is_valid():
-            
-            expl_min = None
-            expl_max = None
-            expl_npt = 25
-            try:
-                value_in = request.GET.get('expl_min',None)
-                if value_in is not None:
-                    expl_min = float(value_in)
-                
-                value_in = request.GET.get('expl_max',None)    
-                if value_in is not None:
-                    expl_max = float(value_in)
-                
-                expl_npt = int(request.GET.get('expl_npt',25))
-            except:
-                err_mess = "explore_dmax: could not process exploration range\n"
-                err_mess += "  Min:%s / Max:%s / Npts:%s\n" % (str(expl_min), str(expl_max), str(expl_npt))
-                err_mess += "  %s" % sys.exc_value
-                store_error(user=request.user, url=request.path, text=err_mess, method='simpleplot.explore_dmax', build=sansanalysis.settings.APP_VERSION)
-            
+        Ajax call returning a curve computed from the output of a P(r) inversion.
+        
+        GET arguments:
+            - curve: 'pr' for P(r) [default], 'iq' for the calculated I(q)
+            - npts: number of points of P(r), PR_OUTPUT_NPTS by default
+            - scale_x, scale_y: plot scales, by default those of the session
+            - v: version of the data set. The browser may keep the
+                 calculated I(q) if it matches the current version.
+            - format, precision, max_points, decimation, full: see plot_payload
+        
+        The curves are cached by inversion output, curve, scales and
+        decimation, and by data version for the calculated I(q).
+        
+        @param iq_id: pk of IqData object
+        @param pr_id: pk of PrInversion object
+    """
+    try:
+        pr_id = int(pr_id)
+    except:
+        raise Http404
+    pr_key = view_util.get_shared_pr_key(request, pr_id)
+    pr = manipulations.prdata.get_pr(pr_id, user_id=request.user.id, iq_id=iq_id, key=pr_key)
+    if pr is None:
+        raise Http404
+    
+    curve = 'iq' if request.GET.get('curve', 'pr') == 'iq' else 'pr'
+    if curve == 'iq':
+        scale_x, scale_y = _get_plot_scale(request, view_util.DATA_SCALE_X_QSTRING, view_util.DATA_SCALE_Y_QSTRING)
+    else:
+        scale_x, scale_y = _get_plot_scale(request, view_util.OUTPUT_SCALE_X_QSTRING, view_util.OUTPUT_SCALE_Y_QSTRING)
+    max_points, method = plot_payload.get_decimation_options(request)
+    try:
+        npts = int(request.GET.get('npts', sansanalysis.settings.PR_OUTPUT_NPTS))
+    except ValueError:
+        npts = sansanalysis.settings.PR_OUTPUT_NPTS
+    npts = min(max(npts, 2), sansanalysis.settings.PR_OUTPUT_MAX_NPTS)
+    
+    try:
+        pr_output_id = manipulations.prdata.get_pr_output_id(pr.id)
+        if pr_output_id is None:
+            raise RuntimeError, "No output available for P(r) inversion %d" % pr.id
+        
+        def _compute():
             invertor = manipulations.prdata.PrInvertor()
-            plotdata = invertor.explore_dmax(iq_id, f.cleaned_data, request.user.id, min=expl_min, max=expl_max, npts=expl_npt)
-            
-            resp = "<?xml version=\"1.0\" encoding=\"ISO-8859-1\"?>\n<pr>\n"
-            for i in range(len(plotdata['x'])):
-                resp += "<point><x>%g</x><y>%g</y></point>\n" % (plotdata['x'][i], plotdata['y'][i])
-            resp += "</pr>"
-            return HttpResponse(resp, mimetype="text/xml")
+            if curve == 'iq':
+                dist = invertor.get_iq_calc(pr_output_id)
+            else:
+                dist = invertor.get_pr(pr_output_id, npts)
+            columns, is_set, ticks_x, ticks_y = view_util.get_plot_arrays(dist, scale_x, scale_y)
+            columns, is_set, n_full = view_util.decimate_plot_arrays(columns, is_set, max_points, method)
+            return columns, ticks_x, ticks_y, invertor.messages, n_full
+        
+        # The output of an inversion does not change, but the
+        # calculated I(q) is evaluated at the Q values of the data
+        key = ('pr', pr_output_id, curve, scale_x, scale_y, max_points, method)
+        max_age = sansanalysis.settings.PLOT_DATA_MAX_AGE
+        if curve == 'pr':
+            key += (npts,)
         else:
+            version = manipulations.iqdata.get_data_version(pr.iq_data)
+            key += (version,)
+            if request.GET.get('v', None) != version:
+                max_age = None
+        return plot_payload.cached_plot_response(request, key, _compute, plot_payload.PLOT_COLUMNS, max_age=max_age)
+    except:
+        err_mess = "pr_plot_data failed: %s" % sys.exc_value
+        store_error(user=request.user, url=request.path, text=err_mess, method='simpleplot.pr_plot_data', build=sansanalysis.settings.APP_VERSION)
+        columns, is_set, ticks_x, ticks_y = view_util.get_plot_arrays(None)
+        return plot_payload.plot_response(request, columns, plot_payload.PLOT_COLUMNS)
+
+@login_required
+@confirm_access
+def explore_dmax_submit(request, iq_id):
+    """
+        Ajax call submitting a D_max scan as a background job.
+        Takes the inversion parameters of PrForm and the D_max range
+        as GET arguments, see _get_explore_parameters.
+        The response gives the URL to poll for the outputs of the scan,
+        and the URL to cancel it. Scans found in the cache are not
+        submitted: the response then only gives the URL of their outputs.
+        
+        @param iq_id: pk of IqData object
+    """
+    try:
+        parameters, expl_min, expl_max, expl_npt = _get_explore_parameters(request)
+        
+        # Scans computed before are served right away
+        iq = get_object_or_404(IqData, pk=iq_id)
+        if manipulations.prdata.get_cached_scan(iq, parameters, expl_min, expl_max, expl_npt) is not None:
+            data_url = "%s?%s" % (reverse('sansanalysis.simpleplot.views.explore_dmax_data', args=(iq_id,)), request.GET.urlencode())
+            resp = "<?xml version=\"1.0\" encoding=\"ISO-8859-1\"?>\n<job>\n<data_url>%s</data_url>\n</job>" % escape(data_url)
+            return HttpResponse(resp, mimetype="text/xml")
+        
+        job = _submit_scan_job(request, iq, parameters, expl_min, expl_max, expl_npt)
+        data_url = view_util.get_data_url('sansanalysis.simpleplot.views.explore_dmax_data', (iq_id,), job=job.id)
+        cancel_url = reverse('sansanalysis.jobs.views.cancel_job', args=(job.id,))
+        resp = "<?xml version=\"1.0\" encoding=\"ISO-8859-1\"?>\n<job>\n<id>%d</id>\n" % job.id
+        resp += "<data_url>%s</data_url>\n<cancel_url>%s</cancel_url>\n</job>" % (escape(data_url), escape(cancel_url))
+        return HttpResponse(resp, mimetype="text/xml")
+    except:
+        err_mess = "explore_dmax_submit failed: %s" % sys.exc_value
+        store_error(user=request.user, url=request.path, text=err_mess, method='simpleplot.explore_dmax_submit', build=sansanalysis.settings.APP_VERSION)
+        resp = "<?xml version=\"1.0\" encoding=\"ISO-8859-1\"?>\n<job>\n<error>Could not start the D max exploration</error>\n</job>"
+        return HttpResponse(resp, mimetype="text/xml")
+
+def _submit_scan_job(request, iq, parameters, expl_min, expl_max, expl_npt):
+    """
+        Returns the job computing a D_max scan for the current user,
+        submitting it unless the same scan is already waiting, running or done
+        @param iq: IqData object
+        @param parameters: inversion parameters
+        @param expl_min, expl_max, expl_npt: D_max range, see _get_explore_parameters
+    """
+    return manipulations.prdata.submit_analysis_job('explore_dmax', iq, {'iq_id': str(iq.id),
+                                                                         'parameters': parameters,
+                                                                         'min': expl_min,
+                                                                         'max': expl_max,
+                                                                         'npts': expl_npt}, request.user.id)
+
+def _get_scan_columns(result):
+    """
+        Returns the columns of plot data for the outputs of a D_max scan,
+        in the order of plot_payload.SCAN_COLUMNS
+        @param result: dictionary of outputs, see prdata.scan_dmax
+    """
+    names = ['d_max'] + plot_payload.SCAN_COLUMNS[1:]
+    columns = []
+    for name in names:
+        values = [item[name] for item in result['points']]
+        columns.append(numpy.asarray([v if v is not None else numpy.nan for v in values], dtype=float))
+    return columns
+
+def _get_scan_job(request, iq_id, job_id, kind='explore_dmax'):
+    """
+        Returns a D_max scan job of the current user for a given data set
+        @param iq_id: pk of IqData object
+        @param job_id: pk of the Job object
+        @param kind: type of job
+    """
+    try:
+        job = Job.objects.get(pk=int(job_id), kind=kind, owner=request.user.id)
+    except (Job.DoesNotExist, ValueError):
+        raise Http404
+    if job.get_parameters()['iq_id'] != iq_id:
+        raise Http404
+    return job
+
+def _scan_job_response(request, iq_id, job):
+    """
+        Returns the points of a D_max scan job completed so far.
+        See explore_dmax_data.
+        @param iq_id: pk of IqData object
+        @param job: Job object
+    """
+    result = job.get_result() or {'points': [], 'errors': []}
+    messages = result['errors']
+    if job.error is not None:
+        messages = messages + [job.error]
+    if job.status == DONE:
+        # Keep the scan for the next requests served by this process
+        job_parameters = job.get_parameters()
+        manipulations.prdata.cache_scan(IqData.objects.get(pk=iq_id), job_parameters['parameters'], job_parameters['min'],
+                                        job_parameters['max'], job_parameters['npts'], result)
+    return plot_payload.plot_response(request, _get_scan_columns(result), plot_payload.SCAN_COLUMNS, messages=messages,
+                                      extra={'job': {'id': job.id, 'status': job.status, 'progress': job.progress}})
+
+@login_required
+@confirm_access
+def explore_dmax_data(request, iq_id):
+    """
+        Ajax call returning the outputs of the inversion as a function
+        of D_max, in the columns given by plot_payload.SCAN_COLUMNS.
+        Outputs that could not be computed are sent as null.
+        Takes the same GET arguments as explore_dmax_submit, plus
+        the format and precision arguments of plot_payload.
+        
+        Scans are never computed in the request. With a 'job' GET argument,
+        returns the points of a scan submitted with explore_dmax_submit
+        that are completed so far. Without it, the scan is served from the
+        cache of this process; if it is not found there, the job computing
+        it is submitted, or found if it is already waiting, running or done,
+        and its points are returned. The JSON response then has a 'job' entry
+        with the status and the progress of the scan.
+        
+        @param iq_id: pk of IqData object
+    """
+    job_id = request.GET.get('job', None)
+    if job_id is not None:
+        return _scan_job_response(request, iq_id, _get_scan_job(request, iq_id, job_id))
+    
+    try:
+        parameters, expl_min, expl_max, expl_npt = _get_explore_parameters(request)
+        iq = IqData.objects.get(pk=iq_id)
+        result = manipulations.prdata.get_cached_scan(iq, parameters, expl_min, expl_max, expl_npt)
+        if result is None:
+            job = _submit_scan_job(request, iq, parameters, expl_min, expl_max, expl_npt)
+            return _scan_job_response(request, iq_id, job)
+        columns = _get_scan_columns(result)
+        messages = result['errors']
+    except JobLimitError:
+        columns = [[] for name in plot_payload.SCAN_COLUMNS]
+        messages = [str(sys.exc_value)]
+    except:
+        err_mess = "explore_dmax_data failed: %s" % sys.exc_value
+        store_error(user=request.user, url=request.path, text=err_mess, method='simpleplot.explore_dmax_data', build=sansanalysis.settings.APP_VERSION)
+        columns = [[] for name in plot_payload.SCAN_COLUMNS]
+        messages = ["Could not compute the P(r) inversion for a range of D max"]
+    return plot_payload.plot_response(request, columns, plot_payload.SCAN_COLUMNS, messages=messages)
+    
+def _get_alpha_values(request, max_npts):
+    """
+        Returns the alpha values, spaced on a log scale, given by
+        the alpha_min, alpha_max and alpha_npt GET arguments
+        @param max_npts: maximum number of values
+    """
+    alpha_min = float(request.GET.get('alpha_min', 1e-6))
+    alpha_max = float(request.GET.get('alpha_max', 1e2))
+    alpha_npt = int(request.GET.get('alpha_npt', 50))
+    alpha_npt = min(max(alpha_npt, 1), max_npts)
+    return invert_pr.get_alpha_values(alpha_min, alpha_max, alpha_npt)
+
+@login_required
+@confirm_access
+def pr_path_data(request, iq_id):
+    """
+        Ajax call returning the outputs of the inversion for a range
+        of alpha values, in the columns given by plot_payload.PATH_COLUMNS.
+        The JSON response also has the distances ('r'), the P(r) values
+        for each alpha, one row per alpha ('pr'), the alpha with the
+        smallest generalized cross-validation score ('alpha_gcv') and the
+        alpha of the corner of the L-curve ('alpha_lcurve'), so that the
+        page can show P(r) for any alpha of the range without other requests.
+        
+        GET arguments:
+            - the inversion parameters of PrForm, alpha being ignored
+            - alpha_min, alpha_max: range of alpha, spaced on a log scale
+            - alpha_npt: number of alpha values
+            - npts: number of points of P(r), PR_OUTPUT_NPTS by default
+            - format, precision: see plot_payload
+        
+        @param iq_id: pk of IqData object
+    """
+    try:
+        f = PrForm(request.GET)
+        if not f.is_valid():
             raise RuntimeError, "PrForm could not be validated"
+        parameters = f.cleaned_data
+        
+        alphas = _get_alpha_values(request, sansanalysis.settings.PR_PATH_MAX_NPTS)
+        npts = int(request.GET.get('npts', sansanalysis.settings.PR_OUTPUT_NPTS))
+        npts = min(max(npts, 2), sansanalysis.settings.PR_OUTPUT_MAX_NPTS)
+        
+        iq = get_object_or_404(IqData, pk=iq_id)
+        solutions = manipulations.prdata.regularization_path(iq, parameters, alphas, npts)
+        columns = [solutions['alpha']] + [solutions[name] for name in plot_payload.PATH_COLUMNS[1:]]
+        extra = {'r': solutions['r'].tolist(),
+                 'pr': solutions['pr'].tolist(),
+                 'alpha_gcv': solutions['alpha_gcv'],
+                 'alpha_lcurve': solutions['alpha_lcurve']}
+        return plot_payload.plot_response(request, columns, plot_payload.PATH_COLUMNS, extra=extra)
     except:
-        err_mess = "explore_dmax failed: %s" % sys.exc_value
-        store_error(user=request.user, url=request.path, text=err_mess, method='simpleplot.explore_dmax', build=sansanalysis.settings.APP_VERSION)
+        err_mess = "pr_path_data failed: %s" % sys.exc_value
+        store_error(user=request.user, url=request.path, text=err_mess, method='simpleplot.pr_path_data', build=sansanalysis.settings.APP_VERSION)
+        columns = [[] for name in plot_payload.PATH_COLUMNS]
+        return plot_payload.plot_response(request, columns, plot_payload.PATH_COLUMNS,
+                                          messages=["Could not compute the P(r) inversion for a range of alpha"])
+    
+def _get_map_parameters(request):
+    """
+        Returns the inversion parameters, the D_max values and the
+        alpha values of a quality map given as GET arguments.
+        See pr_map_data.
+    """
+    parameters, expl_min, expl_max, expl_npt = _get_explore_parameters(request)
+    expl_npt = min(expl_npt, sansanalysis.settings.PR_MAP_MAX_NPTS)
+    d_values = invert_pr.get_dmax_values(parameters['d_max'], expl_min, expl_max, expl_npt)
+    alphas = _get_alpha_values(request, sansanalysis.settings.PR_MAP_MAX_NPTS)
+    return parameters, [float(v) for v in d_values], [float(v) for v in alphas]
+
+def _get_map_columns(result):
+    """
+        Returns the columns of plot data for a quality map,
+        in the order of plot_payload.MAP_COLUMNS
+        @param result: dictionary of outputs, see prdata.quality_map
+    """
+    n_alpha = len(result['alpha'])
+    columns = [numpy.repeat(result['d_max'], n_alpha), numpy.tile(result['alpha'], len(result['d_max']))]
+    for name in plot_payload.MAP_COLUMNS[2:]:
+        values = [v if v is not None else numpy.nan for row in result[name] for v in row]
+        columns.append(numpy.asarray(values, dtype=float))
+    return columns
+
+def _submit_map_job(request, iq, parameters, d_values, alphas):
+    """
+        Returns the job computing a quality map for the current user,
+        submitting it unless the same map is already waiting, running or done
+        @param iq: IqData object
+        @param parameters: inversion parameters
+        @param d_values: list of D_max values
+        @param alphas: list of alpha values
+    """
+    return manipulations.prdata.submit_analysis_job('pr_map', iq, {'iq_id': str(iq.id),
+                                                                   'parameters': parameters,
+                                                                   'd_values': d_values,
+                                                                   'alphas': alphas}, request.user.id)
+
+def _map_job_response(request, iq_id, job):
+    """
+        Returns the map of a quality map job completed so far.
+        See pr_map_data.
+        @param iq_id: pk of IqData object
+        @param job: Job object
+    """
+    job_parameters = job.get_parameters()
+    result = job.get_result()
+    if result is None:
+        n_dmax = len(job_parameters['d_values'])
+        n_alpha = len(job_parameters['alphas'])
+        result = {'d_max': job_parameters['d_values'], 'alpha': job_parameters['alphas'], 'errors': []}
+        for name in plot_payload.MAP_COLUMNS[2:]:
+            result[name] = [[None]*n_alpha]*n_dmax
+    messages = result['errors']
+    if job.error is not None:
+        messages = messages + [job.error]
+    if job.status == DONE:
+        # Keep the map for the next requests served by this process
+        manipulations.prdata.cache_map(IqData.objects.get(pk=iq_id), job_parameters['parameters'],
+                                       job_parameters['d_values'], job_parameters['alphas'], result)
+    return plot_payload.plot_response(request, _get_map_columns(result), plot_payload.MAP_COLUMNS, messages=messages,
+                                      extra={'n_dmax': len(result['d_max']), 'n_alpha': len(result['alpha']),
+                                             'job': {'id': job.id, 'status': job.status, 'progress': job.progress}})
+
+@login_required
+@confirm_access
+def pr_map_submit(request, iq_id):
+    """
+        Ajax call submitting a quality map as a background job.
+        Takes the same GET arguments as pr_map_data.
+        The response gives the URL to poll for the map, and the URL
+        to cancel it. Maps found in the cache are not submitted:
+        the response then only gives the URL of the map.
+        
+        @param iq_id: pk of IqData object
+    """
+    try:
+        parameters, d_values, alphas = _get_map_parameters(request)
         
-        resp = "<?xml version=\"1.0\" encoding=\"ISO-8859-1\"?>\n<pr></pr>"
+        # Maps computed before are served right away
+        iq = get_object_or_404(IqData, pk=iq_id)
+        if manipulations.prdata.get_cached_map(iq, parameters, d_values, alphas) is not None:
+            data_url = "%s?%s" % (reverse('sansanalysis.simpleplot.views.pr_map_data', args=(iq_id,)), request.GET.urlencode())
+            resp = "<?xml version=\"1.0\" encoding=\"ISO-8859-1\"?>\n<job>\n<data_url>%s</data_url>\n</job>" % escape(data_url)
+            return HttpResponse(resp, mimetype="text/xml")
+        
+        job = _submit_map_job(request, iq, parameters, d_values, alphas)
+        data_url = view_util.get_data_url('sansanalysis.simpleplot.views.pr_map_data', (iq_id,), job=job.id)
+        cancel_url = reverse('sansanalysis.jobs.views.cancel_job', args=(job.id,))
+        resp = "<?xml version=\"1.0\" encoding=\"ISO-8859-1\"?>\n<job>\n<id>%d</id>\n" % job.id
+        resp += "<data_url>%s</data_url>\n<cancel_url>%s</cancel_url>\n</job>" % (escape(data_url), escape(cancel_url))
+        return HttpResponse(resp, mimetype="text/xml")
+    except:
+        err_mess = "pr_map_submit failed: %s" % sys.exc_value
+        store_error(user=request.user, url=request.path, text=err_mess, method='simpleplot.pr_map_submit', build=sansanalysis.settings.APP_VERSION)
+        resp = "<?xml version=\"1.0\" encoding=\"ISO-8859-1\"?>\n<job>\n<error>Could not start the D max and alpha map</error>\n</job>"
         return HttpResponse(resp, mimetype="text/xml")
+
+@login_required
+@confirm_access
+def pr_map_data(request, iq_id):
+    """
+        Ajax call returning the outputs of the inversion over a grid
+        of D_max and alpha values, for a contour plot. Each point is a
+        cell of the grid, in the columns given by plot_payload.MAP_COLUMNS,
+        D_max varying slowest. Values that were not computed are sent as
+        null. The JSON response also gives the number of D_max values
+        ('n_dmax') and of alpha values ('n_alpha') of the grid.
+        
+        Maps are never computed in the request. With a 'job' GET argument,
+        returns the map of a job submitted with pr_map_submit completed so
+        far. Without it, the map is served from the cache of this process;
+        if it is not found there, the job computing it is submitted, or
+        found if it is already waiting, running or done, and its map is
+        returned. The JSON response then has a 'job' entry with the status
+        and the progress of the map.
+        
+        GET arguments:
+            - the inversion parameters of PrForm, D_max and alpha being
+              only used for the default range of D_max
+            - expl_min, expl_max, expl_npt: range of D_max, see _get_explore_parameters
+            - alpha_min, alpha_max, alpha_npt: range of alpha, see pr_path_data
+            - format, precision: see plot_payload
+        
+        @param iq_id: pk of IqData object
+    """
+    job_id = request.GET.get('job', None)
+    if job_id is not None:
+        return _map_job_response(request, iq_id, _get_scan_job(request, iq_id, job_id, kind='pr_map'))
     
+    try:
+        parameters, d_values, alphas = _get_map_parameters(request)
+        iq = IqData.objects.get(pk=iq_id)
+        result = manipulations.prdata.get_cached_map(iq, parameters, d_values, alphas)
+        if result is None:
+            return _map_job_response(request, iq_id, _submit_map_job(request, iq, parameters, d_values, alphas))
+        return plot_payload.plot_response(request, _get_map_columns(result), plot_payload.MAP_COLUMNS, messages=result['errors'],
+                                          extra={'n_dmax': len(result['d_max']), 'n_alpha': len(result['alpha'])})
+    except JobLimitError:
+        columns = [[] for name in plot_payload.MAP_COLUMNS]
+        return plot_payload.plot_response(request, columns, plot_payload.MAP_COLUMNS, messages=[str(sys.exc_value)],
+                                          extra={'n_dmax': 0, 'n_alpha': 0})
+    except:
+        err_mess = "pr_map_data failed: %s" % sys.exc_value
+        store_error(user=request.user, url=request.path, text=err_mess, method='simpleplot.pr_map_data', build=sansanalysis.settings.APP_VERSION)
+        columns = [[] for name in plot_payload.MAP_COLUMNS]
+        return plot_payload.plot_response(request, columns, plot_payload.MAP_COLUMNS,
+                                          messages=["Could not compute the P(r) inversion over the D max and alpha grid"],
+                                          extra={'n_dmax': 0, 'n_alpha': 0})
     
 def access_shared_data(request, key):
     """
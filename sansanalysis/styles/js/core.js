@@ -52,4 +52,23 @@ function show_help_dialog(help_content) {
 		}
 	});
 	$("#help_dialog").dialog('open');	
-}
\ No newline at end of file
+}
+
+function show_user_alert($, messages) {
+	// Show messages received after the page was loaded
+	if (messages==null || messages.length==0) {
+		return;
+	}
+	if ($(".user_alert").length==0) {
+		$("body").append("<div class='user_alert'><div class='close'/><div id='alert_message'></div></div>");
+	}
+	var html = document.getElementById('alert_message').innerHTML;
+	for (var i=0; i<messages.length; i++) {
+		if (html.length>0) {
+			html += "<br><br>";
+		}
+		html += $('<div/>').text(messages[i]).html();
+	}
+	document.getElementById('alert_message').innerHTML = html;
+	user_alert();
+}
@@ -203,5 +203,88 @@ function create_plot_new($, id, data, options, xlabel, point_hover) {
     addArrow('up',    -14, 100, { top: -10 });
     addArrow('down',  -14, 111, { top: 10 });
     
-    
-};
\ No newline at end of file
+    return plot;
+};
+
+// Plot data loaded from the data endpoints, by URL
+var plot_data_cache = {};
+
+function payload_to_points(payload) {
+	// Rebuild the rows of points expected by the plots
+	// from the columns sent by the data endpoints
+	var columns = new Array(payload.columns.length);
+	for (var j=0; j<payload.columns.length; j++) {
+		columns[j] = payload.data[payload.columns[j]];
+	}
+	var points = new Array(payload.npts);
+	for (var i=0; i<payload.npts; i++) {
+		var row = new Array(columns.length);
+		for (var j=0; j<columns.length; j++) {
+			row[j] = columns[j][i];
+		}
+		points[i] = row;
+	}
+	return points;
+}
+
+function payload_to_curve(payload, name) {
+	// Return the [x, y] points of the plot data for a given
+	// column, leaving out the points where it is not defined
+	var x = payload.data[payload.columns[0]];
+	var y = payload.data[name];
+	var points = [];
+	for (var i=0; i<payload.npts; i++) {
+		if (y[i]!=null) {
+			points.push([x[i], y[i]]);
+		}
+	}
+	return points;
+}
+
+function load_plot_data($, url, callback) {
+	// Call callback with the plot data found at url.
+	// Responses are kept for the life of the page.
+	if (plot_data_cache[url]!=null) {
+		callback(plot_data_cache[url]);
+		return;
+	}
+	$.ajax({
+	  url: url,
+	  dataType: 'json',
+	  cache: true,
+	  success: function(payload){
+	  	plot_data_cache[url] = payload;
+	  	callback(payload);
+	  }
+	});
+}
+
+function full_resolution_url(url) {
+	return url + (url.indexOf('?')<0 ? '?' : '&') + 'full=1';
+}
+
+function load_full_on_zoom($, id, plot, data, index, payload, url) {
+	// Replace a decimated series by all its points
+	// the first time the plot is zoomed
+	if (payload.npts_full==null || payload.npts>=payload.npts_full) {
+		return;
+	}
+	$('#'+id).one("plotzoom", function(event, plot) {
+		load_plot_data($, full_resolution_url(url), function(full_payload){
+			data[index].data = payload_to_points(full_payload);
+			plot.setData(data);
+			plot.setupGrid();
+			plot.draw();
+		});
+	});
+}
+
+function set_plot_ticks(options, payload) {
+	// Use the ticks computed for log scales
+	if (payload.ticks_x!=null) {
+		options.xaxis.ticks = payload.ticks_x;
+	}
+	if (payload.ticks_y!=null) {
+		options.yaxis.ticks = payload.ticks_y;
+	}
+}
@@ -123,35 +123,24 @@ function process_par_change(){
 		}
 	//}
 	
-	$.ajax({
-	  url: '/analysis/'+window.fit_problem.iq_id+'/model/'+window.fit_problem.model_id+'/?'+params,
-	  cache: false,
-	  success: function(xmldata){
-	    	window.iq_calc = new Array();
-	      	points=xmldata.getElementsByTagName("point");
-	      	if (points.length>0) {
-				  for (i=0;i<points.length;i++) {
-				  	  var x = parseFloat(points[i].getElementsByTagName("x")[0].childNodes[0].nodeValue);
-				  	  var y = parseFloat(points[i].getElementsByTagName("y")[0].childNodes[0].nodeValue);
-					  window.iq_calc[i] = new Array(x,y,0,0,0);
-				  }
-				  document.getElementById('model_pars_errors').innerHTML = "";
-			} else {
-				var errs = xmldata.getElementsByTagName("error");
-				var err_html = "";
-				if (errs.length > 0) {
-					err_html = "<div class='error'>"
-					for (i = 0; i < errs.length; i++) {
-						err_html += errs[i].getElementsByTagName("par")[0].childNodes[0].nodeValue;
-						err_html += ":<ul class='errorlist'><li>"+errs[i].getElementsByTagName("value")[0].childNodes[0].nodeValue+"</li></ul>"
-					}
-					err_html += "</div>";
+	var url = '/analysis/'+window.fit_problem.iq_id+'/model/'+window.fit_problem.model_id+'/data/?'+params;
+	load_plot_data($, url, function(payload){
+		window.iq_calc = payload_to_points(payload);
+		if (window.iq_calc.length>0) {
+			document.getElementById('model_pars_errors').innerHTML = "";
+		} else {
+			// The messages describe the parameters that are not valid
+			var err_html = "";
+			if (payload.messages.length > 0) {
+				err_html = "<div class='error'><ul class='errorlist'>";
+				for (i = 0; i < payload.messages.length; i++) {
+					err_html += "<li>"+payload.messages[i]+"</li>";
 				}
-				
-				document.getElementById('model_pars_errors').innerHTML = err_html;
-			};
-			iq_plot();
-	  }
+				err_html += "</ul></div>";
+			}
+			document.getElementById('model_pars_errors').innerHTML = err_html;
+		};
+		iq_plot();
 	});
 	
 	
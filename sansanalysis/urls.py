@@ -10,6 +10,7 @@ urlpatterns = patterns('',
      (r'^analysis/', include('sansanalysis.modeling.urls')),
      #(r'^analysis/', include('sansanalysis.refl_invert.urls')),
      (r'^comments/', include('sansanalysis.commenting.urls')),
+     (r'^jobs/', include('sansanalysis.jobs.urls')),
      (r'^admin/', include(admin.site.urls)),
 
      # OpenID